@@ -1,163 +1,295 @@
-from flask import Flask, request, Response, render_template
+import argparse
+import logging
+from flask import Flask, g, request, Response, render_template, stream_with_context
 import requests
-from pymongo import MongoClient
+from pymongo.errors import PyMongoError
 from tqdm import tqdm
 from datetime import datetime
-clients = dict(
-    db1 = [
-        MongoClient(host="localhost", port=27001),
-        MongoClient(host="localhost", port=27002),
-        ],
-    db2 = [
-        MongoClient(host="localhost", port=27003),
-        MongoClient(host="localhost", port=27004),
-        ]
-    )
+from file_mapping import FileMappingCache
+from hydration import FASTDFS_TIMEOUT, ArticleHydrator, PREVIEW_BYTES, media_error
+from instrumentation import FASTDFS_SECONDS, METRICS_MIMETYPE, finish_trace, registry, span, start_trace
+from pagination import (DEFAULT_READ_FIELDS, NDJSON_MIMETYPE, NEXT_PAGE_HEADER, RANK_LIST_FIELDS,
+                        RANK_LIST_PROJECTION, READ_FIELDS, STREAM_BATCH_SIZE, PageRequest, format_rank_entry,
+                        format_read, ndjson_line, parse_rank_cursor, parse_read_cursor, read_projection)
+from response_cache import ResponseCache
+from router import RANK_SITES, QueryRouter
+router = QueryRouter()
 app = Flask(__name__)
+file_mapping = FileMappingCache(router.ordered_clients)
+hydrator = ArticleHydrator(router, file_mapping)
+response_cache = ResponseCache()
+
+# Bytes per chunk streamed by the media proxy
+MEDIA_CHUNK_SIZE = 64 * 1024
+
+# Upstream headers passed through by the media proxy
+MEDIA_HEADERS = ("Content-Type", "Content-Length", "Content-Range", "Accept-Ranges", "ETag", "Last-Modified")
 
 def convert_file_to_path(file_name):
-    for client in sum(list(clients.values()),[]):
-        try:
-            return client.file.mapping.find_one(dict(name=file_name))["path"].replace("0.0.0.0","localhost")
-        except:
-            pass
-    return None
+    return file_mapping.get(file_name)
 
+@app.before_request
+def start_request_trace():
+    g.trace_token = start_trace(f"{request.method} {request.path}")
 
-def article_by_id(aid):
-    for db2_client in clients["db2"]:
-        try:
-            article = db2_client.info.article.find_one(dict(aid=aid))
-            # print(article)
-            text_file = article["text"]
-            
-            text_location = convert_file_to_path(text_file).strip()
-            print(text_location)
+def request_route():
+    return request.url_rule.rule if request.url_rule else "unmatched"
 
-            # Fetch the text content directly like in the original backend
-            text = requests.get(text_location).text
+@app.after_request
+def finish_request_trace(response):
+    """Per-request breakdown of Mongo, FastDFS and mapping time in the Server-Timing header."""
+    token = g.pop("trace_token", None)
+    if token is not None:
+        timing = finish_trace(token, request_route(), response.status_code)
+        # A streamed body is produced after this point; a header would only cover the setup
+        if not response.is_streamed:
+            response.headers["Server-Timing"] = timing
+    return response
 
-            images = [convert_file_to_path(i).strip() for i in article["image"].split(',') if i.strip()]
-            videos = [convert_file_to_path(i).strip() for i in article["video"].split(',') if i.strip()]
+@app.teardown_request
+def close_request_trace(exception):
+    """Finish traces after_request never saw, e.g. of a view that raised."""
+    token = g.pop("trace_token", None)
+    if token is not None:
+        finish_trace(token, request_route(), 500)
 
-            return dict(text=text, images=images, videos=videos)
-        except:
-            pass
 
-def user_by_id(uid):
-    for client in sum(list(clients.values()),[]):
-        try:
-            user = client.info.user.find_one(dict(uid=uid))
-            if user:
-                user['_id'] = str(user['_id'])
-                return user
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            pass
+def cache_articles(articles):
+    for aid, article in articles.items():
+        if article["text"] is not None:
+            response_cache.put(("article", aid), article)
+
+def article_by_id(aid):
+    article = response_cache.get(("article", aid))
+    if article is not None:
+        return article
+    articles = hydrator.hydrate([aid])
+    cache_articles(articles)
+    article = articles.get(aid)
+    if article and article["text"] is not None:
+        return article
+    return None
+
+def articles_by_ids(aids, preview_bytes=PREVIEW_BYTES):
+    """
+    Hydrate several articles with batched queries; missing texts become empty strings.
+    Texts are cut to `preview_bytes` (0 for whole texts).
+    """
+    articles = hydrator.hydrate(aids, preview_bytes)
+    return {aid: article["text"] or "" for aid, article in articles.items()}
 
+def user_by_id(uid):
+    user = router.find_user(uid)
+    if user:
+        user['_id'] = str(user['_id'])
+        return user
     return dict(message="User Not Found")
 
-def find_user_read_list(uid):
-    for client in sum(list(clients.values()),[]):
-        try:
-            history = list(client.history.read.find(dict(uid=uid)))
-            if history:
-                return history
-        except:
-            pass
-    return []
+def find_user_read_list(uid, after=None, limit=None, projection=None):
+    return router.find_reads(uid, after, limit, projection)
 
 def get_popular_rank(grainaty, rid):
-    for client in clients["db1" if grainaty=="daily" else "db2"]:
-        try:
-            rank = client.history.popular_rank.find_one(dict(temporalGranularity=grainaty, id=rid))
-            if rank:
-                return rank
-        except:
-            pass
-    return None
+    try:
+        return router.find_rank(grainaty, rid)
+    except PyMongoError:
+        return None
 
-def get_all_popular_rank(grainaty):
-    for client in clients["db1" if grainaty=="daily" else "db2"]:
-        try:
-            rank = client.history.popular_rank.find(dict(temporalGranularity=grainaty))
-            if rank:
-                return rank
-        except:
-            pass
-    return []
+def get_all_popular_rank(grainaty, after=None, limit=None, projection=None):
+    try:
+        return router.find_ranks(grainaty, after, limit, projection)
+    except PyMongoError:
+        return []
 
 @app.route("/api/article/<aid>")
 def get_article_api(aid: str):
     article_data = article_by_id(aid)
-    print(article_data)
     if article_data:
         return article_data
     return {"error": "Article not found"}, 404
 
+def history_entries(history, fields, preview_bytes):
+    texts = articles_by_ids([i["aid"] for i in history], preview_bytes) if "text" in fields else {}
+    return [format_read(i, texts, fields) for i in history]
+
+def next_page_headers(page, limit, key):
+    """Cursor of the next page, sent only when this page is full."""
+    if len(page) < limit:
+        return {}
+    return {NEXT_PAGE_HEADER: str(page[-1][key])}
+
 @app.route("/api/user/<uid>")
 def get_user_api(uid: str):
+    """
+    A user and a page of its reading history. ?limit=&after= page through
+    the history, ?fields= picks the fields of each read and
+    ?format=ndjson streams the whole history, one JSON object per line.
+    """
+    try:
+        page = PageRequest(request.args, READ_FIELDS, DEFAULT_READ_FIELDS, parse_read_cursor)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    preview_bytes = request.args.get("preview", PREVIEW_BYTES, type=int)
+
     user = user_by_id(uid)
     if user.get("message") == "User Not Found":
         return user, 404
-    
-    history = find_user_read_list(uid)
-    history = [dict(
-        text=article_by_id(i["aid"])["text"],  # Now this will work because we're getting the actual text
-        timestamp=i["timestamp"],
-        aid=i["aid"]
-    ) for i in history]
-    
+
+    projection = read_projection(page.fields)
+    if page.stream:
+        def lines():
+            yield ndjson_line({"user": user})
+            for history in router.iter_reads(uid, page.after, projection, STREAM_BATCH_SIZE):
+                for entry in history_entries(history, page.fields, preview_bytes):
+                    yield ndjson_line(entry)
+        return Response(stream_with_context(lines()), mimetype=NDJSON_MIMETYPE)
+
+    history = find_user_read_list(uid, page.after, page.limit, projection)
     return {
         "user": user,
-        "reading_history": history
-    }
+        "reading_history": history_entries(history, page.fields, preview_bytes)
+    }, next_page_headers(history, page.limit, "_id")
+
+def rank_response(rank, preview_bytes):
+    article_list = rank.pop("articleList", None)
+    materialized_bytes = rank.pop("previewBytes", None)
+    begin_date = rank.pop("beginDate", None)
+    # Summaries stored by generate_popular_rank --materialize, unless stale or cut to another size
+    if (article_list is not None and materialized_bytes == preview_bytes
+            and [i["aid"] for i in article_list] == rank["articleAidList"]):
+        rank["article_list"] = article_list
+    else:
+        texts = articles_by_ids(rank["articleAidList"], preview_bytes)
+        rank["article_list"] = [dict(
+            text=texts.get(i, ""),
+            aid=i
+        ) for i in rank["articleAidList"]]
+
+    timestamp = int(rank["timestamp"]) / 1000
+    rank["begin_date"] = begin_date or datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+    del rank["timestamp"]
+    del rank["_id"]
+    return rank
+
+def check_rank_version():
+    """Drop cached rank responses once generate_popular_rank has written new ranks."""
+    if response_cache.version_due():
+        response_cache.set_version(router.rank_version())
 
 @app.route("/api/popular_rank/<grainaty>/<rid>")
 def get_popular_rank_api(grainaty: str, rid: str):
     rid = int(rid)
+    preview_bytes = request.args.get("preview", PREVIEW_BYTES, type=int)
+    check_rank_version()
+    key = ("rank", grainaty, rid, preview_bytes)
+    response = response_cache.get(key)
+    if response is not None:
+        return response
+
     rank = get_popular_rank(grainaty, rid)
     if not rank:
         return {"error": "Rank not found"}, 404
-    
-    rank["article_list"] = [dict(
-        text=article_by_id(i)["text"],
-        aid=i
-    ) for i in rank["articleAidList"]]
-    
-    timestamp = int(rank["timestamp"]) / 1000
-    rank["begin_date"] = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
 
-    # print(rank)
-    del rank["timestamp"]
-    del rank["_id"]
-    
-    return rank
+    response = rank_response(rank, preview_bytes)
+    response_cache.put(key, response)
+    return response
 
+def warm_response_cache():
+    """Cache the newest rank of every granularity and the full articles it lists."""
+    response_cache.set_version(router.rank_version())
+    aids = []
+    for grainaty in RANK_SITES:
+        try:
+            rank = router.latest_rank(grainaty)
+        except PyMongoError:
+            continue
+        if rank:
+            aids.extend(rank["articleAidList"])
+            response_cache.put(("rank", grainaty, rank["id"], PREVIEW_BYTES), rank_response(rank, PREVIEW_BYTES))
+    cache_articles(hydrator.hydrate(aids))
 
 @app.route("/api/popular_rank/<grainaty>")
 def get_all_popular_rank_api(grainaty: str):
-    ranks = []
-    for client in clients["db1" if grainaty=="daily" else "db2"]:
-        try:
-            ranks.extend(list(client.history.popular_rank.find({"temporalGranularity": grainaty})))
-        except:
-            pass
-            
+    """Rank ids and dates of a granularity, paged like the reading history."""
+    try:
+        page = PageRequest(request.args, RANK_LIST_FIELDS, RANK_LIST_FIELDS, parse_rank_cursor)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    if page.stream:
+        def lines():
+            for ranks in router.iter_ranks(grainaty, page.after, RANK_LIST_PROJECTION, STREAM_BATCH_SIZE):
+                for rank in ranks:
+                    yield ndjson_line(format_rank_entry(rank, page.fields))
+        return Response(stream_with_context(lines()), mimetype=NDJSON_MIMETYPE)
+
+    ranks = get_all_popular_rank(grainaty, page.after, page.limit, RANK_LIST_PROJECTION)
     if not ranks:
         return {"error": "No ranks found"}, 404
 
-    timestamps = []
-    for rank in ranks:
-        timestamp = int(rank["timestamp"]) / 1000
-        timestamps.append({
-            "timestamp": timestamp,
-            "date": datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d'),
-            "rid": rank["id"]
-        })
-        
-    return timestamps
+    return [format_rank_entry(rank, page.fields) for rank in ranks], next_page_headers(ranks, page.limit, "id")
+
+@app.route("/api/media/<path:file_name>")
+def get_media_api(file_name: str):
+    """Stream a stored file from FastDFS, passing Range requests through."""
+    location = convert_file_to_path(file_name)
+    if location is None:
+        return {"error": "File not found"}, 404
+
+    # Identity encoding keeps Content-Length and Content-Range valid
+    headers = {"Accept-Encoding": "identity"}
+    if "Range" in request.headers:
+        headers["Range"] = request.headers["Range"]
+    with span("fastdfs", FASTDFS_SECONDS, kind="media") as labels:
+        try:
+            upstream = hydrator.session.get(location, headers=headers, stream=True, timeout=FASTDFS_TIMEOUT)
+        except requests.RequestException:
+            labels["outcome"] = "error"
+            return {"error": "Storage unavailable"}, 502
+    if upstream.status_code >= 400:
+        upstream.close()
+        message, status = media_error(upstream.status_code)
+        return {"error": message}, status
+
+    def chunks():
+        with upstream:
+            yield from upstream.iter_content(MEDIA_CHUNK_SIZE)
+
+    return Response(
+        stream_with_context(chunks()),
+        status=upstream.status_code,
+        headers={name: upstream.headers[name] for name in MEDIA_HEADERS if name in upstream.headers},
+        direct_passthrough=True,
+    )
+
+@app.route("/api/stats/response_cache")
+def get_response_cache_stats_api():
+    return response_cache.stats()
+
+@app.route("/api/stats/file_mapping")
+def get_file_mapping_stats_api():
+    return file_mapping.stats()
+
+@app.route("/api/stats/nodes")
+def get_node_stats_api():
+    return {"nodes": router.connections.stats()}
+
+@app.route("/metrics")
+def get_metrics_api():
+    return Response(registry.render(), content_type=METRICS_MIMETYPE)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="API server")
+    parser.add_argument("--spread-reads", action="store_true",
+                        help="spread reads across the primary and backup of each site")
+    parser.add_argument("--cache-bytes", type=int, default=response_cache.max_bytes,
+                        help="memory bound of the article and rank response cache")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    router.connections.spread_reads = args.spread_reads
+    response_cache.max_bytes = args.cache_bytes
+    router.connections.start()
+    router.load_directory()
+    file_mapping.load()
+    warm_response_cache()
     app.run(host='0.0.0.0', port=8070)
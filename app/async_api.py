@@ -0,0 +1,599 @@
+"""
+asyncio serving mode of the API.
+Serves the same routes as api.py with motor for MongoDB and a pooled
+keep-alive aiohttp client for the nginx/FastDFS gateway, so a slow
+download or query no longer blocks the worker. Queries are routed
+like api.py (see router.py).
+
+    python3 async_api.py --port 8070
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+import aiohttp
+from aiohttp import web
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import PyMongoError
+
+from connection import ConnectionManager
+from file_mapping import FileMappingCache
+from hydration import (ARTICLE_PROJECTION, FASTDFS_TIMEOUT, PREVIEW_BYTES, TEXT_FETCH_WORKERS, media_error,
+                       split_file_names)
+from instrumentation import (FAILOVERS, FASTDFS_SECONDS, MAPPING_SECONDS, METRICS_MIMETYPE, MONGO_SECONDS,
+                             finish_trace, registry, span, start_trace)
+from pagination import (DEFAULT_READ_FIELDS, NDJSON_MIMETYPE, NEXT_PAGE_HEADER, RANK_LIST_FIELDS,
+                        RANK_LIST_PROJECTION, READ_FIELDS, STREAM_BATCH_SIZE, PageRequest, format_rank_entry,
+                        format_read, ndjson_line, parse_rank_cursor, parse_read_cursor, read_projection)
+from response_cache import ResponseCache
+from router import DEFAULT_ARTICLE_SITE, RANK_SITES, RANK_VERSION_ID, SITES, ShardDirectory
+
+# Connections kept open to the FastDFS gateway
+HTTP_POOL_SIZE = 100
+
+# Bytes per chunk streamed by the media proxy
+MEDIA_CHUNK_SIZE = 64 * 1024
+
+# Upstream headers passed through by the media proxy
+MEDIA_HEADERS = ("Content-Type", "Content-Length", "Content-Range", "Accept-Ranges", "ETag", "Last-Modified")
+
+class AsyncFileMappingCache(FileMappingCache):
+    """FileMappingCache whose loads and fallback queries go through motor."""
+
+    def _refresh_if_stale(self):
+        # Refreshed by AsyncFileMappingCache.refresh_forever instead
+        pass
+
+    @staticmethod
+    async def _async_version_of(client):
+        mapping = client.file.mapping
+        newest = await mapping.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+        return await mapping.estimated_document_count(), newest["_id"] if newest else None
+
+    async def async_load(self):
+        for client in self.clients:
+            try:
+                version = await self._async_version_of(client)
+                entries = await client.file.mapping.find({}, {"_id": 0, "name": 1, "path": 1}).to_list(None)
+            except PyMongoError:
+                continue
+            self._install(entries, version)
+            return True
+        return False
+
+    async def refresh_forever(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            for client in self.clients:
+                try:
+                    version = await self._async_version_of(client)
+                except PyMongoError:
+                    continue
+                if version != self._version:
+                    await self.async_load()
+                break
+
+    async def async_get_many(self, file_names):
+        with span("mapping", MAPPING_SECONDS, source="cache") as labels:
+            paths, missing = self._lookup_cached(file_names)
+            if missing:
+                labels["source"] = "mongo"
+            for client in self.clients:
+                if not missing:
+                    break
+                try:
+                    entries = await client.file.mapping.find(
+                        {"name": {"$in": missing}}, {"_id": 0, "name": 1, "path": 1}
+                    ).to_list(None)
+                except PyMongoError:
+                    continue
+                found = {entry["name"]: self._public_path(entry["path"]) for entry in entries}
+                self._remember(found)
+                paths.update(found)
+                missing = [name for name in missing if name not in found]
+            return paths
+
+class AsyncBackend:
+    def __init__(self, spread_reads=False):
+        self.connections = ConnectionManager(SITES, client_factory=AsyncIOMotorClient, spread_reads=spread_reads)
+        self.directory = ShardDirectory()
+        self.file_mapping = AsyncFileMappingCache(self.ordered_clients)
+        self.response_cache = ResponseCache()
+        self.session = None
+        self.text_limit = None
+
+    async def start(self, app):
+        connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=60)
+        connect_timeout, read_timeout = FASTDFS_TIMEOUT
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        # Created here so it binds to the loop serving the app
+        self.text_limit = asyncio.Semaphore(TEXT_FETCH_WORKERS)
+        await self.ping_all()
+        app["ping_nodes"] = asyncio.create_task(self.ping_forever())
+        await self.load_directory()
+        await self.file_mapping.async_load()
+        app["refresh_file_mapping"] = asyncio.create_task(self.file_mapping.refresh_forever())
+        await self.warm_response_cache()
+        app["check_rank_version"] = asyncio.create_task(self.check_rank_version_forever())
+
+    async def stop(self, app):
+        app["ping_nodes"].cancel()
+        app["refresh_file_mapping"].cancel()
+        app["check_rank_version"].cancel()
+        await self.session.close()
+        for node in self.connections.all_nodes():
+            node.client.close()
+
+    @property
+    def sites(self):
+        return list(self.connections.nodes)
+
+    def ordered_clients(self):
+        return [node.client for site in self.sites for node in self.connections.replicas(site)]
+
+    @staticmethod
+    async def ping(node):
+        started = time.perf_counter()
+        try:
+            await node.client.admin.command("ping")
+        except PyMongoError:
+            node.record_failure()
+            return
+        node.record_success(time.perf_counter() - started)
+
+    async def ping_all(self):
+        await asyncio.gather(*(self.ping(node) for node in self.connections.all_nodes()))
+
+    async def ping_forever(self):
+        while True:
+            await asyncio.sleep(self.connections.ping_interval)
+            await self.ping_all()
+
+    async def run(self, site, operation, name="query"):
+        """Async counterpart of QueryRouter.run."""
+        error = None
+        for node in self.connections.replicas(site):
+            address = "%s:%d" % node.address
+            try:
+                with span("mongo", MONGO_SECONDS, operation=name, node=address):
+                    result = await operation(node.client)
+            except PyMongoError as e:
+                node.record_failure()
+                FAILOVERS.inc(site=site, node=address)
+                error = e
+                continue
+            node.record_success()
+            return result
+        raise error or self.connections.unavailable(site)
+
+    async def load_directory(self):
+        for site in self.sites:
+            try:
+                self.directory.add_users(await self.run(site, lambda client: client.info.user.find(
+                    {}, {"_id": 0, "uid": 1, "region": 1}).to_list(None), "info.user.find"))
+            except PyMongoError:
+                continue
+        try:
+            self.directory.add_articles(await self.run(DEFAULT_ARTICLE_SITE, lambda client: client.info.article.find(
+                {}, {"_id": 0, "aid": 1, "category": 1}).to_list(None), "info.article.find"))
+        except PyMongoError:
+            pass
+
+    def user_sites(self, uid):
+        site = self.directory.user_site(uid)
+        return [site] if site else self.sites
+
+    async def fetch_text(self, location, preview_bytes=None):
+        """Download a text file, or only its first `preview_bytes` bytes with a Range request."""
+        headers = {"Range": f"bytes=0-{preview_bytes - 1}", "Accept-Encoding": "identity"} if preview_bytes else {}
+        async with self.text_limit:
+            with span("fastdfs", FASTDFS_SECONDS, kind="preview" if preview_bytes else "text") as labels:
+                try:
+                    async with self.session.get(location, headers=headers) as response:
+                        response.raise_for_status()
+                        if not preview_bytes:
+                            return await response.text()
+                        # A server ignoring Range sends the whole file; read only the start
+                        data = await response.content.read(preview_bytes)
+                        return data.decode(response.charset or "utf-8", errors="ignore")
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    labels["outcome"] = "error"
+                    return None
+
+    async def find_articles(self, aids):
+        """One $in query per site, sent to all sites at once."""
+        groups = self.directory.group_articles(aids)
+        results = await asyncio.gather(*(
+            self.run(site, lambda client, batch=batch: client.info.article.find(
+                {"aid": {"$in": batch}}, ARTICLE_PROJECTION).to_list(None), "info.article.find")
+            for site, batch in groups.items()
+        ), return_exceptions=True)
+        return {
+            article["aid"]: article
+            for result in results if not isinstance(result, Exception)
+            for article in result
+        }
+
+    async def hydrate(self, aids, preview_bytes=None):
+        """Async counterpart of ArticleHydrator.hydrate."""
+        articles = await self.find_articles(list(dict.fromkeys(aids)))
+
+        file_names = []
+        for article in articles.values():
+            file_names.append(article["text"])
+            file_names.extend(split_file_names(article.get("image")))
+            file_names.extend(split_file_names(article.get("video")))
+        paths = await self.file_mapping.async_get_many(file_names)
+
+        async def no_text():
+            return None
+
+        texts = await asyncio.gather(*(
+            self.fetch_text(paths[article["text"]], preview_bytes) if article["text"] in paths else no_text()
+            for article in articles.values()
+        ))
+        texts = dict(zip(articles, texts))
+
+        return {
+            aid: dict(
+                text=texts[aid],
+                images=[paths[name] for name in split_file_names(article.get("image")) if name in paths],
+                videos=[paths[name] for name in split_file_names(article.get("video")) if name in paths],
+            )
+            for aid, article in articles.items()
+        }
+
+    async def first_result(self, sites, operation, name="query"):
+        """Query candidate sites concurrently; return the first non-empty result in site order."""
+        results = await asyncio.gather(*(self.run(site, operation, name) for site in sites), return_exceptions=True)
+        for result in results:
+            if result and not isinstance(result, Exception):
+                return result
+        return None
+
+    async def user_by_id(self, uid):
+        user = await self.first_result(self.user_sites(uid), lambda client: client.info.user.find_one(dict(uid=uid)),
+                                       "info.user.find_one")
+        if user:
+            self.directory.add_users([user])
+            user["_id"] = str(user["_id"])
+        return user
+
+    async def page(self, site, namespace, query, key, after=None, limit=None, projection=None):
+        """Async counterpart of QueryRouter.page."""
+        database, collection = namespace
+        if after is not None:
+            query = dict(query, **{key: {"$gt": after}})
+        if projection is not None:
+            projection = dict(projection, **{key: 1})
+
+        def operation(client):
+            cursor = client[database][collection].find(query, projection).sort(key, 1)
+            if limit:
+                cursor = cursor.limit(limit)
+            return cursor.to_list(None)
+
+        return await self.run(site, operation, f"{database}.{collection}.find")
+
+    async def pages(self, site, namespace, query, key, after=None, projection=None, batch_size=None):
+        """Async counterpart of QueryRouter.pages."""
+        while True:
+            page = await self.page(site, namespace, query, key, after, batch_size, projection)
+            if page:
+                yield page
+            if not batch_size or len(page) < batch_size:
+                return
+            after = page[-1][key]
+
+    async def read_site(self, uid):
+        site = self.directory.user_site(uid)
+        if site:
+            return site
+        for site in self.sites:
+            try:
+                if await self.page(site, ("history", "read"), dict(uid=uid), "_id", limit=1, projection={"_id": 1}):
+                    return site
+            except PyMongoError:
+                continue
+        return None
+
+    async def find_user_read_list(self, uid, after=None, limit=None, projection=None):
+        site = await self.read_site(uid)
+        if site is None:
+            return []
+        return await self.page(site, ("history", "read"), dict(uid=uid), "_id", after, limit, projection)
+
+    async def iter_reads(self, uid, after=None, projection=None, batch_size=None):
+        site = await self.read_site(uid)
+        if site is None:
+            return
+        async for page in self.pages(site, ("history", "read"), dict(uid=uid), "_id", after, projection, batch_size):
+            yield page
+
+    async def get_popular_rank(self, grainaty, rid):
+        try:
+            return await self.run(self.directory.rank_site(grainaty), lambda client: client.history.popular_rank.find_one(
+                dict(temporalGranularity=grainaty, id=rid)), "history.popular_rank.find_one")
+        except PyMongoError:
+            return None
+
+    async def get_all_popular_rank(self, grainaty, after=None, limit=None, projection=None):
+        try:
+            return await self.page(self.directory.rank_site(grainaty), ("history", "popular_rank"),
+                                   dict(temporalGranularity=grainaty), "id", after, limit, projection)
+        except PyMongoError:
+            return []
+
+    async def latest_rank(self, grainaty):
+        return await self.run(self.directory.rank_site(grainaty), lambda client: client.history.popular_rank.find_one(
+            dict(temporalGranularity=grainaty), sort=[("timestamp", -1)]), "history.popular_rank.find_one")
+
+    async def rank_version(self):
+        """Async counterpart of QueryRouter.rank_version."""
+        versions = []
+        for site in sorted(set(RANK_SITES.values())):
+            try:
+                version = await self.run(site, lambda client: client.history.popular_rank_version.find_one(
+                    {"_id": RANK_VERSION_ID}), "history.popular_rank_version.find_one")
+            except PyMongoError:
+                return None
+            versions.append(version["version"] if version else 0)
+        return tuple(versions)
+
+    async def check_rank_version_forever(self):
+        """Drop cached rank responses once generate_popular_rank has written new ranks."""
+        while True:
+            await asyncio.sleep(self.response_cache.version_ttl)
+            self.response_cache.set_version(await self.rank_version())
+
+    def cache_articles(self, articles):
+        for aid, article in articles.items():
+            if article["text"] is not None:
+                self.response_cache.put(("article", aid), article)
+
+    async def rank_response(self, rank, preview):
+        """Async counterpart of api.rank_response."""
+        article_list = rank.pop("articleList", None)
+        materialized_bytes = rank.pop("previewBytes", None)
+        begin_date = rank.pop("beginDate", None)
+        if (article_list is not None and materialized_bytes == preview
+                and [i["aid"] for i in article_list] == rank["articleAidList"]):
+            rank["article_list"] = article_list
+        else:
+            articles = await self.hydrate(rank["articleAidList"], preview)
+            rank["article_list"] = [dict(
+                text=(articles.get(i) or {}).get("text") or "",
+                aid=i
+            ) for i in rank["articleAidList"]]
+
+        timestamp = int(rank["timestamp"]) / 1000
+        rank["begin_date"] = begin_date or datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+        del rank["timestamp"]
+        del rank["_id"]
+        return rank
+
+    async def warm_response_cache(self):
+        """Cache the newest rank of every granularity and the full articles it lists."""
+        self.response_cache.set_version(await self.rank_version())
+        aids = []
+        for grainaty in RANK_SITES:
+            try:
+                rank = await self.latest_rank(grainaty)
+            except PyMongoError:
+                continue
+            if rank:
+                aids.extend(rank["articleAidList"])
+                self.response_cache.put(("rank", grainaty, rank["id"], PREVIEW_BYTES),
+                                        await self.rank_response(rank, PREVIEW_BYTES))
+        self.cache_articles(await self.hydrate(aids))
+
+    def iter_ranks(self, grainaty, after=None, projection=None, batch_size=None):
+        return self.pages(self.directory.rank_site(grainaty), ("history", "popular_rank"),
+                          dict(temporalGranularity=grainaty), "id", after, projection, batch_size)
+
+backend = AsyncBackend()
+routes = web.RouteTableDef()
+
+def preview_bytes(request):
+    """Text preview size from ?preview= (0 for whole texts)."""
+    try:
+        return int(request.query.get("preview", PREVIEW_BYTES))
+    except ValueError:
+        return PREVIEW_BYTES
+
+async def history_entries(history, fields, preview):
+    articles = await backend.hydrate([i["aid"] for i in history], preview) if "text" in fields else {}
+    texts = {aid: article["text"] or "" for aid, article in articles.items()}
+    return [format_read(i, texts, fields) for i in history]
+
+def next_page_headers(page, limit, key):
+    """Cursor of the next page, sent only when this page is full."""
+    if len(page) < limit:
+        return {}
+    return {NEXT_PAGE_HEADER: str(page[-1][key])}
+
+async def stream_ndjson(request, lines):
+    response = web.StreamResponse(headers={"Content-Type": NDJSON_MIMETYPE})
+    await response.prepare(request)
+    async for line in lines:
+        await response.write(line.encode("utf-8"))
+    await response.write_eof()
+    return response
+
+@routes.get("/api/article/{aid}")
+async def get_article_api(request):
+    aid = request.match_info["aid"]
+    article = backend.response_cache.get(("article", aid))
+    if article is None:
+        articles = await backend.hydrate([aid])
+        backend.cache_articles(articles)
+        article = articles.get(aid)
+    if article and article["text"] is not None:
+        return web.json_response(article)
+    return web.json_response({"error": "Article not found"}, status=404)
+
+@routes.get("/api/user/{uid}")
+async def get_user_api(request):
+    """Paged like api.get_user_api: ?limit=, ?after=, ?fields= and ?format=ndjson."""
+    uid = request.match_info["uid"]
+    try:
+        page = PageRequest(request.query, READ_FIELDS, DEFAULT_READ_FIELDS, parse_read_cursor)
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
+    preview = preview_bytes(request)
+
+    user = await backend.user_by_id(uid)
+    if not user:
+        return web.json_response(dict(message="User Not Found"), status=404)
+
+    projection = read_projection(page.fields)
+    if page.stream:
+        async def lines():
+            yield ndjson_line({"user": user})
+            async for history in backend.iter_reads(uid, page.after, projection, STREAM_BATCH_SIZE):
+                for entry in await history_entries(history, page.fields, preview):
+                    yield ndjson_line(entry)
+        return await stream_ndjson(request, lines())
+
+    history = await backend.find_user_read_list(uid, page.after, page.limit, projection)
+    return web.json_response({
+        "user": user,
+        "reading_history": await history_entries(history, page.fields, preview)
+    }, headers=next_page_headers(history, page.limit, "_id"))
+
+@routes.get("/api/popular_rank/{grainaty}/{rid}")
+async def get_popular_rank_api(request):
+    grainaty = request.match_info["grainaty"]
+    rid = int(request.match_info["rid"])
+    preview = preview_bytes(request)
+    key = ("rank", grainaty, rid, preview)
+    response = backend.response_cache.get(key)
+    if response is not None:
+        return web.json_response(response)
+
+    rank = await backend.get_popular_rank(grainaty, rid)
+    if not rank:
+        return web.json_response({"error": "Rank not found"}, status=404)
+
+    response = await backend.rank_response(rank, preview)
+    backend.response_cache.put(key, response)
+    return web.json_response(response)
+
+@routes.get("/api/popular_rank/{grainaty}")
+async def get_all_popular_rank_api(request):
+    grainaty = request.match_info["grainaty"]
+    try:
+        page = PageRequest(request.query, RANK_LIST_FIELDS, RANK_LIST_FIELDS, parse_rank_cursor)
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
+
+    if page.stream:
+        async def lines():
+            async for ranks in backend.iter_ranks(grainaty, page.after, RANK_LIST_PROJECTION, STREAM_BATCH_SIZE):
+                for rank in ranks:
+                    yield ndjson_line(format_rank_entry(rank, page.fields))
+        return await stream_ndjson(request, lines())
+
+    ranks = await backend.get_all_popular_rank(grainaty, page.after, page.limit, RANK_LIST_PROJECTION)
+    if not ranks:
+        return web.json_response({"error": "No ranks found"}, status=404)
+
+    return web.json_response([format_rank_entry(rank, page.fields) for rank in ranks],
+                             headers=next_page_headers(ranks, page.limit, "id"))
+
+@routes.get("/api/media/{file_name:.+}")
+async def get_media_api(request):
+    """Stream a stored file from FastDFS, passing Range requests through."""
+    paths = await backend.file_mapping.async_get_many([request.match_info["file_name"]])
+    if not paths:
+        return web.json_response({"error": "File not found"}, status=404)
+
+    # Identity encoding keeps Content-Length and Content-Range valid
+    headers = {"Accept-Encoding": "identity"}
+    if "Range" in request.headers:
+        headers["Range"] = request.headers["Range"]
+    response = None
+    try:
+        with span("fastdfs", FASTDFS_SECONDS, kind="media"):
+            upstream = await backend.session.get(next(iter(paths.values())), headers=headers)
+        async with upstream:
+            if upstream.status >= 400:
+                message, status = media_error(upstream.status)
+                return web.json_response({"error": message}, status=status)
+            response = web.StreamResponse(
+                status=upstream.status,
+                headers={name: upstream.headers[name] for name in MEDIA_HEADERS if name in upstream.headers},
+            )
+            await response.prepare(request)
+            async for chunk in upstream.content.iter_chunked(MEDIA_CHUNK_SIZE):
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        if response is not None:
+            # Headers are already sent; the client sees a short body
+            return response
+        return web.json_response({"error": "Storage unavailable"}, status=502)
+
+@routes.get("/api/stats/response_cache")
+async def get_response_cache_stats_api(request):
+    return web.json_response(backend.response_cache.stats())
+
+@routes.get("/api/stats/file_mapping")
+async def get_file_mapping_stats_api(request):
+    return web.json_response(backend.file_mapping.stats())
+
+@routes.get("/api/stats/nodes")
+async def get_node_stats_api(request):
+    return web.json_response({"nodes": backend.connections.stats()})
+
+@routes.get("/metrics")
+async def get_metrics_api(request):
+    return web.Response(body=registry.render().encode("utf-8"), headers={"Content-Type": METRICS_MIMETYPE})
+
+@web.middleware
+async def trace_middleware(request, handler):
+    """Async counterpart of api.start_request_trace / finish_request_trace."""
+    token = start_trace(f"{request.method} {request.path}")
+    status = 500
+    response = None
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else "unmatched"
+        timing = finish_trace(token, route, status)
+        # Streamed responses have sent their headers already
+        if response is not None and not response.prepared:
+            response.headers["Server-Timing"] = timing
+
+def create_app():
+    app = web.Application(middlewares=[trace_middleware])
+    app.add_routes(routes)
+    app.on_startup.append(backend.start)
+    app.on_cleanup.append(backend.stop)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="asyncio API server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8070)
+    parser.add_argument("--spread-reads", action="store_true",
+                        help="spread reads across the primary and backup of each site")
+    parser.add_argument("--cache-bytes", type=int, default=backend.response_cache.max_bytes,
+                        help="memory bound of the article and rank response cache")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    backend.connections.spread_reads = args.spread_reads
+    backend.response_cache.max_bytes = args.cache_bytes
+    web.run_app(create_app(), host=args.host, port=args.port)
@@ -0,0 +1,159 @@
+import itertools
+import threading
+import time
+
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError, ServerSelectionTimeoutError
+
+# Client timeouts (ms); a dead node must fail fast so the backup can answer
+SERVER_SELECTION_TIMEOUT_MS = 500
+CONNECT_TIMEOUT_MS = 500
+SOCKET_TIMEOUT_MS = 5000
+
+# Seconds between background pings of every node
+PING_INTERVAL = 1.0
+
+# Consecutive failures that open a node's circuit, and seconds before it is retried
+FAILURE_THRESHOLD = 2
+RECOVERY_TIMEOUT = 5.0
+
+# Weight of the newest ping in the latency average
+LATENCY_SMOOTHING = 0.3
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+class NodeHealth:
+    """
+    Circuit breaker of one node. `failure_threshold` consecutive failures
+    open the circuit and the node is skipped; after `recovery_timeout`
+    seconds it is half open and the next call decides whether it closes
+    again or stays open.
+    """
+
+    def __init__(self, site, address, client, failure_threshold=FAILURE_THRESHOLD,
+                 recovery_timeout=RECOVERY_TIMEOUT):
+        self.site = site
+        self.address = address
+        self.client = client
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.latency = None
+        self._state = CLOSED
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._state == OPEN and time.monotonic() - self.opened_at >= self.recovery_timeout:
+            return HALF_OPEN
+        return self._state
+
+    def record_success(self, latency=None):
+        with self._lock:
+            self.failures = 0
+            self._state = CLOSED
+            self.opened_at = None
+            if latency is not None:
+                self.latency = latency if self.latency is None else (
+                    LATENCY_SMOOTHING * latency + (1 - LATENCY_SMOOTHING) * self.latency)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._state != CLOSED or self.failures >= self.failure_threshold:
+                # A failed half-open trial opens the circuit for another period
+                self._state = OPEN
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        return dict(
+            site=self.site,
+            address="%s:%d" % self.address,
+            state=self.state,
+            failures=self.failures,
+            latency_ms=round(self.latency * 1000, 3) if self.latency is not None else None,
+        )
+
+class ConnectionManager:
+    """
+    Owns the client of every node with short timeouts, pings them in the
+    background and orders each site's replicas by health: closed circuits
+    (primary before backup), then half-open ones. Nodes with an open
+    circuit are skipped until their recovery timeout, so a dead node costs
+    nothing once it has been noticed. With `spread_reads`, healthy
+    replicas of a site take turns being first.
+    """
+
+    def __init__(self, sites, client_factory=MongoClient, spread_reads=False,
+                 ping_interval=PING_INTERVAL, failure_threshold=FAILURE_THRESHOLD,
+                 recovery_timeout=RECOVERY_TIMEOUT,
+                 server_selection_timeout_ms=SERVER_SELECTION_TIMEOUT_MS,
+                 connect_timeout_ms=CONNECT_TIMEOUT_MS, socket_timeout_ms=SOCKET_TIMEOUT_MS):
+        self.spread_reads = spread_reads
+        self.ping_interval = ping_interval
+        self.nodes = {
+            site: [
+                NodeHealth(site, (host, port), client_factory(
+                    host=host, port=port,
+                    serverSelectionTimeoutMS=server_selection_timeout_ms,
+                    connectTimeoutMS=connect_timeout_ms,
+                    socketTimeoutMS=socket_timeout_ms,
+                ), failure_threshold, recovery_timeout)
+                for host, port in addresses
+            ]
+            for site, addresses in sites.items()
+        }
+        self._turns = {site: itertools.count() for site in sites}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def replicas(self, site):
+        """Nodes of `site` in the order they should be tried."""
+        nodes = self.nodes[site]
+        closed = [node for node in nodes if node.state == CLOSED]
+        if self.spread_reads and len(closed) > 1:
+            turn = next(self._turns[site]) % len(closed)
+            closed = closed[turn:] + closed[:turn]
+        return closed + [node for node in nodes if node.state == HALF_OPEN]
+
+    @staticmethod
+    def unavailable(site):
+        return ServerSelectionTimeoutError(f"no available node for site {site}")
+
+    def all_nodes(self):
+        """Every node, primaries before backups."""
+        replicas = list(self.nodes.values())
+        return [replica[i] for i in range(max(map(len, replicas))) for replica in replicas if i < len(replica)]
+
+    def ping(self, node):
+        started = time.perf_counter()
+        try:
+            node.client.admin.command("ping")
+        except PyMongoError:
+            node.record_failure()
+            return False
+        node.record_success(time.perf_counter() - started)
+        return True
+
+    def ping_all(self):
+        for node in self.all_nodes():
+            self.ping(node)
+
+    def _ping_forever(self):
+        while not self._stop.wait(self.ping_interval):
+            self.ping_all()
+
+    def start(self):
+        """Ping every node now, then keep pinging from a daemon thread."""
+        self.ping_all()
+        self._thread = threading.Thread(target=self._ping_forever, name="mongo-health", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def stats(self):
+        return [node.stats() for node in self.all_nodes()]
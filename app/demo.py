@@ -11,12 +11,22 @@ def fetch_article(aid):
     return None
 
 def fetch_user(uid):
-    print(f"{BACKEND_URL}/api/user/{uid}")
-    response = requests.get(f"{BACKEND_URL}/api/user/{uid}")
-    print(response.json())
-    if response.status_code == 200:
-        return response.json()
-    return None
+    # The reading history is paged; follow the cursor header to the last page
+    user_data = None
+    params = {}
+    while True:
+        response = requests.get(f"{BACKEND_URL}/api/user/{uid}", params=params)
+        if response.status_code != 200:
+            return user_data
+        page = response.json()
+        if user_data is None:
+            user_data = page
+        else:
+            user_data["reading_history"].extend(page["reading_history"])
+        after = response.headers.get("X-Next-After")
+        if not after:
+            return user_data
+        params = {"after": after}
 
 def fetch_popular_rank(granularity, rid):
     response = requests.get(f"{BACKEND_URL}/api/popular_rank/{granularity}/{rid}")
@@ -25,10 +35,18 @@ def fetch_popular_rank(granularity, rid):
     return None
 
 def fetch_all_popular_rank(granularity):
-    response = requests.get(f"{BACKEND_URL}/api/popular_rank/{granularity}")
-    if response.status_code == 200:
-        return response.json()
-    return None
+    # The listing is paged; follow the cursor header to the last page
+    ranks = []
+    params = {}
+    while True:
+        response = requests.get(f"{BACKEND_URL}/api/popular_rank/{granularity}", params=params)
+        if response.status_code != 200:
+            return ranks or None
+        ranks.extend(response.json())
+        after = response.headers.get("X-Next-After")
+        if not after:
+            return ranks
+        params = {"after": after}
 
 
 def main():
@@ -0,0 +1,188 @@
+import threading
+import time
+
+from pymongo.errors import PyMongoError
+
+from instrumentation import MAPPING_SECONDS, record_lookups, span
+
+# Seconds between checks of file.mapping for a new version
+FILE_MAPPING_TTL = 300
+
+# Mapping paths point at the storage host as seen from inside the containers
+STORAGE_HOST = "0.0.0.0"
+PUBLIC_HOST = "localhost"
+
+class FileMappingCache:
+    """
+    In-process copy of file.mapping (file name -> FastDFS URL).
+    The whole collection is loaded once and re-read only when its version
+    (document count and newest _id) changes, checked at most every `ttl`
+    seconds. Names missing from the copy fall back to a Mongo query.
+    `clients` is a list, or a callable returning the clients in the order
+    to try them.
+    """
+
+    def __init__(self, clients, ttl=FILE_MAPPING_TTL):
+        self._clients = clients
+        self.ttl = ttl
+        # Values keep only the part of the URL after the shared base
+        self._base = None
+        self._paths = {}
+        self._version = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.fallback_hits = 0
+        self.reloads = 0
+
+    @property
+    def clients(self):
+        return self._clients() if callable(self._clients) else self._clients
+
+    @staticmethod
+    def _public_path(path):
+        return path.strip().replace(STORAGE_HOST, PUBLIC_HOST)
+
+    @staticmethod
+    def _version_of(client):
+        mapping = client.file.mapping
+        newest = mapping.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+        return mapping.estimated_document_count(), newest["_id"] if newest else None
+
+    def _compact(self, path):
+        if self._base and path.startswith(self._base):
+            return path[len(self._base):]
+        return path
+
+    def _expand(self, value):
+        return value if value.startswith("http") else self._base + value
+
+    def _install(self, entries, version):
+        """Replace the cached mapping with `entries` (file.mapping documents)."""
+        paths = {entry["name"]: self._public_path(entry["path"]) for entry in entries}
+        # scheme://host:port/ shared by every FastDFS URL
+        base = "/".join(next(iter(paths.values())).split("/")[:3]) + "/" if paths else None
+        with self._lock:
+            self._base = base
+            self._paths = {name: self._compact(path) for name, path in paths.items()}
+            self._version = version
+            self._checked_at = time.monotonic()
+            self.reloads += 1
+
+    def load(self):
+        """Read the whole mapping from the first reachable node."""
+        for client in self.clients:
+            try:
+                version = self._version_of(client)
+                entries = list(client.file.mapping.find({}, {"_id": 0, "name": 1, "path": 1}))
+            except PyMongoError:
+                continue
+            self._install(entries, version)
+            return True
+        return False
+
+    def _refresh_if_stale(self):
+        if time.monotonic() - self._checked_at < self.ttl:
+            return
+        self._checked_at = time.monotonic()
+        for client in self.clients:
+            try:
+                version = self._version_of(client)
+            except PyMongoError:
+                continue
+            if version != self._version:
+                self.load()
+            return
+
+    def _query(self, file_name):
+        for client in self.clients:
+            try:
+                entry = client.file.mapping.find_one(dict(name=file_name), {"_id": 0, "path": 1})
+            except PyMongoError:
+                continue
+            if entry:
+                return self._public_path(entry["path"])
+        return None
+
+    def get(self, file_name):
+        """Return the public URL of a stored file, or None if it is unknown."""
+        self._refresh_if_stale()
+        with span("mapping", MAPPING_SECONDS, source="cache") as labels:
+            value = self._paths.get(file_name)
+            if value is not None:
+                self.hits += 1
+                record_lookups("file_mapping", 1, 0)
+                return self._expand(value)
+
+            self.misses += 1
+            record_lookups("file_mapping", 0, 1)
+            labels["source"] = "mongo"
+            path = self._query(file_name)
+            if path is not None:
+                self._remember({file_name: path})
+            return path
+
+    def _query_many(self, file_names):
+        paths = {}
+        for client in self.clients:
+            remaining = [name for name in file_names if name not in paths]
+            if not remaining:
+                break
+            try:
+                entries = client.file.mapping.find(
+                    {"name": {"$in": remaining}}, {"_id": 0, "name": 1, "path": 1}
+                )
+                for entry in entries:
+                    paths[entry["name"]] = self._public_path(entry["path"])
+            except PyMongoError:
+                continue
+        return paths
+
+    def _lookup_cached(self, file_names):
+        """Split file names into cached paths and names that need a query."""
+        paths = {}
+        missing = []
+        for file_name in set(file_names):
+            value = self._paths.get(file_name)
+            if value is None:
+                missing.append(file_name)
+            else:
+                paths[file_name] = self._expand(value)
+        self.hits += len(paths)
+        self.misses += len(missing)
+        record_lookups("file_mapping", len(paths), len(missing))
+        return paths, missing
+
+    def _remember(self, found):
+        """Add paths found by fallback queries to the cache."""
+        self.fallback_hits += len(found)
+        with self._lock:
+            for file_name, path in found.items():
+                self._paths[file_name] = self._compact(path)
+
+    def get_many(self, file_names):
+        """
+        Resolve several file names at once. Names missing from the cache are
+        looked up with a single $in query. Unknown names are left out.
+        """
+        self._refresh_if_stale()
+        with span("mapping", MAPPING_SECONDS, source="cache") as labels:
+            paths, missing = self._lookup_cached(file_names)
+            if missing:
+                labels["source"] = "mongo"
+                found = self._query_many(missing)
+                self._remember(found)
+                paths.update(found)
+            return paths
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(
+            entries=len(self._paths),
+            hits=self.hits,
+            misses=self.misses,
+            fallback_hits=self.fallback_hits,
+            hit_ratio=self.hits / lookups if lookups else None,
+            reloads=self.reloads,
+        )
@@ -0,0 +1,118 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from instrumentation import FASTDFS_SECONDS, in_current_trace, span
+
+# Concurrent FastDFS text downloads per hydration
+TEXT_FETCH_WORKERS = 16
+
+# Bytes of text fetched for previews in user and rank listings
+PREVIEW_BYTES = 1024
+
+# FastDFS (connect, read) timeouts in seconds; a stalled storage node must
+# not hold a request thread forever
+FASTDFS_TIMEOUT = (1.0, 10.0)
+
+# Fields of info.article needed to hydrate an article
+ARTICLE_PROJECTION = {"_id": 0, "aid": 1, "text": 1, "image": 1, "video": 1}
+
+def media_error(upstream_status):
+    """Error message and status the media proxy returns for a failed FastDFS response."""
+    if upstream_status == 404:
+        return "File not found", 404
+    if upstream_status == 416:
+        return "Requested range not satisfiable", 416
+    # Other failures are the storage's, not the client's
+    return "Storage unavailable", 502
+
+def split_file_names(field):
+    return [name.strip() for name in (field or "").split(',') if name.strip()]
+
+class ArticleHydrator:
+    """
+    Turns aids into article payloads (text, image and video URLs) in batches:
+    one $in query per site holding the articles, one file mapping lookup for every file
+    name, and concurrent text downloads over a shared keep-alive session.
+    """
+
+    def __init__(self, router, file_mapping, workers=TEXT_FETCH_WORKERS):
+        self.router = router
+        self.file_mapping = file_mapping
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def find_articles(self, aids):
+        return self.router.find_articles(aids, ARTICLE_PROJECTION)
+
+    def fetch_text(self, location, preview_bytes=None):
+        """
+        Download a text file, or only its first `preview_bytes` bytes with
+        a Range request. None when the download fails.
+        """
+        if not preview_bytes:
+            with span("fastdfs", FASTDFS_SECONDS, kind="text") as labels:
+                try:
+                    response = self.session.get(location, timeout=FASTDFS_TIMEOUT)
+                    response.raise_for_status()
+                    return response.text
+                except requests.RequestException:
+                    labels["outcome"] = "error"
+                    return None
+
+        with span("fastdfs", FASTDFS_SECONDS, kind="preview") as labels:
+            try:
+                with self.session.get(location, headers={"Range": f"bytes=0-{preview_bytes - 1}", "Accept-Encoding": "identity"},
+                                      stream=True, timeout=FASTDFS_TIMEOUT) as response:
+                    response.raise_for_status()
+                    # A server ignoring Range sends the whole file; stop reading early
+                    data = b""
+                    for chunk in response.iter_content(preview_bytes):
+                        data += chunk
+                        if len(data) >= preview_bytes:
+                            break
+                    encoding = response.encoding or "utf-8"
+            except requests.RequestException:
+                labels["outcome"] = "error"
+                return None
+        # The cut may split a multi-byte character
+        return data[:preview_bytes].decode(encoding, errors="ignore")
+
+    def hydrate(self, aids, preview_bytes=None):
+        """
+        Return {aid: dict(text, images, videos)} for the given aids.
+        Repeated aids are fetched once; unknown aids are left out, and text
+        is None when the download fails. With `preview_bytes`, text holds
+        only the start of each file.
+        """
+        unique_aids = list(dict.fromkeys(aids))
+        articles = self.find_articles(unique_aids)
+
+        file_names = []
+        for article in articles.values():
+            file_names.append(article["text"])
+            file_names.extend(split_file_names(article.get("image")))
+            file_names.extend(split_file_names(article.get("video")))
+        paths = self.file_mapping.get_many(file_names)
+
+        texts = dict(zip(
+            articles,
+            self.executor.map(
+                in_current_trace(lambda article: (self.fetch_text(paths[article["text"]], preview_bytes)
+                                                  if article["text"] in paths else None)),
+                articles.values()
+            )
+        ))
+
+        return {
+            aid: dict(
+                text=texts[aid],
+                images=[paths[name] for name in split_file_names(article.get("image")) if name in paths],
+                videos=[paths[name] for name in split_file_names(article.get("video")) if name in paths],
+            )
+            for aid, article in articles.items()
+        }
@@ -0,0 +1,200 @@
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger("ddbs.trace")
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Requests slower than this are logged with their spans
+SLOW_REQUEST_SECONDS = 1.0
+
+METRICS_MIMETYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _label_text(label_names, values):
+    if not label_names:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, str(value).replace('"', '\\"'))
+                          for name, value in zip(label_names, values)) + "}"
+
+class Counter:
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(self.label_names, key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts, sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        names = self.label_names + ("le",)
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{_label_text(names, key + (bound,))} {cumulative}")
+                lines.append(f"{self.name}_bucket{_label_text(names, key + ('+Inf',))} {count}")
+                lines.append(f"{self.name}_sum{_label_text(self.label_names, key)} {total}")
+                lines.append(f"{self.name}_count{_label_text(self.label_names, key)} {count}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, *args, **kwargs):
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format."""
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram(
+    "ddbs_request_seconds", "API request latency", ("route", "status"))
+MONGO_SECONDS = registry.histogram(
+    "ddbs_mongo_seconds", "MongoDB operation latency per node", ("operation", "node", "outcome"))
+FASTDFS_SECONDS = registry.histogram(
+    "ddbs_fastdfs_seconds", "FastDFS download latency (time to headers for media)", ("kind", "outcome"))
+MAPPING_SECONDS = registry.histogram(
+    "ddbs_mapping_seconds", "File mapping lookup latency", ("source",))
+FAILOVERS = registry.counter(
+    "ddbs_mongo_failovers_total", "Operations passed on to the next replica after a node failed", ("site", "node"))
+CACHE_LOOKUPS = registry.counter(
+    "ddbs_cache_lookups_total", "Lookups of the in-process caches", ("cache", "result"))
+
+class Trace:
+    """Spans recorded while serving one request."""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def add(self, kind, seconds, labels):
+        # list.append is atomic, so worker threads and tasks can share the trace
+        self.spans.append((kind, seconds, labels))
+
+    def totals(self):
+        """{kind: (calls, seconds)}; concurrent spans add up beyond wall time."""
+        totals = {}
+        for kind, seconds, _ in self.spans:
+            calls, total = totals.get(kind, (0, 0.0))
+            totals[kind] = (calls + 1, total + seconds)
+        return totals
+
+    def server_timing(self, elapsed):
+        entries = ['%s;dur=%.1f;desc="%d calls"' % (kind, seconds * 1000, calls)
+                   for kind, (calls, seconds) in sorted(self.totals().items())]
+        entries.append("total;dur=%.1f" % (elapsed * 1000))
+        return ", ".join(entries)
+
+    def describe(self):
+        return " ".join(
+            "%s[%s]=%.1fms" % (kind, ",".join(f"{name}={value}" for name, value in labels.items()), seconds * 1000)
+            for kind, seconds, labels in self.spans
+        )
+
+_current = contextvars.ContextVar("ddbs_trace", default=None)
+
+def start_trace(name):
+    """Start the trace of a request; returns the token for finish_trace."""
+    return _current.set(Trace(name))
+
+def finish_trace(token, route, status):
+    """
+    Record the request latency, log slow requests with their spans and
+    return the Server-Timing header value.
+    """
+    trace = _current.get()
+    _current.reset(token)
+    elapsed = time.perf_counter() - trace.started
+    REQUEST_SECONDS.observe(elapsed, route=route, status=status)
+    if elapsed >= SLOW_REQUEST_SECONDS:
+        logger.warning("slow request %s %s %.1fms: %s", trace.name, status, elapsed * 1000, trace.describe())
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug("request %s %s %.1fms: %s", trace.name, status, elapsed * 1000, trace.describe())
+    return trace.server_timing(elapsed)
+
+def in_current_trace(function):
+    """Wrap `function` so spans it records in worker threads join the caller's trace."""
+    trace = _current.get()
+
+    def run(*args, **kwargs):
+        token = _current.set(trace)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return run
+
+@contextmanager
+def span(name, histogram, **labels):
+    """
+    Time the block into `histogram` and the current trace. The labels dict
+    is yielded so the block can fill in labels known only at the end;
+    `outcome` defaults to "ok", or "error" when the block raises.
+    """
+    started = time.perf_counter()
+    try:
+        yield labels
+    except BaseException:
+        labels["outcome"] = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        labels.setdefault("outcome", "ok")
+        histogram.observe(elapsed, **labels)
+        trace = _current.get()
+        if trace is not None:
+            trace.add(name, elapsed, labels)
+
+def record_lookups(cache, hits, misses):
+    if hits:
+        CACHE_LOOKUPS.inc(hits, cache=cache, result="hit")
+    if misses:
+        CACHE_LOOKUPS.inc(misses, cache=cache, result="miss")
@@ -0,0 +1,90 @@
+import json
+from datetime import datetime
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+# Items per page when the request gives no limit, and the largest allowed limit
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Items fetched per query while streaming NDJSON
+STREAM_BATCH_SIZE = 500
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# Header carrying the cursor of the next page
+NEXT_PAGE_HEADER = "X-Next-After"
+
+# Reading history fields a client may ask for; text is hydrated from FastDFS
+READ_FIELDS = ("aid", "timestamp", "readTimeLength", "agreeOrNot", "commentOrNot",
+               "shareOrNot", "commentDetail", "text")
+DEFAULT_READ_FIELDS = ("text", "timestamp", "aid")
+
+RANK_LIST_FIELDS = ("timestamp", "date", "rid")
+
+class PageRequest:
+    """
+    limit / after / fields / format parameters of a listing request.
+    `after` is the cursor returned with the previous page: a read _id for
+    reading history, a rank id for rank listings.
+    """
+
+    def __init__(self, args, allowed_fields, default_fields, parse_after):
+        limit = args.get("limit")
+        try:
+            self.limit = DEFAULT_PAGE_SIZE if limit is None else int(limit)
+        except ValueError:
+            raise ValueError(f"limit must be an integer, got {limit!r}")
+        if not 0 < self.limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+
+        after = args.get("after")
+        self.after = parse_after(after) if after else None
+
+        fields = args.get("fields")
+        self.fields = tuple(name for name in fields.split(",") if name) if fields else default_fields
+        unknown = set(self.fields) - set(allowed_fields)
+        if unknown:
+            raise ValueError(f"unknown fields: {', '.join(sorted(unknown))}")
+
+        self.stream = args.get("format") == "ndjson"
+
+def parse_read_cursor(after):
+    try:
+        return ObjectId(after)
+    except InvalidId:
+        raise ValueError(f"invalid cursor: {after!r}")
+
+def parse_rank_cursor(after):
+    try:
+        return int(after)
+    except ValueError:
+        raise ValueError(f"invalid cursor: {after!r}")
+
+def read_projection(fields):
+    """Mongo projection of history.read for the requested fields."""
+    projection = {"_id": 1, "aid": 1}
+    projection.update((name, 1) for name in fields if name != "text")
+    return projection
+
+# Fields of history.popular_rank needed for rank listings
+RANK_LIST_PROJECTION = {"_id": 0, "id": 1, "timestamp": 1}
+
+def format_read(read, texts, fields):
+    entry = {}
+    for name in fields:
+        entry[name] = texts.get(read["aid"], "") if name == "text" else read.get(name)
+    return entry
+
+def format_rank_entry(rank, fields):
+    timestamp = int(rank["timestamp"]) / 1000
+    entry = {
+        "timestamp": timestamp,
+        "date": datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d'),
+        "rid": rank["id"]
+    }
+    return {name: entry[name] for name in fields}
+
+def ndjson_line(obj):
+    return json.dumps(obj, ensure_ascii=False, default=str) + "\n"
@@ -0,0 +1,98 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from instrumentation import record_lookups
+
+# Serialized bytes of responses the cache may hold
+RESPONSE_CACHE_BYTES = 64 << 20
+
+# Seconds between checks of the rank version written by generate_popular_rank
+RANK_VERSION_TTL = 10
+
+class ResponseCache:
+    """
+    LRU cache of finished JSON responses, bounded by their serialized size.
+    Keys are tuples whose first element names the kind of response
+    ("article", "rank"), so one kind can be dropped at once. Rank responses
+    are dropped whenever the rank version changes.
+    """
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_BYTES, version_ttl=RANK_VERSION_TTL):
+        self.max_bytes = max_bytes
+        self.version_ttl = version_ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._version = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses[key[0]] = self.misses.get(key[0], 0) + 1
+                record_lookups(f"response_{key[0]}", 0, 1)
+                return None
+            self._entries.move_to_end(key)
+            self.hits[key[0]] = self.hits.get(key[0], 0) + 1
+            record_lookups(f"response_{key[0]}", 1, 0)
+            return entry[0]
+
+    def put(self, key, value):
+        size = len(json.dumps(value, default=str))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+
+    def invalidate(self, kind):
+        """Drop every entry of one kind."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == kind]:
+                self._bytes -= self._entries.pop(key)[1]
+            self.invalidations += 1
+
+    def version_due(self):
+        return time.monotonic() - self._checked_at >= self.version_ttl
+
+    def set_version(self, version):
+        """
+        Record the current rank version; a change drops cached rank
+        responses. None (version unreadable) keeps the cache as it is.
+        """
+        self._checked_at = time.monotonic()
+        if version is not None and version != self._version:
+            if self._version is not None:
+                self.invalidate("rank")
+            self._version = version
+
+    def stats(self):
+        kinds = sorted(set(self.hits) | set(self.misses))
+        ratios = {}
+        for kind in kinds:
+            lookups = self.hits.get(kind, 0) + self.misses.get(kind, 0)
+            ratios[kind] = self.hits.get(kind, 0) / lookups if lookups else None
+        return dict(
+            entries=len(self._entries),
+            bytes=self._bytes,
+            max_bytes=self.max_bytes,
+            hits=dict(self.hits),
+            misses=dict(self.misses),
+            hit_ratio=ratios,
+            evictions=self.evictions,
+            invalidations=self.invalidations,
+        )
@@ -0,0 +1,232 @@
+from pymongo.errors import PyMongoError
+
+from connection import ConnectionManager
+from instrumentation import FAILOVERS, MONGO_SECONDS, span
+
+# Primary and backup node of each site
+SITES = dict(
+    db1=[("localhost", 27001), ("localhost", 27003)],
+    db2=[("localhost", 27002), ("localhost", 27004)],
+)
+
+# Placement rules of bulk_load.DataDistributor and generate_popular_rank
+REGION_SITES = {"Beijing": "db1", "Hong Kong": "db2"}
+CATEGORY_SITES = {"science": ["db1", "db2"], "technology": ["db2"]}
+RANK_SITES = {"daily": "db1", "weekly": "db2", "monthly": "db2"}
+
+# Document of history.popular_rank_version bumped by generate_popular_rank
+RANK_VERSION_ID = "popular_rank"
+
+# db2 holds every article, so it serves aids missing from the directory
+DEFAULT_ARTICLE_SITE = "db2"
+
+class ShardDirectory:
+    """
+    uid -> region and aid -> category maps used to pick the single site
+    holding a user, its reads or an article.
+    """
+
+    def __init__(self):
+        self.user_regions = {}
+        self.article_categories = {}
+
+    def add_users(self, users):
+        for user in users:
+            self.user_regions[user["uid"]] = user["region"]
+
+    def add_articles(self, articles):
+        for article in articles:
+            self.article_categories[article["aid"]] = article["category"]
+
+    def user_site(self, uid):
+        """Site of a user and its reads, or None if the uid is unknown."""
+        return REGION_SITES.get(self.user_regions.get(uid))
+
+    def article_site(self, aid):
+        sites = CATEGORY_SITES.get(self.article_categories.get(aid))
+        return sites[0] if sites else DEFAULT_ARTICLE_SITE
+
+    def group_articles(self, aids):
+        """Split aids into {site: [aid, ...]}, one batch per site."""
+        groups = {}
+        for aid in aids:
+            groups.setdefault(self.article_site(aid), []).append(aid)
+        return groups
+
+    @staticmethod
+    def rank_site(granularity):
+        return RANK_SITES.get(granularity, "db2")
+
+class QueryRouter:
+    """
+    Sends each query to the one site that holds the data, on the healthiest
+    of its replicas (see ConnectionManager); the next replica is tried only
+    when that one fails. A None result from a reachable node is final.
+    """
+
+    def __init__(self, connections=None):
+        self.connections = connections or ConnectionManager(SITES)
+        self.directory = ShardDirectory()
+
+    @property
+    def sites(self):
+        return list(self.connections.nodes)
+
+    def all_nodes(self):
+        """Every client, primaries before backups."""
+        return [node.client for node in self.connections.all_nodes()]
+
+    def ordered_clients(self):
+        """Every client, healthiest first."""
+        return [node.client for site in self.sites for node in self.connections.replicas(site)]
+
+    def run(self, site, operation, name="query"):
+        """
+        Run operation(client) on the healthiest replica of `site`, failing
+        over to the others. Each attempt is a span named `name`, tagged with the node.
+        """
+        error = None
+        for node in self.connections.replicas(site):
+            address = "%s:%d" % node.address
+            try:
+                with span("mongo", MONGO_SECONDS, operation=name, node=address):
+                    result = operation(node.client)
+            except PyMongoError as e:
+                node.record_failure()
+                FAILOVERS.inc(site=site, node=address)
+                error = e
+                continue
+            node.record_success()
+            return result
+        raise error or self.connections.unavailable(site)
+
+    def load_directory(self):
+        """Read the uid and aid placement from every site."""
+        for site in self.sites:
+            try:
+                self.directory.add_users(self.run(site, lambda client: list(
+                    client.info.user.find({}, {"_id": 0, "uid": 1, "region": 1})), "info.user.find"))
+            except PyMongoError:
+                continue
+        try:
+            self.directory.add_articles(self.run(DEFAULT_ARTICLE_SITE, lambda client: list(
+                client.info.article.find({}, {"_id": 0, "aid": 1, "category": 1})), "info.article.find"))
+        except PyMongoError:
+            pass
+
+    def user_sites(self, uid):
+        """The site of a known uid; every site for an unknown one."""
+        site = self.directory.user_site(uid)
+        return [site] if site else self.sites
+
+    def find_user(self, uid):
+        for site in self.user_sites(uid):
+            try:
+                user = self.run(site, lambda client: client.info.user.find_one(dict(uid=uid)), "info.user.find_one")
+            except PyMongoError:
+                continue
+            if user:
+                self.directory.add_users([user])
+                return user
+        return None
+
+    def page(self, site, namespace, query, key, after=None, limit=None, projection=None):
+        """
+        One page of `namespace` (database, collection) on `site`, ordered by
+        `key` and starting after the cursor value `after`.
+        """
+        database, collection = namespace
+        if after is not None:
+            query = dict(query, **{key: {"$gt": after}})
+        if projection is not None:
+            projection = dict(projection, **{key: 1})
+
+        def operation(client):
+            cursor = client[database][collection].find(query, projection).sort(key, 1)
+            if limit:
+                cursor = cursor.limit(limit)
+            return list(cursor)
+
+        return self.run(site, operation, f"{database}.{collection}.find")
+
+    def pages(self, site, namespace, query, key, after=None, projection=None, batch_size=None):
+        """
+        Yield consecutive pages until the collection is exhausted. Each page
+        is its own query, so at most one page is held at a time and a failed
+        node is left mid-stream without losing the position.
+        """
+        while True:
+            page = self.page(site, namespace, query, key, after, batch_size, projection)
+            if page:
+                yield page
+            if not batch_size or len(page) < batch_size:
+                return
+            after = page[-1][key]
+
+    def read_site(self, uid):
+        """Site holding the reads of `uid`, probing every site for an unknown uid."""
+        site = self.directory.user_site(uid)
+        if site:
+            return site
+        for site in self.sites:
+            try:
+                if self.page(site, ("history", "read"), dict(uid=uid), "_id", limit=1, projection={"_id": 1}):
+                    return site
+            except PyMongoError:
+                continue
+        return None
+
+    def find_reads(self, uid, after=None, limit=None, projection=None):
+        """Reads of a user in _id order; they live on the same site as the user."""
+        site = self.read_site(uid)
+        if site is None:
+            return []
+        return self.page(site, ("history", "read"), dict(uid=uid), "_id", after, limit, projection)
+
+    def iter_reads(self, uid, after=None, projection=None, batch_size=None):
+        site = self.read_site(uid)
+        if site is None:
+            return iter(())
+        return self.pages(site, ("history", "read"), dict(uid=uid), "_id", after, projection, batch_size)
+
+    def find_articles(self, aids, projection):
+        """Fetch articles with one $in query per site."""
+        articles = {}
+        for site, batch in self.directory.group_articles(aids).items():
+            try:
+                found = self.run(site, lambda client: list(
+                    client.info.article.find({"aid": {"$in": batch}}, projection)), "info.article.find")
+            except PyMongoError:
+                continue
+            for article in found:
+                articles[article["aid"]] = article
+        return articles
+
+    def find_rank(self, granularity, rid):
+        return self.run(self.directory.rank_site(granularity), lambda client: client.history.popular_rank.find_one(
+            dict(temporalGranularity=granularity, id=rid)), "history.popular_rank.find_one")
+
+    def find_ranks(self, granularity, after=None, limit=None, projection=None):
+        """Ranks of a granularity in id order."""
+        return self.page(self.directory.rank_site(granularity), ("history", "popular_rank"),
+                         dict(temporalGranularity=granularity), "id", after, limit, projection)
+
+    def iter_ranks(self, granularity, after=None, projection=None, batch_size=None):
+        return self.pages(self.directory.rank_site(granularity), ("history", "popular_rank"),
+                          dict(temporalGranularity=granularity), "id", after, projection, batch_size)
+
+    def latest_rank(self, granularity):
+        return self.run(self.directory.rank_site(granularity), lambda client: client.history.popular_rank.find_one(
+            dict(temporalGranularity=granularity), sort=[("timestamp", -1)]), "history.popular_rank.find_one")
+
+    def rank_version(self):
+        """Rank version of every rank site, or None if one cannot be read."""
+        versions = []
+        for site in sorted(set(RANK_SITES.values())):
+            try:
+                version = self.run(site, lambda client: client.history.popular_rank_version.find_one(
+                    {"_id": RANK_VERSION_ID}), "history.popular_rank_version.find_one")
+            except PyMongoError:
+                return None
+            versions.append(version["version"] if version else 0)
+        return tuple(versions)
@@ -0,0 +1,418 @@
+"""
+End-to-end benchmark of the data pipeline and the API.
+
+Generates synthetic data (synthetic_data.py), loads it with bulk_load's
+native importer, builds beread and the popular ranks, then replays a mixed
+traffic profile against the API with stub_fastdfs.py standing in for
+FastDFS. Stage timings and per-endpoint throughput and p50/p99 latency are
+printed as JSON, and written to --output for regression tracking.
+
+The four targets are throwaway mongods. With --mongod they are started
+here on fresh data directories; otherwise --targets must point at running
+ones, and a target already holding users is only reused with --drop.
+
+    python3 benchmarks/bench_end_to_end.py --mongod $(which mongod) --reads 200000 --requests 5000
+    python3 benchmarks/bench_end_to_end.py --targets ... --stages api --server async --concurrency 32
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+import requests
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "data_load"))
+sys.path.insert(0, str(ROOT / "app"))
+
+import bulk_load
+import generate_beread
+import generate_popular_rank
+import stub_fastdfs
+import synthetic_data
+from connection import ConnectionManager
+
+STAGES = ("data", "load", "beread", "rank", "api")
+
+# Primaries first, then backups, like the compose deployment on 27001-27004
+DEFAULT_TARGETS = "127.0.0.1:27101=db1,127.0.0.1:27102=db2,127.0.0.1:27103=db1,127.0.0.1:27104=db2"
+
+DEFAULT_TRAFFIC = "article=50,user=30,rank=15,rank_list=5"
+
+def parse_traffic(spec):
+    weights = {}
+    for item in spec.split(","):
+        endpoint, weight = item.split("=")
+        if endpoint not in ("article", "user", "rank", "rank_list"):
+            raise ValueError(f"unknown endpoint {endpoint}")
+        weights[endpoint] = float(weight)
+    return weights
+
+def site_addresses(targets):
+    """{site: [(host, port), ...]} in target order, so primaries come first."""
+    sites = {}
+    for host, port, db_key in targets.values():
+        sites.setdefault(db_key, []).append((host, port))
+    return sites
+
+def client_pairs(sites):
+    """(db1, db2) client pairs: the primaries, then the backups."""
+    return [
+        (MongoClient(host=db1[0], port=db1[1]), MongoClient(host=db2[0], port=db2[1]))
+        for db1, db2 in zip(sites["db1"], sites["db2"])
+    ]
+
+def wait_for_mongod(host, port, timeout=30.0):
+    client = MongoClient(host=host, port=port, serverSelectionTimeoutMS=500)
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            try:
+                client.admin.command("ping")
+                return
+            except PyMongoError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.2)
+    finally:
+        client.close()
+
+@contextmanager
+def mongod_stand_ins(mongod, targets, directory):
+    """Start one mongod per target on an empty data directory, stopped on exit."""
+    processes = []
+    try:
+        for host, port, _ in targets.values():
+            dbpath = Path(directory) / f"mongod-{port}"
+            dbpath.mkdir(parents=True, exist_ok=True)
+            processes.append(subprocess.Popen([
+                mongod, "--dbpath", str(dbpath), "--port", str(port), "--bind_ip", host,
+                "--logpath", str(dbpath / "mongod.log"),
+            ]))
+        for host, port, _ in targets.values():
+            wait_for_mongod(host, port)
+        yield
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+@contextmanager
+def working_directory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+def timed(stages, name, function, *args, **kwargs):
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    stages[name] = {"seconds": round(time.perf_counter() - started, 3)}
+    return result
+
+def prepare_targets(targets, drop):
+    for address, (host, port, _) in targets.items():
+        client = MongoClient(host=host, port=port)
+        try:
+            if client.info.user.estimated_document_count() and not drop:
+                raise SystemExit(f"{address} already holds data; pass --drop to overwrite it")
+            for database in ("info", "history", "file"):
+                client.drop_database(database)
+        finally:
+            client.close()
+
+def run_load(args, targets, workdir, stages):
+    """bulk_load's mapping refresh, split and native import, timed per stage."""
+    load_args = argparse.Namespace(
+        write_buffer_size=bulk_load.DEFAULT_WRITE_BUFFER_SIZE, compression=None,
+        user_index=bulk_load.DEFAULT_USER_INDEX_PATH, reuse_user_index=False,
+        split_workers=args.split_workers, targets=args.targets,
+        import_batch_size=args.import_batch_size, import_workers=args.import_workers,
+    )
+    with working_directory(workdir):
+        for path in bulk_load.OUTPUT_PATHS.values():
+            Path(path).mkdir(exist_ok=True)
+        checkpoint = bulk_load.PipelineCheckpoint(bulk_load.DEFAULT_CHECKPOINT_PATH)
+        timed(stages, "file_mapping", bulk_load.refresh_file_mapping)
+        timed(stages, "distribute", bulk_load.distribute, load_args, checkpoint)
+        timed(stages, "import", bulk_load.import_native, load_args, checkpoint)
+
+    reads = sum(1 for _ in open(Path(workdir) / "db-generation" / "read.dat"))
+    stages["import"]["reads_per_sec"] = round(reads / stages["import"]["seconds"]) if reads else 0
+
+def run_beread(pairs, stages):
+    def build():
+        generate_beread.create_indexes(pairs)
+        for db1_client, db2_client in pairs:
+            generate_beread.generate_bulk(db1_client, db2_client)
+    timed(stages, "beread", build)
+
+def run_rank(pairs, fetch_host, stages):
+    def full():
+        for db1_client, db2_client in pairs:
+            generate_popular_rank.generate_full(db1_client, db2_client)
+
+    def incremental():
+        return sum(len(generate_popular_rank.generate_incremental(db1_client, db2_client, rebuild_counters=True))
+                   for db1_client, db2_client in pairs)
+
+    def materialize():
+        return sum(generate_popular_rank.materialize_ranks(db1_client, db2_client, fetch_host=fetch_host)
+                   for db1_client, db2_client in pairs)
+
+    timed(stages, "rank_full", full)
+    buckets = timed(stages, "rank_incremental_rebuild", incremental)
+    stages["rank_incremental_rebuild"]["buckets"] = buckets
+    ranks = timed(stages, "rank_materialize", materialize)
+    stages["rank_materialize"]["ranks"] = ranks
+
+def start_sync_server(sites, host, port):
+    """Serve api.app with werkzeug from a daemon thread, routed to the benchmark targets."""
+    from werkzeug.serving import make_server
+    import api
+
+    api.router.connections = ConnectionManager(sites)
+    api.router.connections.start()
+    api.router.load_directory()
+    api.file_mapping.load()
+    api.warm_response_cache()
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server(host, port, api.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="bench-api", daemon=True).start()
+
+    def stop():
+        server.shutdown()
+        api.router.connections.stop()
+    return stop
+
+def start_async_server(sites, host, port):
+    """Serve async_api on its own event loop thread, routed to the benchmark targets."""
+    from aiohttp import web
+    from motor.motor_asyncio import AsyncIOMotorClient
+    import async_api
+
+    async_api.backend.connections = ConnectionManager(sites, client_factory=AsyncIOMotorClient)
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(async_api.create_app(), access_log=None)
+    ready = threading.Event()
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, host, port).start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, name="bench-api", daemon=True).start()
+    ready.wait()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+    return stop
+
+def sample_keys(pairs):
+    """uids, aids (most read first) and (granularity, rank id) pairs to request."""
+    db1_client, db2_client = pairs[0]
+    uids = [user["uid"] for client in (db1_client, db2_client)
+            for user in client.info.user.find({}, {"_id": 0, "uid": 1})]
+    read_counts = {beread["aid"]: beread.get("readNum", 0)
+                   for beread in db2_client.history.beread.find({}, {"_id": 0, "aid": 1, "readNum": 1})}
+    aids = sorted((article["aid"] for article in db2_client.info.article.find({}, {"_id": 0, "aid": 1})),
+                  key=lambda aid: -read_counts.get(aid, 0))
+    ranks = [(rank["temporalGranularity"], rank["id"]) for client in (db1_client, db2_client)
+             for rank in client.history.popular_rank.find({}, {"_id": 0, "temporalGranularity": 1, "id": 1})]
+    return uids, aids, ranks
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def summarize(latencies, errors, seconds):
+    values = sorted(latencies)
+    return {
+        "requests": len(values),
+        "errors": errors,
+        "throughput": round(len(values) / seconds, 1) if seconds else None,
+        "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else None,
+        "p50_ms": round(percentile(values, 0.50) * 1000, 3) if values else None,
+        "p99_ms": round(percentile(values, 0.99) * 1000, 3) if values else None,
+    }
+
+def replay_traffic(base_url, keys, traffic, requests_total, warmup, concurrency, zipf_exponent, seed):
+    """
+    Send `requests_total` requests drawn from the traffic mix from
+    `concurrency` threads; article ids follow the read popularity.
+    """
+    uids, aids, ranks = keys
+    # Endpoints without anything to ask for (e.g. the rank stage was skipped) are left out
+    available = dict(article=aids, user=uids, rank=ranks, rank_list=ranks)
+    traffic = {endpoint: weight for endpoint, weight in traffic.items() if available[endpoint]}
+    aid_weights = synthetic_data.zipf_cum_weights(len(aids), zipf_exponent) if aids else None
+    endpoints, weights = zip(*traffic.items())
+    counter = itertools.count()
+    results = {endpoint: ([], [0]) for endpoint in endpoints}
+    lock = threading.Lock()
+
+    def url_for(endpoint, rng):
+        if endpoint == "article":
+            return f"/api/article/{rng.choices(aids, cum_weights=aid_weights)[0]}"
+        if endpoint == "user":
+            return f"/api/user/{rng.choice(uids)}"
+        if endpoint == "rank":
+            granularity, rid = rng.choice(ranks)
+            return f"/api/popular_rank/{granularity}/{rid}"
+        return f"/api/popular_rank/{rng.choice(['daily', 'weekly', 'monthly'])}"
+
+    def worker(index):
+        rng = random.Random(seed + index)
+        session = requests.Session()
+        while True:
+            sequence = next(counter)
+            if sequence >= warmup + requests_total:
+                return
+            endpoint = rng.choices(endpoints, weights)[0]
+            url = base_url + url_for(endpoint, rng)
+            started = time.perf_counter()
+            try:
+                ok = session.get(url).status_code < 500
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - started
+            if sequence < warmup:
+                continue
+            with lock:
+                latencies, errors = results[endpoint]
+                latencies.append(elapsed)
+                errors[0] += not ok
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+
+    report = {endpoint: summarize(latencies, errors[0], seconds) for endpoint, (latencies, errors) in results.items()}
+    report["overall"] = summarize(
+        [latency for latencies, _ in results.values() for latency in latencies],
+        sum(errors[0] for _, errors in results.values()), seconds
+    )
+    return report
+
+def run_api(args, sites, pairs, stages):
+    if args.server == "async":
+        stop = start_async_server(sites, "127.0.0.1", args.api_port)
+    else:
+        stop = start_sync_server(sites, "127.0.0.1", args.api_port)
+    try:
+        keys = sample_keys(pairs)
+        report = timed(stages, "api", replay_traffic, f"http://127.0.0.1:{args.api_port}", keys,
+                       parse_traffic(args.traffic), args.requests, args.warmup, args.concurrency,
+                       args.zipf, args.seed)
+    finally:
+        stop()
+    return report
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the load pipeline and the API end to end")
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help=f"comma separated stages to run, out of {','.join(STAGES)}")
+    parser.add_argument("--workdir", help="directory for generated and split files (default: a temporary one)")
+    parser.add_argument("--targets", default=DEFAULT_TARGETS,
+                        help="mongods as host:port=db1,host:port=db2,...; primaries before backups")
+    parser.add_argument("--mongod", help="mongod binary; start the targets here on fresh data directories")
+    parser.add_argument("--drop", action="store_true", help="overwrite targets that already hold data")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--articles", type=int, default=2000)
+    parser.add_argument("--reads", type=int, default=100000)
+    parser.add_argument("--days", type=int, default=120)
+    parser.add_argument("--zipf", type=float, default=1.1, help="exponent of the article popularity law")
+    parser.add_argument("--split-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--import-batch-size", type=int, default=bulk_load.DEFAULT_IMPORT_BATCH_SIZE)
+    parser.add_argument("--import-workers", type=int, default=bulk_load.DEFAULT_IMPORT_WORKERS)
+    parser.add_argument("--storage-port", type=int, default=9099, help="port of the FastDFS stand-in")
+    parser.add_argument("--storage-latency", type=float, default=0.0,
+                        help="milliseconds the FastDFS stand-in waits before each response")
+    parser.add_argument("--server", choices=["sync", "async"], default="sync",
+                        help="api.py (Flask) or async_api.py (aiohttp)")
+    parser.add_argument("--api-port", type=int, default=8170)
+    parser.add_argument("--traffic", default=DEFAULT_TRAFFIC, help="endpoint=weight,... of the replayed traffic")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--warmup", type=int, default=200, help="requests sent before measuring")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    stages_to_run = set(args.stages.split(","))
+    unknown = stages_to_run - set(STAGES)
+    if unknown:
+        raise SystemExit(f"unknown stages: {', '.join(sorted(unknown))}")
+    targets = bulk_load.parse_targets(args.targets)
+    sites = site_addresses(targets)
+
+    stages = {}
+    report = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "params": {name: getattr(args, name) for name in (
+            "users", "articles", "reads", "days", "zipf", "split_workers", "import_batch_size",
+            "import_workers", "storage_latency", "server", "traffic", "requests", "concurrency")},
+        "stages": stages,
+    }
+
+    with tempfile.TemporaryDirectory() as scratch:
+        workdir = Path(args.workdir or scratch)
+        workdir.mkdir(parents=True, exist_ok=True)
+        with ExitStack() as stack:
+            if args.mongod:
+                stack.enter_context(mongod_stand_ins(args.mongod, targets, workdir / "mongod"))
+            storage = stub_fastdfs.start_stub(port=args.storage_port, latency_ms=args.storage_latency)
+            stack.callback(storage.shutdown)
+
+            if "data" in stages_to_run:
+                counts = timed(stages, "data", synthetic_data.generate, workdir, args.users, args.articles,
+                               args.reads, args.days, args.zipf,
+                               storage_url=f"http://0.0.0.0:{args.storage_port}", seed=args.seed)
+                stages["data"].update(counts)
+            if "load" in stages_to_run:
+                prepare_targets(targets, args.drop or bool(args.mongod))
+                run_load(args, targets, workdir, stages)
+
+            pairs = client_pairs(sites)
+            if "beread" in stages_to_run:
+                run_beread(pairs, stages)
+            if "rank" in stages_to_run:
+                run_rank(pairs, "127.0.0.1", stages)
+            if "api" in stages_to_run:
+                report["api"] = run_api(args, sites, pairs, stages)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as out_file:
+            out_file.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
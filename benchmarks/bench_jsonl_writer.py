@@ -0,0 +1,133 @@
+"""
+Micro-benchmark of JSONL output.
+
+Writes the same read-like records with the previous flush-per-record
+pattern and with JsonlWriter at several buffer sizes and compressions,
+then reports lines per second. Serialized objects (JsonlHandler.dump)
+and pass-through lines (DataDistributor) are measured separately, since
+json.dumps dominates the former. Each compression is first checked to
+read back through the native importer after its part files are merged.
+
+    python3 benchmarks/bench_jsonl_writer.py --lines 1000000
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "data_load"))
+
+from bulk_load import COMPRESSION_SUFFIXES, JsonlWriter, NativeMongoImporter
+
+def make_records(lines):
+    return [
+        {
+            "timestamp": str(1506000000000 + i),
+            "id": f"r{i}",
+            "uid": str(i % 10000),
+            "aid": str(i % 1000),
+            "readTimeLength": "42",
+            "agreeOrNot": "0",
+            "commentOrNot": "1",
+            "shareOrNot": "0",
+            "commentDetail": "comments to this article: (%d)" % i,
+        }
+        for i in range(lines)
+    ]
+
+def write_flush_per_record(records, file_name):
+    """The JsonlHandler.dump behaviour before buffered writes."""
+    with open(file_name, 'w', encoding='utf-8') as out_file:
+        for obj in records:
+            out_file.write(json.dumps(obj, ensure_ascii=False) + "\n")
+            out_file.flush()
+
+def write_buffered(records, file_name, buffer_size, compression):
+    with JsonlWriter(file_name, buffer_size, compression) as writer:
+        for obj in records:
+            writer.write(obj)
+
+def write_lines_flush_per_record(lines, file_name):
+    """The DataDistributor behaviour before buffered writes, plus a flush per line."""
+    with open(file_name, 'w') as out_file:
+        for line in lines:
+            out_file.write(line + "\n")
+            out_file.flush()
+
+def write_lines_buffered(lines, file_name, buffer_size):
+    with JsonlWriter(file_name, buffer_size) as writer:
+        for line in lines:
+            writer.write_line(line)
+
+def check_round_trip(records, directory, compression, parts=4):
+    """
+    Write records as part files, concatenate them like the parallel read
+    split does, and read them back with the native importer.
+    """
+    merged_name = os.path.join(directory, "merged.jsonl" + COMPRESSION_SUFFIXES[compression])
+    size = -(-len(records) // parts)
+    with open(merged_name, 'wb') as merged:
+        for part in range(parts):
+            part_name = f"{merged_name}.part{part:05d}"
+            write_buffered(records[part * size:(part + 1) * size], part_name, 64 << 10, compression)
+            with open(part_name, 'rb') as part_file:
+                shutil.copyfileobj(part_file, merged)
+            os.remove(part_name)
+    importer = NativeMongoImporter(batch_size=5000, workers=1, compression=compression)
+    read_back = [document for _, batch in importer.read_batches(merged_name) for document in batch]
+    os.remove(merged_name)
+    if read_back != records:
+        raise SystemExit(f"{compression or 'uncompressed'} round trip read {len(read_back)} "
+                         f"of {len(records)} records, or altered them")
+
+def measure(label, write, records, file_name):
+    started = time.perf_counter()
+    write(records, file_name)
+    elapsed = time.perf_counter() - started
+    result = {
+        "writer": label,
+        "seconds": round(elapsed, 3),
+        "lines_per_second": round(len(records) / elapsed),
+        "bytes": os.path.getsize(file_name),
+    }
+    os.remove(file_name)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare JSONL writer throughput")
+    parser.add_argument("--lines", type=int, default=1000000)
+    parser.add_argument("--zstd", action="store_true", help="also measure zstd output (needs zstandard)")
+    args = parser.parse_args()
+
+    records = make_records(args.lines)
+    lines = [json.dumps(record) for record in records]
+
+    object_cases = [("flush-per-record", write_flush_per_record)]
+    for buffer_size in (64 << 10, 1 << 20, 8 << 20):
+        object_cases.append((f"buffered-{buffer_size >> 10}k",
+                             lambda r, f, size=buffer_size: write_buffered(r, f, size, None)))
+    object_cases.append(("buffered-1024k-gzip", lambda r, f: write_buffered(r, f, 1 << 20, 'gzip')))
+    if args.zstd:
+        object_cases.append(("buffered-1024k-zstd", lambda r, f: write_buffered(r, f, 1 << 20, 'zstd')))
+
+    line_cases = [("flush-per-line", write_lines_flush_per_record)]
+    for buffer_size in (64 << 10, 1 << 20, 8 << 20):
+        line_cases.append((f"buffered-{buffer_size >> 10}k",
+                           lambda r, f, size=buffer_size: write_lines_buffered(r, f, size)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        for compression in (None, 'gzip', 'zstd') if args.zstd else (None, 'gzip'):
+            check_round_trip(records[:100000], directory, compression)
+        file_name = os.path.join(directory, "bench.jsonl")
+        objects = [measure(label, write, records, file_name) for label, write in object_cases]
+        passthrough = [measure(label, write, lines, file_name) for label, write in line_cases]
+
+    print(json.dumps({"lines": args.lines, "objects": objects, "passthrough": passthrough}, indent=2))
+
+if __name__ == "__main__":
+    main()
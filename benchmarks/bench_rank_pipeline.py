@@ -0,0 +1,385 @@
+"""
+Benchmark of the popular-rank aggregation pipelines.
+
+Builds the same synthetic reads twice: as legacy beread documents with ISO
+string timestamps, and as beread buckets. On the legacy documents it times
+the legacy pipelines (server-side JavaScript date conversion) against the
+same reads bucketed with the native date operators of
+generate_popular_rank, so only the date operators differ. It then times
+the native pipelines on the legacy documents against the
+generate_popular_rank pipelines on the buckets, which count whole buckets
+instead of unwinding every read, and the three per-granularity pipelines
+against the single-scan $facet pipeline.
+
+    python3 benchmarks/bench_rank_pipeline.py --mongo-uri mongodb://localhost:27017 --articles 2000 --reads 200000
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from pymongo import MongoClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "data_load"))
+
+from generate_beread import BUCKET_SIZE, read_day
+from generate_popular_rank import (
+    GRANULARITIES, _bucket_expression, _granularity_pipeline, _top_articles_stages,
+    all_granularities_pipeline
+)
+
+BENCHMARK_DB = "rank_benchmark"
+
+def legacy_daily_pipeline():
+    """Daily pipeline as it was before native date bucketing."""
+    pipeline = [
+        # Convert timestamp strings to dates
+        {'$unwind': '$timestamp'},
+        {
+            '$addFields': {
+                'timestampDate': {
+                    '$dateFromString': {'dateString': '$timestamp'}
+                }
+            }
+        },
+        # Extract year and day
+        {
+            '$project': {
+                'year': {'$year': '$timestampDate'},
+                'day': {'$dayOfYear': '$timestampDate'},
+                'aid': '$aid'
+            }
+        },
+        # Group and count accesses
+        {
+            '$group': {
+                '_id': {
+                    'year': '$year',
+                    'day': '$day',
+                    'aid': '$aid'
+                },
+                'accessCount': {'$sum': 1}
+            }
+        },
+        # Sort by year, day, and access count
+        {
+            '$sort': {
+                '_id.year': 1,
+                '_id.day': 1,
+                'accessCount': -1
+            }
+        },
+        # Group articles by day
+        {
+            '$group': {
+                '_id': {
+                    'year': '$_id.year',
+                    'day': '$_id.day'
+                },
+                'articles': {
+                    '$push': {
+                        'aid': '$_id.aid',
+                        'accessCount': '$accessCount'
+                    }
+                }
+            }
+        },
+        # Take top 5 articles
+        {
+            '$project': {
+                'articles': {'$slice': ['$articles', 5]},
+                'year': '$_id.year',
+                'dayOfYear': '$_id.day'
+            }
+        },
+        # Convert to proper date
+        {
+            '$addFields': {
+                'date': {
+                    '$function': {
+                        'body': 'function(year, dayOfYear) { return new Date(Date.UTC(year, 0, dayOfYear)); }',
+                        'args': ['$year', '$dayOfYear'],
+                        'lang': 'js'
+                    }
+                }
+            }
+        },
+        # Final projection
+        {
+            '$project': {
+                'timestamp': {'$toLong': '$date'},
+                'temporalGranularity': 'daily',
+                'articleAidList': '$articles.aid'
+            }
+        }
+    ]
+    return pipeline
+
+def legacy_weekly_pipeline():
+    """Weekly pipeline as it was before native date bucketing."""
+    pipeline = [
+        {'$unwind': '$timestamp'},
+        {
+            '$addFields': {
+                'timestampDate': {
+                    '$dateFromString': {'dateString': '$timestamp'}
+                }
+            }
+        },
+        # Calculate first day of week
+        {
+            '$addFields': {
+                'firstDayOfWeek': {
+                    '$subtract': [
+                        '$timestampDate',
+                        {
+                            '$multiply': [
+                                {'$subtract': [{'$dayOfWeek': '$timestampDate'}, 1]},
+                                86400000
+                            ]
+                        }
+                    ]
+                }
+            }
+        },
+        {
+            '$project': {
+                'year': {'$year': '$firstDayOfWeek'},
+                'day': {'$dayOfYear': '$firstDayOfWeek'},
+                'aid': '$aid'
+            }
+        },
+        # Rest of pipeline similar to daily
+        {
+            '$group': {
+                '_id': {
+                    'year': '$year',
+                    'day': '$day',
+                    'aid': '$aid'
+                },
+                'accessCount': {'$sum': 1}
+            }
+        },
+        {'$sort': {'_id.year': 1, '_id.day': 1, 'accessCount': -1}},
+        {
+            '$group': {
+                '_id': {'year': '$_id.year', 'day': '$_id.day'},
+                'articles': {
+                    '$push': {
+                        'aid': '$_id.aid',
+                        'accessCount': '$accessCount'
+                    }
+                }
+            }
+        },
+        {
+            '$project': {
+                'articles': {'$slice': ['$articles', 5]},
+                'year': '$_id.year',
+                'dayOfYear': '$_id.day'
+            }
+        },
+        {
+            '$addFields': {
+                'date': {
+                    '$function': {
+                        'body': 'function(year, dayOfYear) { return new Date(Date.UTC(year, 0, dayOfYear)); }',
+                        'args': ['$year', '$dayOfYear'],
+                        'lang': 'js'
+                    }
+                }
+            }
+        },
+        {
+            '$project': {
+                'timestamp': {'$toLong': '$date'},
+                'temporalGranularity': 'weekly',
+                'articleAidList': '$articles.aid'
+            }
+        }
+    ]
+    return pipeline
+
+def legacy_monthly_pipeline():
+    """Monthly pipeline as it was before native date bucketing."""
+    pipeline = [
+        {'$unwind': '$timestamp'},
+        {
+            '$addFields': {
+                'timestampDate': {
+                    '$dateFromString': {'dateString': '$timestamp'}
+                }
+            }
+        },
+        {
+            '$project': {
+                'year': {'$year': '$timestampDate'},
+                'month': {'$month': '$timestampDate'},
+                'aid': '$aid'
+            }
+        },
+        {
+            '$group': {
+                '_id': {
+                    'year': '$year',
+                    'month': '$month',
+                    'aid': '$aid'
+                },
+                'accessCount': {'$sum': 1}
+            }
+        },
+        {'$sort': {'_id.year': 1, '_id.month': 1, 'accessCount': -1}},
+        {
+            '$group': {
+                '_id': {'year': '$_id.year', 'month': '$_id.month'},
+                'articles': {
+                    '$push': {
+                        'aid': '$_id.aid',
+                        'accessCount': '$accessCount'
+                    }
+                }
+            }
+        },
+        {
+            '$project': {
+                'articles': {'$slice': ['$articles', 5]},
+                'year': '$_id.year',
+                'month': '$_id.month'
+            }
+        },
+        {
+            '$addFields': {
+                'date': {
+                    '$dateFromParts': {
+                        'year': '$year',
+                        'month': '$month'
+                    }
+                }
+            }
+        },
+        {
+            '$project': {
+                'timestamp': {'$toLong': '$date'},
+                'temporalGranularity': 'monthly',
+                'articleAidList': '$articles.aid'
+            }
+        }
+    ]
+    return pipeline
+
+def native_iso_pipeline(granularity):
+    """
+    Rank pipeline of generate_popular_rank run over legacy ISO string
+    beread documents: one read per unwound timestamp, bucketed with native
+    date operators.
+    """
+    return [
+        {'$unwind': '$timestamp'},
+        {
+            '$project': {
+                'aid': '$aid',
+                'reads': {'$literal': 1},
+                'date': _bucket_expression(granularity, {'$dateFromString': {'dateString': '$timestamp'}})
+            }
+        }
+    ] + _top_articles_stages(granularity)
+
+def build_synthetic_beread(db, articles, reads, days, seed):
+    """Store the same reads as legacy ISO string beread documents and as beread buckets."""
+    rng = random.Random(seed)
+    start = datetime(2017, 9, 25)
+    read_times = {str(aid): [] for aid in range(articles)}
+    for _ in range(reads):
+        aid = str(min(int(rng.paretovariate(1.2)) - 1, articles - 1))
+        read_times[aid].append(start + timedelta(seconds=rng.randrange(days * 86400)))
+
+    db.beread_iso.drop()
+    db.beread_bucket.drop()
+    db.beread_iso.insert_many([
+        {"aid": aid, "timestamp": [t.isoformat() for t in times]} for aid, times in read_times.items()
+    ])
+    buckets = []
+    for aid, times in read_times.items():
+        times_by_day = {}
+        for t in sorted(times):
+            times_by_day.setdefault(read_day(t), []).append(t)
+        for day, day_times in times_by_day.items():
+            for offset in range(0, len(day_times), BUCKET_SIZE):
+                bucket_times = day_times[offset:offset + BUCKET_SIZE]
+                buckets.append({"aid": aid, "day": day, "count": len(bucket_times), "timestamp": bucket_times})
+    db.beread_bucket.insert_many(buckets)
+
+def time_pipeline(collection, pipeline, repeat):
+    """Best wall time in seconds over `repeat` runs."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        list(collection.aggregate(pipeline, allowDiskUse=True))
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare legacy and native-date rank pipelines")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    parser.add_argument("--articles", type=int, default=2000)
+    parser.add_argument("--reads", type=int, default=200000)
+    parser.add_argument("--days", type=int, default=120)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="keep the benchmark database afterwards")
+    args = parser.parse_args()
+
+    client = MongoClient(args.mongo_uri)
+    db = client[BENCHMARK_DB]
+    build_synthetic_beread(db, args.articles, args.reads, args.days, args.seed)
+
+    legacy_pipelines = {
+        "daily": legacy_daily_pipeline(),
+        "weekly": legacy_weekly_pipeline(),
+        "monthly": legacy_monthly_pipeline(),
+    }
+    results = []
+    buckets = []
+    for granularity in GRANULARITIES:
+        # Both pipelines read the legacy documents, so only the date operators differ
+        legacy_seconds = time_pipeline(db.beread_iso, legacy_pipelines[granularity], args.repeat)
+        native_seconds = time_pipeline(db.beread_iso, native_iso_pipeline(granularity), args.repeat)
+        results.append({
+            "granularity": granularity,
+            "legacy_seconds": round(legacy_seconds, 4),
+            "native_seconds": round(native_seconds, 4),
+            "speedup": round(legacy_seconds / native_seconds, 2) if native_seconds else None,
+        })
+        bucket_seconds = time_pipeline(db.beread_bucket, _granularity_pipeline(granularity), args.repeat)
+        buckets.append({
+            "granularity": granularity,
+            "unwound_seconds": round(native_seconds, 4),
+            "bucket_seconds": round(bucket_seconds, 4),
+            "speedup": round(native_seconds / bucket_seconds, 2) if bucket_seconds else None,
+        })
+
+    separate_seconds = sum(result["bucket_seconds"] for result in buckets)
+    facet_seconds = time_pipeline(db.beread_bucket, all_granularities_pipeline(), args.repeat)
+    single_scan = {
+        "separate_seconds": round(separate_seconds, 4),
+        "facet_seconds": round(facet_seconds, 4),
+        "speedup": round(separate_seconds / facet_seconds, 2) if facet_seconds else None,
+    }
+
+    print(json.dumps({
+        "articles": args.articles,
+        "reads": args.reads,
+        "results": results,
+        "buckets": buckets,
+        "single_scan": single_scan,
+    }, indent=2))
+    if not args.keep:
+        client.drop_database(BENCHMARK_DB)
+
+if __name__ == "__main__":
+    main()
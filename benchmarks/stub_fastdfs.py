@@ -0,0 +1,82 @@
+"""
+Stand-in for the nginx/FastDFS gateway in benchmarks.
+
+Serves a deterministic body for any path, sized by file type, and honours
+single `bytes=start-end` Range requests like nginx. `--latency` adds a
+fixed delay before each response to model a remote storage node.
+
+    python3 benchmarks/stub_fastdfs.py --port 9099 --latency 2
+"""
+
+import argparse
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Body size per file extension; other files get DEFAULT_SIZE bytes
+FILE_SIZES = {".txt": 4096, ".jpg": 64 * 1024, ".flv": 1 << 20}
+DEFAULT_SIZE = 4096
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)$")
+
+def file_body(path):
+    size = next((size for suffix, size in FILE_SIZES.items() if path.endswith(suffix)), DEFAULT_SIZE)
+    line = (path + " lorem ipsum dolor sit amet\n").encode("utf-8")
+    return (line * (size // len(line) + 1))[:size]
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        body = file_body(self.path)
+        status, start, end = 200, 0, len(body) - 1
+        match = RANGE_PATTERN.match(self.headers.get("Range", ""))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), end) if match.group(2) else end
+            else:
+                start = max(len(body) - int(match.group(2)), 0)
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(body)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain" if self.path.endswith(".txt") else "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+        self.end_headers()
+        self.wfile.write(body[start:end + 1])
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub(host="127.0.0.1", port=9099, latency_ms=0.0):
+    """Serve from a daemon thread; returns the server (call shutdown() to stop)."""
+    handler = type("Handler", (StubHandler,), {"latency": latency_ms / 1000})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-fastdfs", daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic FastDFS files")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9099)
+    parser.add_argument("--latency", type=float, default=0.0, help="milliseconds added to each response")
+    args = parser.parse_args()
+    handler = type("Handler", (StubHandler,), {"latency": args.latency / 1000})
+    ThreadingHTTPServer((args.host, args.port), handler).serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Synthetic input data for the load and API benchmarks.
+
+Writes db-generation/user.dat, article.dat and read.dat in the format of
+the course data generator, plus backend/mapping_results.txt pointing every
+article file at a FastDFS stand-in (see stub_fastdfs.py). Article
+popularity follows a Zipf law, so a few articles take most reads as in
+the real workload.
+
+    python3 benchmarks/synthetic_data.py --output /tmp/ddbs-bench --users 1000 --articles 2000 --reads 100000
+"""
+
+import argparse
+import itertools
+import json
+import random
+from pathlib import Path
+
+# Start of the synthetic read history (2017-09-25 UTC), in epoch milliseconds
+START_TIMESTAMP = 1506297600000
+DAY_MS = 86400000
+
+REGIONS = [("Beijing", 0.6), ("Hong Kong", 0.4)]
+CATEGORIES = [("science", 0.45), ("technology", 0.55)]
+
+COMMENT_TEMPLATE = "comments to this article: (%d)"
+
+def zipf_cum_weights(count, exponent):
+    """Cumulative Zipf weights of ranks 1..count, for random.choices."""
+    return list(itertools.accumulate(1.0 / rank ** exponent for rank in range(1, count + 1)))
+
+def pick(rng, choices):
+    values, weights = zip(*choices)
+    return rng.choices(values, weights)[0]
+
+def make_users(rng, users):
+    for i in range(users):
+        yield {
+            "timestamp": str(START_TIMESTAMP - rng.randrange(365) * DAY_MS),
+            "id": f"u{i}",
+            "uid": str(i),
+            "name": f"user{i}",
+            "gender": rng.choice(["male", "female"]),
+            "email": f"email{i}",
+            "phone": f"phone{i}",
+            "dept": f"dept{rng.randrange(20)}",
+            "grade": f"grade{rng.randrange(1, 5)}",
+            "language": rng.choice(["en", "zh"]),
+            "region": pick(rng, REGIONS),
+            "role": f"role{rng.randrange(3)}",
+            "preferTags": f"tags{rng.randrange(50)}",
+            "obtainedCredits": str(rng.randrange(100)),
+        }
+
+def make_articles(rng, articles, video_ratio):
+    for i in range(articles):
+        images = rng.randrange(4)
+        yield {
+            "id": f"a{i}",
+            "timestamp": str(START_TIMESTAMP - rng.randrange(365) * DAY_MS),
+            "aid": str(i),
+            "title": f"title{i}",
+            "category": pick(rng, CATEGORIES),
+            "abstract": f"abstract of article {i}",
+            "articleTags": f"tags{rng.randrange(50)}",
+            "authors": f"author{rng.randrange(1000)}",
+            "language": rng.choice(["en", "zh"]),
+            "text": f"text_a{i}.txt",
+            "image": "".join(f"image_a{i}_{j}.jpg," for j in range(images)),
+            "video": f"video_a{i}_video.flv" if rng.random() < video_ratio else "",
+        }
+
+def make_reads(rng, reads, users, articles, days, zipf_exponent):
+    # Popularity ranks are shuffled over aids, so popular articles fall in both categories
+    aids = [str(aid) for aid in range(articles)]
+    rng.shuffle(aids)
+    cum_weights = zipf_cum_weights(articles, zipf_exponent)
+    timestamps = sorted(START_TIMESTAMP + rng.randrange(days * DAY_MS) for _ in range(reads))
+    for i, timestamp in enumerate(timestamps):
+        yield {
+            "timestamp": str(timestamp),
+            "id": f"r{i}",
+            "uid": str(rng.randrange(users)),
+            "aid": rng.choices(aids, cum_weights=cum_weights)[0],
+            "readTimeLength": str(rng.randrange(1, 100)),
+            "agreeOrNot": str(int(rng.random() < 0.2)),
+            "commentOrNot": str(int(rng.random() < 0.1)),
+            "shareOrNot": str(int(rng.random() < 0.05)),
+            "commentDetail": COMMENT_TEMPLATE % i,
+        }
+
+def file_names(article):
+    names = [article["text"]]
+    names.extend(name for name in article["image"].split(",") if name)
+    if article["video"]:
+        names.append(article["video"])
+    return names
+
+def write_jsonl(records, file_name):
+    count = 0
+    with open(file_name, "w", encoding="utf-8") as out_file:
+        for record in records:
+            out_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+def generate(output, users=1000, articles=2000, reads=100000, days=120, zipf_exponent=1.1,
+             video_ratio=0.05, storage_url="http://0.0.0.0:9099", seed=0):
+    """
+    Write the input files of bulk_load.py under `output`, laid out as the
+    working directory it expects. Returns the number of records written.
+    """
+    rng = random.Random(seed)
+    output = Path(output)
+    (output / "db-generation").mkdir(parents=True, exist_ok=True)
+    (output / "backend").mkdir(parents=True, exist_ok=True)
+
+    article_records = list(make_articles(rng, articles, video_ratio))
+    counts = {
+        "users": write_jsonl(make_users(rng, users), output / "db-generation" / "user.dat"),
+        "articles": write_jsonl(article_records, output / "db-generation" / "article.dat"),
+        "reads": write_jsonl(make_reads(rng, reads, users, articles, days, zipf_exponent),
+                             output / "db-generation" / "read.dat"),
+    }
+
+    with open(output / "backend" / "mapping_results.txt", "w") as mapping:
+        for article in article_records:
+            for name in file_names(article):
+                mapping.write(f"{name} --> {storage_url}/group1/M00/00/00/{name}\n")
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic user, article and read data")
+    parser.add_argument("--output", required=True, help="directory laid out like the bulk_load working directory")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--articles", type=int, default=2000)
+    parser.add_argument("--reads", type=int, default=100000)
+    parser.add_argument("--days", type=int, default=120, help="days covered by the reads")
+    parser.add_argument("--zipf", type=float, default=1.1, help="exponent of the article popularity law")
+    parser.add_argument("--storage-url", default="http://0.0.0.0:9099",
+                        help="FastDFS base URL written to the file mapping")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    counts = generate(args.output, args.users, args.articles, args.reads, args.days, args.zipf,
+                      storage_url=args.storage_url, seed=args.seed)
+    print(json.dumps(counts, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Text previews of articles, for the rank documents materialized by
+generate_popular_rank.
+
+The data load scripts run without app/, so this repeats the few rules of
+app/hydration.py and app/file_mapping.py that decide what the rank
+endpoint shows: the text file named by info.article is looked up in
+file.mapping, its first PREVIEW_BYTES are downloaded with a Range request,
+and the cut is decoded the way requests decodes the response. Keep both
+sides in step.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from email.message import Message
+from urllib.error import URLError
+from urllib.request import Request, urlopen
+
+# Bytes of text shown per article in rank responses (app/hydration.py)
+PREVIEW_BYTES = 1024
+
+# Storage host written into file.mapping URLs (app/file_mapping.py)
+STORAGE_HOST = "0.0.0.0"
+
+# Concurrent preview downloads, and the timeout of each in seconds
+PREVIEW_FETCH_WORKERS = 16
+PREVIEW_FETCH_TIMEOUT = 10.0
+
+def response_encoding(headers):
+    """The charset requests would pick: the declared one, else ISO-8859-1 for text/*."""
+    message = Message()
+    message["Content-Type"] = headers.get("Content-Type", "")
+    charset = message.get_param("charset")
+    if charset:
+        return str(charset).strip("'\"")
+    return "ISO-8859-1" if "text" in message.get_content_type() else None
+
+def fetch_preview(url, preview_bytes=PREVIEW_BYTES):
+    """The first `preview_bytes` of a file as text, or None when the download fails."""
+    request = Request(url, headers={"Range": f"bytes=0-{preview_bytes - 1}", "Accept-Encoding": "identity"})
+    try:
+        with urlopen(request, timeout=PREVIEW_FETCH_TIMEOUT) as response:
+            # A server ignoring Range sends the whole file; read only the start
+            data = response.read(preview_bytes)
+            encoding = response_encoding(response.headers) or "utf-8"
+    except (URLError, OSError):
+        return None
+    # The cut may split a multi-byte character
+    return data[:preview_bytes].decode(encoding, errors="ignore")
+
+def text_urls(client, aids, fetch_host):
+    """{aid: URL of its text file on `fetch_host`} for the articles whose text is mapped."""
+    text_names = {
+        article["aid"]: article["text"]
+        for article in client.info.article.find({"aid": {"$in": list(aids)}}, {"_id": 0, "aid": 1, "text": 1})
+    }
+    paths = {
+        entry["name"]: entry["path"].strip().replace(STORAGE_HOST, fetch_host)
+        for entry in client.file.mapping.find({"name": {"$in": list(text_names.values())}},
+                                              {"_id": 0, "name": 1, "path": 1})
+    }
+    return {aid: paths[name] for aid, name in text_names.items() if name in paths}
+
+def article_previews(client, aids, fetch_host, preview_bytes=PREVIEW_BYTES):
+    """
+    {aid: text preview} of the given aids, read from `client` (db2 holds
+    every article). The text is None when the article is unknown, its file
+    is unmapped or the download fails.
+    """
+    unique_aids = list(dict.fromkeys(aids))
+    urls = text_urls(client, unique_aids, fetch_host)
+    known = [aid for aid in unique_aids if aid in urls]
+    with ThreadPoolExecutor(max_workers=PREVIEW_FETCH_WORKERS) as executor:
+        texts = dict(zip(known, executor.map(lambda aid: fetch_preview(urls[aid], preview_bytes), known)))
+    return {aid: texts.get(aid) for aid in unique_aids}
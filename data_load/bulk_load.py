@@ -3,16 +3,29 @@ Bulk data loading script for separating and loading data into MongoDB containers
 Handles user, article, and read data distribution across databases.
 """
 
+import argparse
+import gzip
+import io
 import json
 import logging
+import os
+import re
+import shutil
+import struct
 import subprocess
+import threading
+import time
 from pathlib import Path
 from time import sleep
-from typing import Set, Dict, Iterator, Any
-from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, Any, List, Tuple, Optional, IO
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
+from pymongo import MongoClient, ReplaceOne
+from pymongo.errors import BulkWriteError
 from tqdm import tqdm
 
+from indexes import apply_indexes, upsert_index
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -28,17 +41,69 @@ OUTPUT_PATHS = {
     'db2': 'ddbs_2_data'
 }
 
+# Bytes buffered by JsonlWriter before each write to the underlying file
+DEFAULT_WRITE_BUFFER_SIZE = 1 << 20
+
+# File name suffixes of the supported JsonlWriter compressions
+COMPRESSION_SUFFIXES = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+# Split output files and the collections they are imported into
+IMPORT_COLLECTIONS = {
+    'user': ('info', 'user'),
+    'article': ('info', 'article'),
+    'read': ('history', 'read'),
+    'mapping': ('file', 'mapping')
+}
+
+# Direct driver import targets: mongod address and the split output it receives
+NATIVE_TARGETS = {
+    'ddbs_mongo_1': ('localhost', 27001, 'db1'),
+    'ddbs_mongo_2': ('localhost', 27002, 'db2'),
+    'ddbs_mongo_1_bak': ('localhost', 27003, 'db1'),
+    'ddbs_mongo_2_bak': ('localhost', 27004, 'db2'),
+}
+
+# Natural keys used to upsert rows when a partial import is resumed
+UPSERT_KEYS = {
+    'user': 'uid',
+    'article': 'aid',
+    'read': 'id',
+    'mapping': 'name',
+}
+
+DEFAULT_IMPORT_BATCH_SIZE = 5000
+DEFAULT_IMPORT_WORKERS = 4
+
+# Persisted uid -> region index written by the user split
+DEFAULT_USER_INDEX_PATH = 'user_region.idx'
+
+# Progress record of the bulk load pipeline
+DEFAULT_CHECKPOINT_PATH = 'bulk_load_checkpoint.json'
+
+# Pulls the uid out of a raw read.dat line without parsing the whole record
+UID_PATTERN = re.compile(rb'"uid"\s*:\s*"([^"]*)"')
+
 class JsonlHandler:
     @staticmethod
     def load(file_name: str) -> Iterator[dict]:
         """Load JSONL file with error handling."""
+        for _, record in JsonlHandler.load_lines(file_name):
+            yield record
+
+    @staticmethod
+    def load_lines(file_name: str) -> Iterator[Tuple[str, dict]]:
+        """Load JSONL file, yielding each stripped line with its parsed record."""
         try:
             with open(file_name, 'r', encoding='utf-8') as file:
                 for line_num, line in enumerate(file, 1):
                     try:
                         stripped_line = line.strip()
                         if stripped_line:
-                            yield json.loads(stripped_line)
+                            yield stripped_line, json.loads(stripped_line)
                     except json.JSONDecodeError as e:
                         logger.error(f"Error parsing JSON at line {line_num}: {e}")
         except FileNotFoundError:
@@ -46,17 +111,98 @@ class JsonlHandler:
             raise
 
     @staticmethod
-    def dump(objects: Iterator[Any], file_name: str) -> None:
+    def dump(objects: Iterator[Any],
+             file_name: str,
+             buffer_size: int = DEFAULT_WRITE_BUFFER_SIZE,
+             compression: Optional[str] = None) -> None:
         """Dump objects to JSONL file with error handling."""
         try:
-            with open(file_name, 'w', encoding='utf-8') as out_file:
+            with JsonlWriter(file_name, buffer_size, compression) as writer:
                 for obj in objects:
-                    out_file.write(json.dumps(obj, ensure_ascii=False) + "\n")
-                    out_file.flush()
+                    writer.write(obj)
         except IOError as e:
             logger.error(f"Error writing to file {file_name}: {e}")
             raise
 
+def open_jsonl(file_name: str) -> IO[bytes]:
+    """Open a JSONL file for binary reading, decompressing by file suffix."""
+    if file_name.endswith(COMPRESSION_SUFFIXES['gzip']):
+        return gzip.open(file_name, 'rb')
+    if file_name.endswith(COMPRESSION_SUFFIXES['zstd']):
+        import zstandard
+        # Merged part files hold one frame per part; the buffered wrapper provides line iteration
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+            open(file_name, 'rb'), read_across_frames=True, closefd=True))
+    return open(file_name, 'rb')
+
+class JsonlWriter:
+    """
+    Buffered JSONL writer.
+    Lines are collected in memory and written in batches of about
+    `buffer_size` bytes, optionally through gzip or zstd compression.
+    """
+
+    def __init__(self,
+                 file_name: str,
+                 buffer_size: int = DEFAULT_WRITE_BUFFER_SIZE,
+                 compression: Optional[str] = None,
+                 mode: str = 'wb'):
+        if compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(f"Unsupported compression: {compression}")
+        self.file_name = file_name
+        self.buffer_size = buffer_size
+        self._buffer: List[bytes] = []
+        self._buffered = 0
+        self._raw = open(file_name, mode)
+        if compression == 'gzip':
+            self._file = gzip.GzipFile(fileobj=self._raw, mode=mode)
+        elif compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                self._raw.close()
+                raise ValueError("zstd compression requires the zstandard package")
+            self._file = zstandard.ZstdCompressor().stream_writer(self._raw, closefd=False)
+        else:
+            self._file = self._raw
+
+    def __enter__(self) -> "JsonlWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def write(self, obj: Any) -> None:
+        """Serialize one object as a JSONL line."""
+        self.write_line(json.dumps(obj, ensure_ascii=False))
+
+    def write_line(self, line: str) -> None:
+        """Write one already serialized line, without its newline."""
+        self.write_raw(line.encode('utf-8') + b"\n")
+
+    def write_raw(self, data: bytes) -> None:
+        """Write bytes that already end with a newline."""
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._buffer:
+            self._file.write(b"".join(self._buffer))
+            self._buffer.clear()
+            self._buffered = 0
+
+    def close(self) -> None:
+        if self._raw.closed:
+            return
+        try:
+            self.flush()
+            if self._file is not self._raw:
+                self._file.close()
+        finally:
+            self._raw.close()
+
 class DockerHelper:
     @staticmethod
     def get_container_names(prefix: str) -> list[str]:
@@ -73,22 +219,227 @@ class DockerHelper:
             logger.error(f"Error getting container names: {e}")
             return []
 
-class DataDistributor:
+class PipelineCheckpoint:
+    """
+    Progress record of the bulk load pipeline, saved as JSON after every change.
+    Tracks completed stages, completed read.dat byte ranges, and the number of
+    input lines committed per import target and collection.
+    """
+
+    def __init__(self, file_name: str = DEFAULT_CHECKPOINT_PATH, resume: bool = False):
+        self.file_name = file_name
+        self._lock = threading.Lock()
+        self.state = {'stages': [], 'read_ranges': None, 'read_chunks': [], 'imports': {}}
+        if resume and os.path.exists(file_name):
+            with open(file_name, 'r', encoding='utf-8') as file:
+                self.state.update(json.load(file))
+            logger.info(f"Resuming bulk load from {file_name}")
+        else:
+            self.save()
+
+    def save(self) -> None:
+        """Write the checkpoint atomically."""
+        temp_name = f"{self.file_name}.tmp"
+        with open(temp_name, 'w', encoding='utf-8') as file:
+            json.dump(self.state, file)
+        os.replace(temp_name, self.file_name)
+
+    def is_done(self, stage: str) -> bool:
+        return stage in self.state['stages']
+
+    def mark_done(self, stage: str) -> None:
+        with self._lock:
+            if stage not in self.state['stages']:
+                self.state['stages'].append(stage)
+            self.save()
+
+    def read_ranges(self, compute) -> List[Tuple[int, int]]:
+        """Byte ranges of read.dat, fixed on first use so a resume reuses them."""
+        with self._lock:
+            if self.state['read_ranges'] is None:
+                self.state['read_ranges'] = compute()
+                self.state['read_chunks'] = []
+                self.save()
+            return [tuple(r) for r in self.state['read_ranges']]
+
+    def is_chunk_done(self, index: int) -> bool:
+        return index in self.state['read_chunks']
+
+    def mark_chunk_done(self, index: int) -> None:
+        with self._lock:
+            self.state['read_chunks'].append(index)
+            self.save()
+
+    def import_progress(self, key: str) -> Optional[Dict[str, Any]]:
+        """Progress of an import target collection, or None if it never started."""
+        return self.state['imports'].get(key)
+
+    def record_import(self, key: str, line: int, done: bool = False) -> None:
+        with self._lock:
+            self.state['imports'][key] = {'line': line, 'done': done}
+            self.save()
+
+def split_byte_ranges(file_name: str, chunks: int) -> List[Tuple[int, int]]:
+    """Split a file into roughly equal byte ranges that start and end on line boundaries."""
+    size = os.path.getsize(file_name)
+    boundaries = [0]
+    with open(file_name, 'rb') as file:
+        for i in range(1, chunks):
+            file.seek(max(size * i // chunks, boundaries[-1]))
+            file.readline()
+            boundaries.append(min(file.tell(), size))
+    boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+class UserRegionIndex:
+    """
+    Compact uid -> split output index.
+    Canonical numeric uids take one byte each in a bytearray indexed by the
+    uid value; any other uid falls back to a small dict.
+    """
+
+    MAGIC = b'URIX1'
+    # Largest uid stored in the dense array, bounding it to 256MB
+    MAX_DENSE_UID = 1 << 28
+    CODES = {'db1': 1, 'db2': 2}
+    DB_KEYS = {code: db_key for db_key, code in CODES.items()}
+
     def __init__(self):
-        self.db1_user_set: Set[str] = set()
-        self.db2_user_set: Set[str] = set()
+        self._codes = bytearray()
+        self._other: Dict[str, int] = {}
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @classmethod
+    def _dense_slot(cls, uid: str) -> Optional[int]:
+        if uid.isdigit() and (uid == '0' or not uid.startswith('0')):
+            value = int(uid)
+            if value < cls.MAX_DENSE_UID:
+                return value
+        return None
+
+    def add(self, uid: str, db_key: str) -> None:
+        code = self.CODES[db_key]
+        slot = self._dense_slot(uid)
+        if slot is None:
+            self._size += uid not in self._other
+            self._other[uid] = code
+            return
+        if slot >= len(self._codes):
+            self._codes.extend(bytes(max(slot + 1 - len(self._codes), len(self._codes) // 2)))
+        self._size += not self._codes[slot]
+        self._codes[slot] = code
+
+    def lookup(self, uid: Optional[str]) -> Optional[str]:
+        """Return 'db1', 'db2', or None for unknown uids."""
+        if uid is None:
+            return None
+        slot = self._dense_slot(uid)
+        if slot is None:
+            code = self._other.get(uid, 0)
+        else:
+            code = self._codes[slot] if slot < len(self._codes) else 0
+        return self.DB_KEYS.get(code)
+
+    def save(self, file_name: str) -> None:
+        other = json.dumps(self._other).encode('utf-8')
+        with open(file_name, 'wb') as file:
+            file.write(self.MAGIC)
+            file.write(struct.pack('<QQQ', self._size, len(self._codes), len(other)))
+            file.write(self._codes)
+            file.write(other)
+
+    @classmethod
+    def load(cls, file_name: str) -> "UserRegionIndex":
+        index = cls()
+        with open(file_name, 'rb') as file:
+            if file.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError(f"Not a user region index: {file_name}")
+            index._size, dense_length, other_length = struct.unpack('<QQQ', file.read(24))
+            index._codes = bytearray(file.read(dense_length))
+            index._other = json.loads(file.read(other_length).decode('utf-8'))
+        return index
+
+# Per-process user index for read splitting, set by the pool initializer
+_worker_user_index: Dict[str, UserRegionIndex] = {}
+
+def _init_read_split_worker(user_index_path: str) -> None:
+    _worker_user_index['index'] = UserRegionIndex.load(user_index_path)
+
+def _split_read_chunk(file_name: str,
+                      start: int,
+                      end: int,
+                      part_paths: Dict[str, str],
+                      buffer_size: int = DEFAULT_WRITE_BUFFER_SIZE,
+                      compression: Optional[str] = None) -> Dict[str, int]:
+    """
+    Route the lines of one byte range of read.dat into per-database part files.
+    Lines are written through unchanged; only the uid is extracted.
+    """
+    user_index = _worker_user_index['index']
+    counts = {'db1': 0, 'db2': 0, 'unknown': 0}
+    outputs = {
+        db_key: JsonlWriter(path, buffer_size, compression)
+        for db_key, path in part_paths.items()
+    }
+    try:
+        with open(file_name, 'rb') as file:
+            file.seek(start)
+            while file.tell() < end:
+                line = file.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                match = UID_PATTERN.search(line)
+                db_key = user_index.lookup(match.group(1).decode('utf-8') if match else None)
+                if db_key is None:
+                    counts['unknown'] += 1
+                    continue
+                outputs[db_key].write_raw(line if line.endswith(b"\n") else line + b"\n")
+                counts[db_key] += 1
+    finally:
+        for output in outputs.values():
+            output.close()
+    return counts
+
+class DataDistributor:
+    def __init__(self,
+                 buffer_size: int = DEFAULT_WRITE_BUFFER_SIZE,
+                 compression: Optional[str] = None,
+                 user_index_path: str = DEFAULT_USER_INDEX_PATH):
+        self.user_index = UserRegionIndex()
+        self.user_index_path = user_index_path
         self.output_files: Dict = {}
-        
-    def setup_output_files(self):
+        self.buffer_size = buffer_size
+        self.compression = compression
+
+    def output_path(self, path: str, collection: str) -> str:
+        """Output file of a collection, suffixed for the configured compression."""
+        return f"{path}/{collection}.jsonl{COMPRESSION_SUFFIXES[self.compression]}"
+
+    def setup_output_files(self, collections: Tuple[str, ...] = ('user', 'article', 'read')):
         """Initialize output files for both databases."""
         for db_key, path in OUTPUT_PATHS.items():
             Path(path).mkdir(exist_ok=True)
             self.output_files[db_key] = {
-                'user': open(f"{path}/user.jsonl", 'w'),
-                'article': open(f"{path}/article.jsonl", 'w'),
-                'read': open(f"{path}/read.jsonl", 'w')
+                collection: JsonlWriter(self.output_path(path, collection), self.buffer_size, self.compression)
+                for collection in collections
             }
 
+    def close_collection(self, collection: str):
+        """Flush and close one collection's output files."""
+        for db_files in self.output_files.values():
+            if collection in db_files:
+                db_files.pop(collection).close()
+
+    def load_user_index(self):
+        """Reuse the user index persisted by an earlier user split."""
+        self.user_index = UserRegionIndex.load(self.user_index_path)
+        logger.info(f"Loaded {len(self.user_index)} users from {self.user_index_path}")
+
     def close_files(self):
         """Safely close all output files."""
         for db_files in self.output_files.values():
@@ -97,70 +448,329 @@ class DataDistributor:
 
     def distribute_user_data(self):
         """Distribute user data based on region."""
-        for record in tqdm(JsonlHandler.load(f"{DB_GENERATION_PATH}/user.dat"), desc="Processing users"):
+        for line, record in tqdm(JsonlHandler.load_lines(f"{DB_GENERATION_PATH}/user.dat"), desc="Processing users"):
             region = record.get("region")
             if region == "Beijing":
-                self.output_files['db1']['user'].write(json.dumps(record) + "\n")
-                self.db1_user_set.add(record["uid"])
+                self.output_files['db1']['user'].write_line(line)
+                self.user_index.add(record["uid"], 'db1')
             elif region == "Hong Kong":
-                self.output_files['db2']['user'].write(json.dumps(record) + "\n")
-                self.db2_user_set.add(record["uid"])
+                self.output_files['db2']['user'].write_line(line)
+                self.user_index.add(record["uid"], 'db2')
             else:
                 logger.error(f"Invalid region: {region}")
                 continue
 
+        # Persisted so read splitting can run in other processes or be resumed
+        self.user_index.save(self.user_index_path)
+
     def distribute_article_data(self):
         """Distribute article data based on category."""
-        for record in tqdm(JsonlHandler.load(f"{DB_GENERATION_PATH}/article.dat"), desc="Processing articles"):
+        for line, record in tqdm(JsonlHandler.load_lines(f"{DB_GENERATION_PATH}/article.dat"), desc="Processing articles"):
             category = record.get("category")
             if category == "science":
                 for db in ['db1', 'db2']:
-                    self.output_files[db]['article'].write(json.dumps(record) + "\n")
+                    self.output_files[db]['article'].write_line(line)
             elif category == "technology":
-                self.output_files['db2']['article'].write(json.dumps(record) + "\n")
+                self.output_files['db2']['article'].write_line(line)
             else:
                 logger.error(f"Invalid category: {category}")
                 continue
 
     def distribute_read_data(self):
         """Distribute read data based on user sets."""
-        for record in tqdm(JsonlHandler.load(f"{DB_GENERATION_PATH}/read.dat"), desc="Processing reads"):
+        for line, record in tqdm(JsonlHandler.load_lines(f"{DB_GENERATION_PATH}/read.dat"), desc="Processing reads"):
             uid = record.get("uid")
-            if uid in self.db1_user_set:
-                self.output_files['db1']['read'].write(json.dumps(record) + "\n")
-            elif uid in self.db2_user_set:
-                self.output_files['db2']['read'].write(json.dumps(record) + "\n")
-            else:
+            db_key = self.user_index.lookup(uid)
+            if db_key is None:
                 logger.error(f"Unknown user ID: {uid}")
                 continue
+            self.output_files[db_key]['read'].write_line(line)
+
+    def distribute_read_data_parallel(self, workers: int, checkpoint: Optional[PipelineCheckpoint] = None):
+        """
+        Distribute read data across a process pool.
+        read.dat is split into byte ranges; each worker routes its range into
+        its own part files, which are then concatenated in order. With a
+        checkpoint, ranges finished by an earlier run keep their part files
+        and are not split again.
+        """
+        file_name = f"{DB_GENERATION_PATH}/read.dat"
+        if checkpoint:
+            ranges = checkpoint.read_ranges(lambda: split_byte_ranges(file_name, workers * 4))
+        else:
+            ranges = split_byte_ranges(file_name, workers * 4)
+
+        # The merged files are written directly, not through the writers
+        self.close_collection('read')
+
+        part_paths = [
+            {db_key: f"{self.output_path(path, 'read')}.part{index:05d}" for db_key, path in OUTPUT_PATHS.items()}
+            for index in range(len(ranges))
+        ]
+        totals = {'db1': 0, 'db2': 0, 'unknown': 0}
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_read_split_worker,
+            initargs=(self.user_index_path,)
+        ) as executor:
+            futures = {
+                index: executor.submit(_split_read_chunk, file_name, start, end, paths,
+                                       self.buffer_size, self.compression)
+                for index, ((start, end), paths) in enumerate(zip(ranges, part_paths))
+                if not (checkpoint and checkpoint.is_chunk_done(index))
+            }
+            for index, future in tqdm(futures.items(), desc="Processing read chunks"):
+                for key, count in future.result().items():
+                    totals[key] += count
+                if checkpoint:
+                    checkpoint.mark_chunk_done(index)
+
+        if totals['unknown']:
+            logger.error(f"Skipped {totals['unknown']} reads with unknown user IDs")
+
+        # Compressed parts are complete gzip members / zstd frames, so they concatenate too
+        for db_key, path in OUTPUT_PATHS.items():
+            with open(self.output_path(path, 'read'), 'wb') as merged:
+                for paths in part_paths:
+                    with open(paths[db_key], 'rb') as part:
+                        shutil.copyfileobj(part, merged)
+        # Parts are only removed once every merge is complete and recorded, so a
+        # resumed run either redoes the merge or skips the stage entirely
+        if checkpoint:
+            checkpoint.mark_done('reads')
+        for paths in part_paths:
+            for part_path in paths.values():
+                os.remove(part_path)
+        logger.info(f"Split reads: {totals['db1']} to db1, {totals['db2']} to db2")
 
 class MongoImporter:
     @staticmethod
-    def import_data(container_name: str) -> None:
-        """Import data into MongoDB container using mongoimport."""
+    def import_data(container_name: str, checkpoint: Optional[PipelineCheckpoint] = None) -> None:
+        """
+        Import data into MongoDB container using mongoimport.
+        With a checkpoint, finished collections are skipped and a collection
+        that was interrupted is re-imported in upsert mode on its natural key.
+        """
         logger.info(f"Loading data for container: {container_name}")
-        
-        collections = {
-            'user': ('info', 'user'),
-            'article': ('info', 'article'),
-            'read': ('history', 'read'),
-            'mapping': ('file', 'mapping')
-        }
-        
-        for collection, (db_name, coll_name) in collections.items():
+
+        for collection, (db_name, coll_name) in IMPORT_COLLECTIONS.items():
             file_name = 'file_map.jsonl' if collection == 'mapping' else f'{collection}.jsonl'
+            progress_key = f"import:{container_name}:{collection}"
+            progress = checkpoint.import_progress(progress_key) if checkpoint else None
+            if progress and progress['done']:
+                logger.info(f"Skipping {collection} for {container_name}: already imported")
+                continue
+
+            command = [
+                'docker', 'exec', container_name,
+                'mongoimport',
+                f'--db={db_name}',
+                f'--collection={coll_name}',
+            ]
+            if progress:
+                command += ['--mode=upsert', f'--upsertFields={UPSERT_KEYS[collection]}']
+            command.append(f'{DATA_LOAD_PATH}/{file_name}')
+
             try:
-                subprocess.run([
-                    'docker', 'exec', container_name,
-                    'mongoimport',
-                    f'--db={db_name}',
-                    f'--collection={coll_name}',
-                    f'{DATA_LOAD_PATH}/{file_name}'
-                ], check=True)
+                if progress:
+                    # Without the unique key index every upsert scans the collection
+                    spec = upsert_index((db_name, coll_name), UPSERT_KEYS[collection]).document
+                    create_index = (f"db.getSiblingDB('{db_name}').{coll_name}.createIndex("
+                                    f"{json.dumps(dict(spec['key']))}, "
+                                    f"{json.dumps({'name': spec['name'], 'unique': True})})")
+                    subprocess.run(['docker', 'exec', container_name, 'mongo', '--quiet', '--eval', create_index],
+                                   check=True)
+                if checkpoint:
+                    checkpoint.record_import(progress_key, 0)
+                subprocess.run(command, check=True)
+                if checkpoint:
+                    checkpoint.record_import(progress_key, 0, done=True)
             except subprocess.CalledProcessError as e:
                 logger.error(f"Error importing {collection} to {container_name}: {e}")
 
-def refresh_file_mapping():
+class NativeMongoImporter:
+    """
+    Import split JSONL files straight into MongoDB with pymongo.
+    Each collection is streamed in unordered insert_many batches spread over
+    a pool of worker threads; indexes are built after the data is loaded.
+    """
+
+    def __init__(self,
+                 batch_size: int = DEFAULT_IMPORT_BATCH_SIZE,
+                 workers: int = DEFAULT_IMPORT_WORKERS,
+                 compression: Optional[str] = None):
+        self.batch_size = batch_size
+        self.workers = workers
+        self.compression = compression
+
+    def file_name(self, db_key: str, collection: str) -> str:
+        """Split output file of a collection; the file mapping is never compressed."""
+        if collection == 'mapping':
+            return f"{OUTPUT_PATHS[db_key]}/file_map.jsonl"
+        return f"{OUTPUT_PATHS[db_key]}/{collection}.jsonl{COMPRESSION_SUFFIXES[self.compression]}"
+
+    def read_batches(self, file_name: str, skip_lines: int = 0) -> Iterator[Tuple[int, List[dict]]]:
+        """
+        Parse a JSONL file into lists of at most batch_size documents.
+        Yields each batch with the number of the last input line it covers.
+        """
+        batch = []
+        line_num = skip_lines
+        with open_jsonl(file_name) as file:
+            for line_num, line in enumerate(file, 1):
+                if line_num <= skip_lines or not line.strip():
+                    continue
+                try:
+                    batch.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    logger.error(f"Error parsing JSON at line {line_num} of {file_name}: {e}")
+                    continue
+                if len(batch) >= self.batch_size:
+                    yield line_num, batch
+                    batch = []
+        if batch:
+            yield line_num, batch
+
+    @staticmethod
+    def insert_batch(collection, documents: List[dict]) -> int:
+        """Insert one batch, tolerating documents rejected by the server."""
+        try:
+            return len(collection.insert_many(documents, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            logger.error(f"{len(e.details['writeErrors'])} documents rejected by {collection.full_name}")
+            return e.details['nInserted']
+
+    @staticmethod
+    def upsert_batch(collection, documents: List[dict], key: str) -> int:
+        """Replace-or-insert one batch on its natural key, so replaying it is harmless."""
+        operations = [ReplaceOne({key: document[key]}, document, upsert=True) for document in documents]
+        try:
+            result = collection.bulk_write(operations, ordered=False)
+            return result.upserted_count + result.matched_count
+        except BulkWriteError as e:
+            logger.error(f"{len(e.details['writeErrors'])} documents rejected by {collection.full_name}")
+            return e.details['nUpserted'] + e.details['nMatched']
+
+    def import_collection(self,
+                          client: MongoClient,
+                          file_name: str,
+                          db_name: str,
+                          coll_name: str,
+                          checkpoint: Optional[PipelineCheckpoint] = None,
+                          progress_key: Optional[str] = None,
+                          upsert_key: Optional[str] = None) -> int:
+        """
+        Stream one JSONL file into a collection. Returns the number of rows written.
+        With a checkpoint, the last input line of the completed batch prefix is
+        recorded as batches finish. A resumed import skips those lines and
+        upserts the rest on `upsert_key`, since later batches may have been
+        partially inserted before the interruption.
+        """
+        collection = client[db_name][coll_name]
+        progress = checkpoint.import_progress(progress_key) if checkpoint else None
+        if progress and progress['done']:
+            logger.info(f"Skipping {db_name}.{coll_name} for {progress_key}: already imported")
+            return 0
+        skip_lines = progress['line'] if progress else 0
+        resuming = progress is not None and upsert_key is not None
+        if resuming:
+            # Indexes are otherwise built after the load; without the key index
+            # every upsert scans the partially loaded collection
+            collection.create_indexes([upsert_index((db_name, coll_name), upsert_key)])
+        if checkpoint:
+            checkpoint.record_import(progress_key, skip_lines)
+
+        written = 0
+        # Batch sequence number -> last input line, for batches not yet committed
+        finished: Dict[int, int] = {}
+        next_to_commit = 0
+
+        def collect(futures) -> None:
+            nonlocal written, next_to_commit
+            for future in futures:
+                sequence, end_line, future_rows = future.result()
+                written += future_rows
+                finished[sequence] = end_line
+            committed_line = None
+            while next_to_commit in finished:
+                committed_line = finished.pop(next_to_commit)
+                next_to_commit += 1
+            if checkpoint and committed_line is not None:
+                checkpoint.record_import(progress_key, committed_line)
+
+        def write(sequence: int, end_line: int, batch: List[dict]) -> Tuple[int, int, int]:
+            if resuming:
+                return sequence, end_line, self.upsert_batch(collection, batch, upsert_key)
+            return sequence, end_line, self.insert_batch(collection, batch)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = set()
+            for sequence, (end_line, batch) in enumerate(self.read_batches(file_name, skip_lines)):
+                # Bound the batches held in memory to two per worker
+                if len(pending) >= self.workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(executor.submit(write, sequence, end_line, batch))
+            collect(pending)
+
+        if checkpoint:
+            progress = checkpoint.import_progress(progress_key)
+            checkpoint.record_import(progress_key, progress['line'], done=True)
+        return written
+
+    def import_data(self,
+                    target: str,
+                    host: str,
+                    port: int,
+                    db_key: str,
+                    checkpoint: Optional[PipelineCheckpoint] = None) -> Dict[str, Dict[str, float]]:
+        """Import every split collection into one mongod and report rows/sec per collection."""
+        logger.info(f"Loading data for {target} ({host}:{port}) from {OUTPUT_PATHS[db_key]}")
+        client = MongoClient(host=host, port=port)
+        stats = {}
+        try:
+            for collection, (db_name, coll_name) in IMPORT_COLLECTIONS.items():
+                started = time.perf_counter()
+                rows = self.import_collection(
+                    client, self.file_name(db_key, collection), db_name, coll_name,
+                    checkpoint, f"import:{target}:{collection}", UPSERT_KEYS[collection]
+                )
+                elapsed = time.perf_counter() - started
+                stats[collection] = {
+                    'rows': rows,
+                    'seconds': round(elapsed, 3),
+                    'rows_per_sec': round(rows / elapsed) if elapsed else rows,
+                }
+                logger.info(f"{target}: {db_name}.{coll_name} {rows} rows in {elapsed:.1f}s "
+                            f"({stats[collection]['rows_per_sec']} rows/sec)")
+
+            build_indexes(target, client, checkpoint)
+        finally:
+            client.close()
+        return stats
+
+def build_indexes(target: str, client: MongoClient, checkpoint: Optional[PipelineCheckpoint] = None) -> None:
+    """Apply the index spec of indexes.py once a node is loaded, so inserts do not maintain them."""
+    if checkpoint and checkpoint.is_done(f"indexes:{target}"):
+        return
+    started = time.perf_counter()
+    created = apply_indexes(client)
+    logger.info(f"{target}: {len(created)} indexes built in {time.perf_counter() - started:.1f}s")
+    if checkpoint:
+        checkpoint.mark_done(f"indexes:{target}")
+
+def parse_targets(spec: str) -> Dict[str, Tuple[str, int, str]]:
+    """Parse 'host:port=db1,host:port=db2' into native import targets."""
+    targets = {}
+    for item in spec.split(','):
+        address, db_key = item.strip().split('=')
+        host, port = address.rsplit(':', 1)
+        if db_key not in OUTPUT_PATHS:
+            raise ValueError(f"Unknown split output {db_key} for target {address}")
+        targets[address] = (host, int(port), db_key)
+    return targets
+
+def refresh_file_mapping(buffer_size: int = DEFAULT_WRITE_BUFFER_SIZE):
     """Update file mapping data for both databases."""
     try:
         with open("backend/mapping_results.txt", 'r') as f:
@@ -170,36 +780,121 @@ def refresh_file_mapping():
             ]
         
         for path in OUTPUT_PATHS.values():
-            JsonlHandler.dump(mapping, f"{path}/file_map.jsonl")
+            JsonlHandler.dump(mapping, f"{path}/file_map.jsonl", buffer_size)
     except (FileNotFoundError, IndexError) as e:
         logger.error(f"Error processing mapping file: {e}")
         raise
 
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Split generated data and load it into MongoDB")
+    parser.add_argument("--split-workers", type=int, default=os.cpu_count() or 1,
+                        help="processes used to split read.dat; 1 splits it sequentially")
+    parser.add_argument("--write-buffer-size", type=int, default=DEFAULT_WRITE_BUFFER_SIZE,
+                        help="bytes buffered per output file before each write")
+    parser.add_argument("--user-index", default=DEFAULT_USER_INDEX_PATH,
+                        help="file the uid -> region index is persisted to")
+    parser.add_argument("--reuse-user-index", action="store_true",
+                        help="skip the user split and route reads with the persisted user index")
+    parser.add_argument("--importer", choices=["docker", "native"], default="docker",
+                        help="docker runs mongoimport in each container; native inserts with pymongo")
+    parser.add_argument("--targets",
+                        help="native importer targets as host:port=db1,host:port=db2, also the nodes "
+                             "indexed after a docker import (default: the four compose mongods on localhost)")
+    parser.add_argument("--import-batch-size", type=int, default=DEFAULT_IMPORT_BATCH_SIZE,
+                        help="documents per insert_many in the native importer")
+    parser.add_argument("--import-workers", type=int, default=DEFAULT_IMPORT_WORKERS,
+                        help="concurrent insert_many batches per collection in the native importer")
+    parser.add_argument("--compression", choices=["gzip", "zstd"],
+                        help="compress split output files (native importer only)")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT_PATH,
+                        help="file recording pipeline progress")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip work recorded as finished in the checkpoint and resume partial imports")
+    args = parser.parse_args()
+    if args.compression and args.importer == "docker":
+        parser.error("mongoimport reads plain JSONL only; use --importer native with --compression")
+    return args
+
+def import_native(args: argparse.Namespace, checkpoint: Optional[PipelineCheckpoint] = None) -> None:
+    """Load the split files into every target in parallel with the native importer."""
+    targets = parse_targets(args.targets) if args.targets else NATIVE_TARGETS
+    importer = NativeMongoImporter(args.import_batch_size, args.import_workers, args.compression)
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = {
+            target: executor.submit(importer.import_data, target, *address, checkpoint)
+            for target, address in targets.items()
+        }
+        report = {target: future.result() for target, future in futures.items()}
+    logger.info(f"Native import report: {json.dumps(report)}")
+
+def distribute(args: argparse.Namespace, checkpoint: PipelineCheckpoint) -> None:
+    """Split the generated data files, skipping stages the checkpoint records as done."""
+    distributor = DataDistributor(args.write_buffer_size, args.compression, args.user_index)
+    reuse_users = args.reuse_user_index or checkpoint.is_done('users')
+    stages = {'article': 'articles', 'read': 'reads'}
+    if not reuse_users:
+        stages['user'] = 'users'
+    try:
+        distributor.setup_output_files(tuple(
+            collection for collection, stage in stages.items() if not checkpoint.is_done(stage)
+        ))
+        if reuse_users:
+            distributor.load_user_index()
+        else:
+            distributor.distribute_user_data()
+            distributor.close_collection('user')
+            checkpoint.mark_done('users')
+
+        if not checkpoint.is_done('articles'):
+            distributor.distribute_article_data()
+            distributor.close_collection('article')
+            checkpoint.mark_done('articles')
+
+        if not checkpoint.is_done('reads'):
+            if args.split_workers > 1:
+                distributor.distribute_read_data_parallel(args.split_workers, checkpoint)
+            else:
+                distributor.distribute_read_data()
+                distributor.close_collection('read')
+            checkpoint.mark_done('reads')
+    finally:
+        distributor.close_files()
+
 def main():
+    args = parse_args()
     try:
         logger.info("Starting bulk data load process")
         sleep(10)  # Wait for MongoDB containers to be ready
-        
-        refresh_file_mapping()
-        
-        distributor = DataDistributor()
-        try:
-            distributor.setup_output_files()
-            distributor.distribute_user_data()
-            distributor.distribute_article_data()
-            distributor.distribute_read_data()
-        finally:
-            distributor.close_files()
-        
+
+        checkpoint = PipelineCheckpoint(args.checkpoint, args.resume)
+        if not checkpoint.is_done('mapping'):
+            refresh_file_mapping(args.write_buffer_size)
+            checkpoint.mark_done('mapping')
+
+        distribute(args, checkpoint)
+
+        if args.importer == "native":
+            import_native(args, checkpoint)
+            logger.info("Bulk data load completed successfully")
+            return
+
         mongo_containers = sorted(
             DockerHelper.get_container_names(prefix="ddbs_mongo_"),
             key=lambda x: len(x)
         )
-        
+
         # Use ThreadPoolExecutor for parallel data import
         with ThreadPoolExecutor(max_workers=len(mongo_containers)) as executor:
-            executor.map(MongoImporter.import_data, mongo_containers)
-        
+            list(executor.map(lambda name: MongoImporter.import_data(name, checkpoint), mongo_containers))
+
+        # mongoimport leaves the collections unindexed; reach the nodes through their published ports
+        for target, (host, port, _) in (parse_targets(args.targets) if args.targets else NATIVE_TARGETS).items():
+            client = MongoClient(host=host, port=port)
+            try:
+                build_indexes(target, client, checkpoint)
+            finally:
+                client.close()
+
         logger.info("Bulk data load completed successfully")
     
     except Exception as e:
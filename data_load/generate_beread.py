@@ -1,111 +1,632 @@
-from pymongo import MongoClient
+import argparse
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from pymongo import MongoClient, InsertOne, ReplaceOne, UpdateOne, ASCENDING, DESCENDING
 from tqdm import tqdm
 import datetime
-from typing import List, Dict, Any
+from bson import ObjectId
+from typing import List, Dict, Any, Iterable, Iterator, Tuple, Optional
+
+from indexes import apply_indexes
+
+# Number of write operations sent per bulk_write call
+BULK_BATCH_SIZE = 1000
+
+# Number of new read records applied per incremental step
+INCREMENTAL_CHUNK_SIZE = 10000
+
+# Read _ids are ObjectIds, which are only ordered by the second they were
+# created in: within a second, or across writers whose clocks disagree, a
+# smaller _id can be inserted after a larger one. High-water marks therefore
+# only advance over _ids created at least this many seconds ago, assuming
+# every writer's clock is within this bound and its inserts land within it.
+SETTLE_SECONDS = 5
+
+# Reads kept per beread_bucket document; the reads of an article on one
+# day spill over into further buckets once one is full
+BUCKET_SIZE = 1000
+
+# Keys of the last incremental chunks applied to a beread summary or bucket,
+# kept so that a chunk replayed after an interrupted run skips what it wrote
+APPLIED_CHUNKS_KEPT = 8
+
+# Counter fields of a beread summary document and list fields of a beread bucket
+COUNTER_FIELDS = ["readNum", "commentNum", "agreeNum", "shareNum"]
+LIST_FIELDS = ["timestamp", "readUidList", "commentUidList", "agreeUidList", "shareUidList"]
+
+# Interaction flag of a read record, with the counter and uid list it feeds
+INTERACTIONS = [
+    ("commentOrNot", "commentNum", "commentUidList"),
+    ("agreeOrNot", "agreeNum", "agreeUidList"),
+    ("shareOrNot", "shareNum", "shareUidList"),
+]
+
+# Fields needed from history.read to build beread documents
+READ_PROJECTION = {
+    "_id": 1,
+    "aid": 1,
+    "uid": 1,
+    "timestamp": 1,
+    "commentOrNot": 1,
+    "agreeOrNot": 1,
+    "shareOrNot": 1,
+}
+
+# (host, port) of db1 and db2, for the primary and the backup pair
+MONGO_NODES = [
+    [("ddbs_mongo_1", 27017), ("ddbs_mongo_2", 27017)],
+    [("ddbs_mongo_1_bak", 27017), ("ddbs_mongo_2_bak", 27017)],
+]
+PAIR_NAMES = ["primary", "backup"]
+
+# Aid ranges per worker process in parallel bulk mode; more ranges than
+# workers keep every process busy when popular articles skew the ranges
+PARTITIONS_PER_WORKER = 4
 
 def get_mongo_clients() -> List[List[MongoClient]]:
     """Initialize and return MongoDB client connections."""
-    return [
-        [
-            MongoClient(host="ddbs_mongo_1", port=27017),
-            MongoClient(host="ddbs_mongo_2", port=27017),
-        ],
-        [
-            MongoClient(host="ddbs_mongo_1_bak", port=27017),
-            MongoClient(host="ddbs_mongo_2_bak", port=27017),
-        ]
-    ]
+    return [[MongoClient(host=host, port=port) for host, port in pair] for pair in MONGO_NODES]
+
+def run_pairs(function, clients: List[List[MongoClient]], *args) -> List[Any]:
+    """
+    Run function(db1_client, db2_client, *args) on every pair at once, one
+    thread per pair, and report how long each took. Returns the results
+    in pair order.
+    """
+    def timed(name, pair):
+        started = time.perf_counter()
+        result = function(*pair, *args)
+        print(f"{name} pair done in {time.perf_counter() - started:.1f}s")
+        return result
+
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        futures = [executor.submit(timed, name, pair) for name, pair in zip(PAIR_NAMES, clients)]
+        return [future.result() for future in futures]
 
 def create_indexes(clients: List[List[MongoClient]]) -> None:
-    """Create necessary indexes on MongoDB collections."""
+    """Apply the read and beread indexes of the index spec to every node."""
     for db1_client, db2_client in clients:
-        db1_client.history.read.create_index([("aid", 1)])
-        db2_client.history.read.create_index([("aid", 1)])
+        for client in (db1_client, db2_client):
+            apply_indexes(client, [("history", "read"), ("history", "beread"), ("history", "beread_bucket")])
+
+def read_day(timestamp: datetime.datetime) -> datetime.datetime:
+    """Midnight of a read time: the day of the bucket the read is kept in."""
+    return datetime.datetime(timestamp.year, timestamp.month, timestamp.day)
+
+def process_read_record(read_record: Dict[str, Any], beread: Dict[str, Any]) -> None:
+    """Count a single read record and keep it for the bucket of its day."""
+    # Keep the read time as a native date; like the ISO strings stored
+    # previously, the naive local time is interpreted as UTC by MongoDB
+    timestamp = datetime.datetime.fromtimestamp(
+        int(read_record["timestamp"]) / 1000
+    )
+    interactions = tuple(bool(int(read_record[flag])) for flag, _, _ in INTERACTIONS)
+
+    # Update read and interaction counters
+    beread["readNum"] += 1
+    for interacted, (_, counter, _) in zip(interactions, INTERACTIONS):
+        if interacted:
+            beread[counter] += 1
+
+    beread["days"].setdefault(read_day(timestamp), []).append((timestamp, read_record["uid"], interactions))
 
 def process_read_records(read_records, beread: Dict[str, Any]) -> None:
     """Process read records and update beread statistics."""
     for read_record in read_records:
-        # Convert timestamp to ISO format
-        timestamp = datetime.datetime.fromtimestamp(
-            int(read_record["timestamp"]) / 1000
-        ).isoformat()
-        
-        # Update basic read statistics
-        beread["timestamp"].append(timestamp)
-        beread["readNum"] += 1
-        beread["readUidList"].append(read_record["uid"])
-        
-        # Update interaction statistics
-        if int(read_record["commentOrNot"]):
-            beread["commentNum"] += 1
-            beread["commentUidList"].append(read_record["uid"])
-        if int(read_record["agreeOrNot"]):
-            beread["agreeNum"] += 1
-            beread["agreeUidList"].append(read_record["uid"])
-        if int(read_record["shareOrNot"]):
-            beread["shareNum"] += 1
-            beread["shareUidList"].append(read_record["uid"])
+        process_read_record(read_record, beread)
 
 def initialize_beread(article: Dict[str, Any]) -> Dict[str, Any]:
-    """Initialize beread dictionary with default values."""
+    """
+    Initialize beread dictionary with default values. Reads are collected
+    per day under "days" until they are written as buckets.
+    """
     return {
         "id": article["id"],
-        "timestamp": list(),
         "aid": article["aid"],
         "readNum": 0,
-        "readUidList": list(),
         "commentNum": 0,
-        "commentUidList": list(),
         "agreeNum": 0,
-        "agreeUidList": list(),
         "shareNum": 0,
-        "shareUidList": list(),
+        "days": dict(),
+    }
+
+def summary_document(beread: Dict[str, Any]) -> Dict[str, Any]:
+    """The history.beread document of an article: its counters, without its reads."""
+    return {field: value for field, value in beread.items() if field != "days"}
+
+def bucket_fields(reads: List[Tuple[datetime.datetime, str, Tuple[bool, ...]]]) -> Dict[str, Any]:
+    """Read count, timestamps and uid lists of a run of (timestamp, uid, interactions) reads."""
+    fields = {
+        "count": len(reads),
+        "timestamp": [timestamp for timestamp, _, _ in reads],
+        "readUidList": [uid for _, uid, _ in reads],
     }
+    for i, (_, _, uid_list) in enumerate(INTERACTIONS):
+        fields[uid_list] = [uid for _, uid, interactions in reads if interactions[i]]
+    return fields
+
+def bucket_documents(beread: Dict[str, Any], bucket_size: int = BUCKET_SIZE) -> Iterator[Dict[str, Any]]:
+    """history.beread_bucket documents of an article: its reads of each day, `bucket_size` at most per document."""
+    for day, reads in sorted(beread["days"].items()):
+        for start in range(0, len(reads), bucket_size):
+            yield {"aid": beread["aid"], "day": day, **bucket_fields(reads[start:start + bucket_size])}
 
-def update_beread_collections(db1_client: MongoClient, 
-                            db2_client: MongoClient, 
-                            beread: Dict[str, Any], 
+def beread_sites(category: str) -> List[str]:
+    """db2 holds the beread of every article, db1 only of science articles."""
+    return ["db2", "db1"] if category == "science" else ["db2"]
+
+def update_beread_collections(db1_client: MongoClient,
+                            db2_client: MongoClient,
+                            beread: Dict[str, Any],
                             aid: str,
                             category: str) -> None:
-    """Update beread collections in MongoDB."""
-    # Always update db2
-    db2_client.history.beread.update_one(
-        {"aid": aid},
-        {"$set": beread},
+    """Replace the beread summary and buckets of one article in MongoDB."""
+    buckets = list(bucket_documents(beread))
+    clients = {"db1": db1_client, "db2": db2_client}
+    for site in beread_sites(category):
+        client = clients[site]
+        client.history.beread.replace_one({"aid": aid}, summary_document(beread), upsert=True)
+        client.history.beread_bucket.delete_many({"aid": aid})
+        if buckets:
+            client.history.beread_bucket.insert_many([dict(bucket) for bucket in buckets])
+
+def load_high_water_mark(state_client: MongoClient,
+                         source: str,
+                         state_collection: str = "beread_state") -> Optional[Any]:
+    """Return the _id of the last read record of `source` already applied to beread."""
+    state = state_client.history[state_collection].find_one({"_id": source})
+    return state.get("lastReadId") if state else None
+
+def load_pending_chunk(state_client: MongoClient,
+                       source: str,
+                       state_collection: str = "beread_state") -> Optional[Dict[str, Any]]:
+    """Return the chunk of `source` that was being applied when a run stopped, if any."""
+    state = state_client.history[state_collection].find_one({"_id": source})
+    return state.get("pending") if state else None
+
+def save_pending_chunk(state_client: MongoClient,
+                       source: str,
+                       chunk: Dict[str, Any],
+                       state_collection: str = "beread_state") -> None:
+    """
+    Record the chunk of `source` about to be applied: the _id of its last
+    read, and whatever else a replay needs. save_high_water_mark clears it.
+    """
+    state_client.history[state_collection].update_one(
+        {"_id": source},
+        {"$set": {"pending": chunk, "updatedAt": datetime.datetime.utcnow()}},
+        upsert=True
+    )
+
+def save_high_water_mark(state_client: MongoClient,
+                         source: str,
+                         last_read_id: Optional[Any],
+                         state_collection: str = "beread_state") -> None:
+    """Store the _id of the last read record of `source` applied to beread."""
+    if last_read_id is None:
+        return
+    state_client.history[state_collection].update_one(
+        {"_id": source},
+        {"$set": {"lastReadId": last_read_id, "updatedAt": datetime.datetime.utcnow()},
+         "$unset": {"pending": ""}},
         upsert=True
     )
-    
-    # Update db1 only for science category
-    if category == "science":
-        db1_client.history.beread.update_one(
-            {"aid": aid},
-            {"$set": beread},
+
+def latest_read_id(client: MongoClient, before: Optional[ObjectId] = None) -> Optional[Any]:
+    """Return the largest _id currently in history.read, or the largest below `before`."""
+    query = {} if before is None else {"_id": {"$lt": before}}
+    latest = client.history.read.find_one(query, {"_id": 1}, sort=[("_id", DESCENDING)])
+    return latest["_id"] if latest else None
+
+def read_cutoff(settle_seconds: float = SETTLE_SECONDS, wait: bool = False) -> ObjectId:
+    """
+    Return an _id below which history.read no longer changes: the _id of
+    `settle_seconds` ago. With `wait`, the bound is the end of the current
+    second and the call sleeps until it has settled instead, so a full
+    build still covers every read inserted before it started.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if wait:
+        cutoff = ObjectId.from_datetime(now + datetime.timedelta(seconds=1))
+        time.sleep((cutoff.generation_time - now).total_seconds() + settle_seconds)
+        return cutoff
+    return ObjectId.from_datetime(now - datetime.timedelta(seconds=settle_seconds))
+
+def build_beread_documents(db1_client: MongoClient,
+                           db2_client: MongoClient,
+                           query: Optional[Dict[str, Any]] = None,
+                           progress: bool = True,
+                           cutoff: Optional[ObjectId] = None) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, str], Dict[str, Any]]:
+    """
+    Build every beread document by streaming each history.read collection once.
+    `query` restricts both articles and reads, e.g. to an aid range, and
+    only reads with an _id below `cutoff` are streamed.
+    Returns beread documents and article categories, both keyed by aid,
+    and the last read _id consumed per source database.
+    """
+    query = query or {}
+    read_query = query if cutoff is None else dict(query, _id={"$lt": cutoff})
+    bereads = {}
+    last_read_ids = {}
+    categories = {}
+    for article in db2_client.info.article.find(query, {"_id": 0, "id": 1, "aid": 1, "category": 1}):
+        bereads[article["aid"]] = initialize_beread(article)
+        categories[article["aid"]] = article["category"]
+
+    # db1 is streamed before db2 so per-article ordering matches the per-article mode
+    for name, client in (("db1", db1_client), ("db2", db2_client)):
+        cursor = client.history.read.find(read_query, READ_PROJECTION, batch_size=BULK_BATCH_SIZE)
+        last_read_id = None
+        for read_record in tqdm(cursor, desc=f"Streaming {name} reads", disable=not progress):
+            if last_read_id is None or read_record["_id"] > last_read_id:
+                last_read_id = read_record["_id"]
+            beread = bereads.get(read_record["aid"])
+            if beread is not None:
+                process_read_record(read_record, beread)
+        last_read_ids[name] = last_read_id
+
+    return bereads, categories, last_read_ids
+
+def _flush(collection, operations: List[UpdateOne]) -> None:
+    """Send pending operations in one unordered bulk_write and clear the buffer."""
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+        operations.clear()
+
+def _flush_all(clients: Dict[str, MongoClient],
+               operations: Dict[Tuple[str, str], List[Any]],
+               batch_size: int = 0) -> None:
+    """Flush the buffers of (site, collection) holding at least `batch_size` operations."""
+    for (site, collection), pending in operations.items():
+        if len(pending) >= batch_size:
+            _flush(clients[site].history[collection], pending)
+
+def reset_buckets(client: MongoClient) -> None:
+    """Empty history.beread_bucket before a rebuild; dropping beats deleting every bucket."""
+    client.history.beread_bucket.drop()
+    apply_indexes(client, [("history", "beread_bucket")])
+
+def write_beread_collections(db1_client: MongoClient,
+                             db2_client: MongoClient,
+                             bereads: Iterable[Dict[str, Any]],
+                             categories: Dict[str, str],
+                             batch_size: int = BULK_BATCH_SIZE,
+                             progress: bool = True) -> None:
+    """
+    Write beread summaries and buckets with batched bulk_write, routed like
+    update_beread_collections. Buckets are inserted, so the bucket
+    collections must be empty (see reset_buckets).
+    """
+    clients = {"db1": db1_client, "db2": db2_client}
+    operations = {(site, collection): [] for site in clients for collection in ("beread", "beread_bucket")}
+    for beread in tqdm(bereads, desc="Writing beread", disable=not progress):
+        aid = beread["aid"]
+        # Replacing drops the uid and timestamp lists of summaries written before buckets
+        summary = ReplaceOne({"aid": aid}, summary_document(beread), upsert=True)
+        buckets = [InsertOne(bucket) for bucket in bucket_documents(beread)]
+
+        for site in beread_sites(categories[aid]):
+            operations[(site, "beread")].append(summary)
+            operations[(site, "beread_bucket")].extend(buckets)
+        _flush_all(clients, operations, batch_size)
+
+    _flush_all(clients, operations)
+
+def build_beread_increments(read_records: Iterable[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Fold new read records into partial beread documents keyed by aid."""
+    increments = {}
+    for read_record in read_records:
+        aid = read_record["aid"]
+        if aid not in increments:
+            increments[aid] = initialize_beread({"id": None, "aid": aid})
+        process_read_record(read_record, increments[aid])
+    return increments
+
+def beread_increment_operations(increment: Dict[str, Any],
+                                article: Dict[str, Any],
+                                chunk: str,
+                                bucket_size: int = BUCKET_SIZE) -> Tuple[UpdateOne, Dict[str, UpdateOne]]:
+    """
+    Build the upserts adding a partial beread document: $inc of the summary
+    counters, and a $push of each day's new reads into a bucket of that day
+    with room for all of them. When no bucket has room, a new one is created.
+    Each write records its key in appliedChunks: `chunk` for the summary,
+    `chunk`/n for the article's n-th bucket write, which is how the bucket
+    writes are returned.
+    """
+    def applied(key):
+        return {"$each": [key], "$slice": -APPLIED_CHUNKS_KEPT}
+
+    summary = UpdateOne(
+        {"aid": article["aid"]},
+        {
+            "$inc": {field: increment[field] for field in COUNTER_FIELDS},
+            "$push": {"appliedChunks": applied(chunk)},
+            "$setOnInsert": {"id": article["id"]},
+        },
+        upsert=True
+    )
+    buckets = {}
+    for part, bucket in enumerate(bucket_documents(increment, bucket_size)):
+        key = f"{chunk}/{part}"
+        push = {field: {"$each": bucket[field]} for field in LIST_FIELDS if bucket[field]}
+        push["appliedChunks"] = applied(key)
+        update = {"$inc": {"count": bucket["count"]}, "$push": push}
+        # Lists with nothing to push still exist on newly created buckets
+        empty = {field: [] for field in LIST_FIELDS if not bucket[field]}
+        if empty:
+            update["$setOnInsert"] = empty
+        buckets[key] = UpdateOne(
+            {"aid": article["aid"], "day": bucket["day"], "count": {"$lte": bucket_size - bucket["count"]}},
+            update,
             upsert=True
         )
+    return summary, buckets
+
+def applied_chunk_writes(client: MongoClient, aids: List[str], chunk: str) -> set:
+    """(aid, key) of the writes of `chunk` that already reached a site's beread summaries and buckets."""
+    applied = set()
+    pattern = re.compile(f"^{re.escape(chunk)}(/|$)")
+    for collection in ("beread", "beread_bucket"):
+        for document in client.history[collection].find(
+            {"aid": {"$in": aids}, "appliedChunks": pattern}, {"_id": 0, "aid": 1, "appliedChunks": 1}
+        ):
+            applied.update((document["aid"], key) for key in document["appliedChunks"] if pattern.match(key))
+    return applied
+
+def apply_read_increments(db1_client: MongoClient,
+                          db2_client: MongoClient,
+                          read_records: List[Dict[str, Any]],
+                          chunk: str,
+                          replay: bool = False) -> None:
+    """
+    Apply a chunk of new read records to beread, routed like
+    update_beread_collections. `chunk` names the chunk; a `replay` of a
+    chunk interrupted earlier skips the writes that already landed on
+    each site.
+    """
+    increments = build_beread_increments(read_records)
+    articles = db2_client.info.article.find(
+        {"aid": {"$in": list(increments)}},
+        {"_id": 0, "id": 1, "aid": 1, "category": 1}
+    )
+
+    clients = {"db1": db1_client, "db2": db2_client}
+    applied = {
+        site: applied_chunk_writes(client, list(increments), chunk) if replay else set()
+        for site, client in clients.items()
+    }
+    operations = {(site, collection): [] for site in clients for collection in ("beread", "beread_bucket")}
+    for article in articles:
+        aid = article["aid"]
+        summary, buckets = beread_increment_operations(increments[aid], article, chunk)
+        for site in beread_sites(article["category"]):
+            if (aid, chunk) not in applied[site]:
+                operations[(site, "beread")].append(summary)
+            operations[(site, "beread_bucket")].extend(
+                bucket for key, bucket in buckets.items() if (aid, key) not in applied[site]
+            )
+
+    _flush_all(clients, operations)
+
+def generate_incremental(db1_client: MongoClient,
+                         db2_client: MongoClient,
+                         chunk_size: int = INCREMENTAL_CHUNK_SIZE,
+                         settle_seconds: float = SETTLE_SECONDS) -> int:
+    """
+    Apply read records inserted since the stored high-water mark to beread.
+    Reads younger than `settle_seconds` are left to the next run. Each
+    chunk is recorded as pending before it is written and the mark
+    advances once it is, so an interrupted run replays the same chunk,
+    skipping the writes that landed, and no read is counted twice.
+    Returns the number of reads applied.
+    """
+    applied = 0
+    cutoff = read_cutoff(settle_seconds)
+    for name, client in (("db1", db1_client), ("db2", db2_client)):
+        last_read_id = load_high_water_mark(db2_client, name)
+        pending = load_pending_chunk(db2_client, name)
+        while True:
+            query = {"_id": {"$lt": cutoff}}
+            if pending is not None:
+                query = {"_id": {"$lte": pending["lastReadId"]}}
+            if last_read_id is not None:
+                query["_id"]["$gt"] = last_read_id
+            read_records = list(
+                client.history.read.find(query, READ_PROJECTION)
+                .sort("_id", ASCENDING)
+                .limit(0 if pending is not None else chunk_size)
+            )
+            if not read_records and pending is not None:
+                # The reads of the pending chunk are gone; nothing is left to replay
+                last_read_id = pending["lastReadId"]
+                save_high_water_mark(db2_client, name, last_read_id)
+                pending = None
+                continue
+            if not read_records:
+                break
+
+            last_read_id = read_records[-1]["_id"]
+            if pending is None:
+                save_pending_chunk(db2_client, name, {"lastReadId": last_read_id})
+            apply_read_increments(db1_client, db2_client, read_records, f"{name}:{last_read_id}",
+                                  replay=pending is not None)
+            save_high_water_mark(db2_client, name, last_read_id)
+            pending = None
+            applied += len(read_records)
+    return applied
+
+def generate_per_article(db1_client: MongoClient,
+                         db2_client: MongoClient,
+                         settle_seconds: float = SETTLE_SECONDS) -> None:
+    """Generate beread data with one query per article and database."""
+    cutoff = read_cutoff(settle_seconds, wait=True)
+    query = {"_id": {"$lt": cutoff}}
+
+    # Process all articles with progress bar
+    for article in tqdm(db2_client.info.article.find({}), total=10000):
+        aid = article["aid"]
+        beread = initialize_beread(article)
+
+        # Process read records from both databases
+        process_read_records(db1_client.history.read.find(dict(query, aid=aid)), beread)
+        process_read_records(db2_client.history.read.find(dict(query, aid=aid)), beread)
+
+        # Update beread collections
+        update_beread_collections(
+            db1_client,
+            db2_client,
+            beread,
+            aid,
+            article["category"]
+        )
+
+    # Every read below the cutoff was consumed above
+    for name, client in (("db1", db1_client), ("db2", db2_client)):
+        save_high_water_mark(db2_client, name, latest_read_id(client, cutoff))
+
+def generate_bulk(db1_client: MongoClient,
+                  db2_client: MongoClient,
+                  batch_size: int = BULK_BATCH_SIZE,
+                  settle_seconds: float = SETTLE_SECONDS) -> None:
+    """Generate beread data from a single pass over each read collection."""
+    cutoff = read_cutoff(settle_seconds, wait=True)
+    bereads, categories, last_read_ids = build_beread_documents(db1_client, db2_client, cutoff=cutoff)
+    reset_buckets(db1_client)
+    reset_buckets(db2_client)
+    write_beread_collections(db1_client, db2_client, bereads.values(), categories, batch_size)
+
+    # Later incremental runs only apply reads inserted after this rebuild
+    for name, last_read_id in last_read_ids.items():
+        save_high_water_mark(db2_client, name, last_read_id)
+
+def aid_ranges(client: MongoClient, partitions: int) -> List[Tuple[str, str]]:
+    """Split the sorted aids of info.article into at most `partitions` contiguous (first, last) ranges."""
+    aids = sorted(article["aid"] for article in client.info.article.find({}, {"_id": 0, "aid": 1}))
+    size = max(1, -(-len(aids) // max(partitions, 1)))
+    return [(aids[start], aids[min(start + size, len(aids)) - 1]) for start in range(0, len(aids), size)]
+
+def _build_aid_range(nodes: List[Tuple[str, int]],
+                     aid_range: Tuple[str, str],
+                     batch_size: int,
+                     cutoff: ObjectId) -> Tuple[int, Dict[str, Any]]:
+    """
+    Worker process: build and write the beread of one aid range of a pair
+    from the reads below `cutoff`. Returns the number of reads applied and
+    the last read _id consumed per source.
+    """
+    db1_client, db2_client = (MongoClient(host=host, port=port) for host, port in nodes)
+    try:
+        first, last = aid_range
+        bereads, categories, last_read_ids = build_beread_documents(
+            db1_client, db2_client, {"aid": {"$gte": first, "$lte": last}}, progress=False, cutoff=cutoff)
+        write_beread_collections(db1_client, db2_client, bereads.values(), categories, batch_size, progress=False)
+        return sum(beread["readNum"] for beread in bereads.values()), last_read_ids
+    finally:
+        db1_client.close()
+        db2_client.close()
+
+def generate_bulk_parallel(nodes: List[List[Tuple[str, int]]],
+                           workers: int,
+                           partitions: Optional[int] = None,
+                           batch_size: int = BULK_BATCH_SIZE,
+                           settle_seconds: float = SETTLE_SECONDS) -> int:
+    """
+    Bulk-generate beread on every pair at once. The articles of each pair
+    are split into aid ranges, and `workers` processes build the ranges of
+    all pairs from one queue, all below the same read cutoff. A pair's
+    buckets are reset before its ranges are queued, and its high-water
+    marks are saved once all of them are written. Returns the number of
+    reads applied over all pairs.
+    """
+    cutoff = read_cutoff(settle_seconds, wait=True)
+    clients = [[MongoClient(host=host, port=port) for host, port in pair] for pair in nodes]
+    partitions = partitions or workers * PARTITIONS_PER_WORKER
+    last_read_ids = [{} for _ in nodes]
+    applied = 0
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for index, (pair, (db1_client, db2_client)) in enumerate(zip(nodes, clients)):
+            reset_buckets(db1_client)
+            reset_buckets(db2_client)
+            for aid_range in aid_ranges(db2_client, partitions):
+                futures[executor.submit(_build_aid_range, pair, aid_range, batch_size, cutoff)] = index
+
+        with tqdm(as_completed(futures), total=len(futures), desc="Building aid ranges") as progress:
+            for future in progress:
+                reads, range_read_ids = future.result()
+                applied += reads
+                pair_read_ids = last_read_ids[futures[future]]
+                for name, last_read_id in range_read_ids.items():
+                    if last_read_id is not None and (name not in pair_read_ids or last_read_id > pair_read_ids[name]):
+                        pair_read_ids[name] = last_read_id
+                progress.set_postfix(reads=applied, reads_per_s=int(applied / (time.perf_counter() - started)))
+
+    # Later incremental runs only apply reads inserted after this rebuild
+    for (_, db2_client), pair_read_ids in zip(clients, last_read_ids):
+        for name, last_read_id in pair_read_ids.items():
+            save_high_water_mark(db2_client, name, last_read_id)
+        db2_client.close()
+    for db1_client, _ in clients:
+        db1_client.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"Applied {applied} reads on {len(nodes)} pairs in {elapsed:.1f}s ({applied / elapsed:.0f} reads/s)")
+    return applied
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Generate history.beread summaries and buckets from history.read")
+    parser.add_argument("--mode", choices=["bulk", "per-article", "incremental"], default="bulk",
+                        help="bulk streams each read collection once; per-article queries reads per aid; "
+                             "incremental applies reads inserted since the last run")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="processes building aid ranges of both pairs in bulk mode; "
+                             "1 builds each pair on a thread of this process")
+    parser.add_argument("--partitions", type=int,
+                        help=f"aid ranges per pair in bulk mode (default: {PARTITIONS_PER_WORKER} per worker)")
+    parser.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE,
+                        help="number of writes per bulk_write in bulk mode")
+    parser.add_argument("--chunk-size", type=int, default=INCREMENTAL_CHUNK_SIZE,
+                        help="number of new reads applied per step in incremental mode")
+    parser.add_argument("--interval", type=float, default=0,
+                        help="in incremental mode, poll for new reads every INTERVAL seconds instead of exiting")
+    parser.add_argument("--settle-seconds", type=float, default=SETTLE_SECONDS,
+                        help="only consume reads whose _id is at least this old, so reads inserted late "
+                             "with a smaller _id are not skipped")
+    return parser.parse_args()
+
+def run_incremental(clients: List[List[MongoClient]],
+                    chunk_size: int,
+                    interval: float,
+                    settle_seconds: float = SETTLE_SECONDS) -> None:
+    """Apply new reads once, or periodically when an interval is given."""
+    while True:
+        for name, applied in zip(PAIR_NAMES, run_pairs(generate_incremental, clients, chunk_size, settle_seconds)):
+            print(f"Applied {applied} new reads to the {name} pair's beread")
+        if interval <= 0:
+            return
+        time.sleep(interval)
 
 def main():
     """Main function to generate beread data."""
+    args = parse_args()
     clients = get_mongo_clients()
     create_indexes(clients)
 
-    for db1_client, db2_client in clients:
-        # Process all articles with progress bar
-        for article in tqdm(db2_client.info.article.find({}), total=10000):
-            aid = article["aid"]
-            beread = initialize_beread(article)
-
-            # Process read records from both databases
-            process_read_records(db1_client.history.read.find({"aid": aid}), beread)
-            process_read_records(db2_client.history.read.find({"aid": aid}), beread)
-
-            # Update beread collections
-            update_beread_collections(
-                db1_client,
-                db2_client,
-                beread,
-                aid,
-                article["category"]
-            )
+    if args.mode == "incremental":
+        run_incremental(clients, args.chunk_size, args.interval, args.settle_seconds)
+        return
+
+    # Both pairs are built at once; bulk mode also splits articles across processes
+    if args.mode == "bulk" and args.workers > 1:
+        generate_bulk_parallel(MONGO_NODES, args.workers, args.partitions, args.batch_size, args.settle_seconds)
+    elif args.mode == "bulk":
+        run_pairs(generate_bulk, clients, args.batch_size, args.settle_seconds)
+    else:
+        run_pairs(generate_per_article, clients, args.settle_seconds)
 
 if __name__ == "__main__":
     main()
@@ -1,7 +1,30 @@
-from pymongo import MongoClient
-from datetime import datetime
+import argparse
+from collections import Counter
+from pymongo import MongoClient, UpdateOne, ASCENDING, DESCENDING
+from datetime import datetime, timedelta, timezone
 from bson.son import SON
 
+from indexes import apply_indexes
+from generate_beread import (APPLIED_CHUNKS_KEPT, load_high_water_mark, load_pending_chunk, read_cutoff, run_pairs,
+                             save_high_water_mark, save_pending_chunk)
+from article_previews import PREVIEW_BYTES, article_previews
+
+# Number of articles kept per rank document
+TOP_K = 5
+
+# Number of new read records counted per incremental step
+INCREMENTAL_CHUNK_SIZE = 10000
+
+GRANULARITIES = ["daily", "weekly", "monthly"]
+
+# Document of history.popular_rank_version bumped after every rank write;
+# the API drops its cached rank responses when the version changes
+RANK_VERSION_ID = "popular_rank"
+
+# Host previews are downloaded from when materializing ranks, in place of
+# the storage host named by file.mapping URLs
+DEFAULT_FETCH_HOST = "nginx"
+
 # MongoDB client configuration
 clients = [
     [
@@ -14,55 +37,51 @@ clients = [
     ]
 ]
 
-def get_daily_top_articles(client):
+def _bucket_date(date):
+    """Truncate a date expression to midnight UTC with native date operators."""
+    return {
+        '$dateFromParts': {
+            'year': {'$year': date},
+            'month': {'$month': date},
+            'day': {'$dayOfMonth': date}
+        }
+    }
+
+def _read_date_stages():
     """
-    Aggregates daily top 5 articles based on access count.
-    Returns sorted list of results by timestamp.
+    Day and read count of each beread bucket. A bucket only holds reads
+    of one day, so buckets are counted whole instead of unwinding their
+    timestamps.
     """
-    pipeline = [
-        # Convert timestamp strings to dates
-        {'$unwind': '$timestamp'},
-        {
-            '$addFields': {
-                'timestampDate': {
-                    '$dateFromString': {'dateString': '$timestamp'}
-                }
-            }
-        },
-        # Extract year and day
+    return [
         {
             '$project': {
-                'year': {'$year': '$timestampDate'},
-                'day': {'$dayOfYear': '$timestampDate'},
-                'aid': '$aid'
+                'aid': '$aid',
+                'timestampDate': '$day',
+                'reads': '$count'
             }
-        },
+        }
+    ]
+
+def _top_articles_stages(granularity):
+    """Count accesses per bucket and aid, then keep the top articles of each bucket."""
+    return [
         # Group and count accesses
         {
             '$group': {
                 '_id': {
-                    'year': '$year',
-                    'day': '$day',
+                    'date': '$date',
                     'aid': '$aid'
                 },
-                'accessCount': {'$sum': 1}
-            }
-        },
-        # Sort by year, day, and access count
-        {
-            '$sort': {
-                '_id.year': 1,
-                '_id.day': 1,
-                'accessCount': -1
+                'accessCount': {'$sum': '$reads'}
             }
         },
-        # Group articles by day
+        # Sort by bucket and access count
+        {'$sort': {'_id.date': 1, 'accessCount': -1}},
+        # Group articles by bucket
         {
             '$group': {
-                '_id': {
-                    'year': '$_id.year',
-                    'day': '$_id.day'
-                },
+                '_id': {'date': '$_id.date'},
                 'articles': {
                     '$push': {
                         'aid': '$_id.aid',
@@ -71,125 +90,108 @@ def get_daily_top_articles(client):
                 }
             }
         },
-        # Take top 5 articles
+        # Take top articles and convert the bucket date to milliseconds
         {
             '$project': {
-                'articles': {'$slice': ['$articles', 5]},
-                'year': '$_id.year',
-                'dayOfYear': '$_id.day'
+                'timestamp': {'$toLong': '$_id.date'},
+                'temporalGranularity': granularity,
+                'articleAidList': {'$slice': ['$articles.aid', TOP_K]},
+                'accessCountList': {'$slice': ['$articles.accessCount', TOP_K]}
             }
-        },
-        # Convert to proper date
-        {
-            '$addFields': {
-                'date': {
-                    '$function': {
-                        'body': 'function(year, dayOfYear) { return new Date(Date.UTC(year, 0, dayOfYear)); }',
-                        'args': ['$year', '$dayOfYear'],
-                        'lang': 'js'
-                    }
-                }
+        }
+    ]
+
+def _week_start(date):
+    """First day (Sunday) of the week containing a date expression."""
+    return {
+        '$subtract': [
+            date,
+            {
+                '$multiply': [
+                    {'$subtract': [{'$dayOfWeek': date}, 1]},
+                    86400000
+                ]
             }
-        },
-        # Final projection
+        ]
+    }
+
+def _bucket_expression(granularity, date):
+    """Start of the daily, weekly or monthly bucket containing a date expression."""
+    if granularity == 'daily':
+        return _bucket_date(date)
+    if granularity == 'weekly':
+        return _bucket_date(_week_start(date))
+    return {
+        '$dateFromParts': {
+            'year': {'$year': date},
+            'month': {'$month': date}
+        }
+    }
+
+def _granularity_pipeline(granularity):
+    return _read_date_stages() + [
         {
             '$project': {
-                'timestamp': {'$toLong': '$date'},
-                'temporalGranularity': 'daily',
-                'articleAidList': '$articles.aid'
+                'aid': '$aid',
+                'reads': '$reads',
+                'date': _bucket_expression(granularity, '$timestampDate')
             }
         }
-    ]
-    results = client.aggregate(pipeline, allowDiskUse=True)
-    return sorted(list(results), key=lambda x: x["timestamp"])
+    ] + _top_articles_stages(granularity)
 
-def get_weekly_top_articles(client):
+def daily_pipeline():
+    """Aggregation pipeline for daily top articles over beread."""
+    return _granularity_pipeline('daily')
+
+def weekly_pipeline():
+    """Aggregation pipeline for weekly top articles over beread."""
+    return _granularity_pipeline('weekly')
+
+def monthly_pipeline():
+    """Aggregation pipeline for monthly top articles over beread."""
+    return _granularity_pipeline('monthly')
+
+def all_granularities_pipeline():
     """
-    Aggregates weekly top 5 articles based on access count.
-    Returns sorted list of results by timestamp.
+    Single-scan pipeline for all granularities: the daily, weekly and
+    monthly bucket of each beread bucket is computed once, then $facet
+    ranks them from the same stream.
     """
-    pipeline = [
-        {'$unwind': '$timestamp'},
-        {
-            '$addFields': {
-                'timestampDate': {
-                    '$dateFromString': {'dateString': '$timestamp'}
-                }
-            }
-        },
-        # Calculate first day of week
-        {
-            '$addFields': {
-                'firstDayOfWeek': {
-                    '$subtract': [
-                        '$timestampDate',
-                        {
-                            '$multiply': [
-                                {'$subtract': [{'$dayOfWeek': '$timestampDate'}, 1]},
-                                86400000
-                            ]
-                        }
-                    ]
-                }
-            }
-        },
-        {
-            '$project': {
-                'year': {'$year': '$firstDayOfWeek'},
-                'day': {'$dayOfYear': '$firstDayOfWeek'},
-                'aid': '$aid'
-            }
-        },
-        # Rest of pipeline similar to daily
-        {
-            '$group': {
-                '_id': {
-                    'year': '$year',
-                    'day': '$day',
-                    'aid': '$aid'
-                },
-                'accessCount': {'$sum': 1}
-            }
-        },
-        {'$sort': {'_id.year': 1, '_id.day': 1, 'accessCount': -1}},
-        {
-            '$group': {
-                '_id': {'year': '$_id.year', 'day': '$_id.day'},
-                'articles': {
-                    '$push': {
-                        'aid': '$_id.aid',
-                        'accessCount': '$accessCount'
-                    }
-                }
-            }
-        },
+    return _read_date_stages() + [
         {
             '$project': {
-                'articles': {'$slice': ['$articles', 5]},
-                'year': '$_id.year',
-                'dayOfYear': '$_id.day'
-            }
-        },
-        {
-            '$addFields': {
-                'date': {
-                    '$function': {
-                        'body': 'function(year, dayOfYear) { return new Date(Date.UTC(year, 0, dayOfYear)); }',
-                        'args': ['$year', '$dayOfYear'],
-                        'lang': 'js'
-                    }
+                'aid': '$aid',
+                'reads': '$reads',
+                **{
+                    granularity: _bucket_expression(granularity, '$timestampDate')
+                    for granularity in GRANULARITIES
                 }
             }
         },
         {
-            '$project': {
-                'timestamp': {'$toLong': '$date'},
-                'temporalGranularity': 'weekly',
-                'articleAidList': '$articles.aid'
+            '$facet': {
+                granularity: [
+                    {'$project': {'aid': '$aid', 'reads': '$reads', 'date': '$' + granularity}}
+                ] + _top_articles_stages(granularity)
+                for granularity in GRANULARITIES
             }
         }
     ]
-    results = client.aggregate(pipeline)
+
+def get_daily_top_articles(client):
+    """
+    Aggregates daily top 5 articles based on access count.
+    Returns sorted list of results by timestamp.
+    """
+    results = client.aggregate(daily_pipeline(), allowDiskUse=True)
+    return sorted(list(results), key=lambda x: x["timestamp"])
+
+def get_weekly_top_articles(client):
+    """
+    Aggregates weekly top 5 articles based on access count.
+    Returns sorted list of results by timestamp.
+    """
+    results = client.aggregate(weekly_pipeline(), allowDiskUse=True)
     return sorted(list(results), key=lambda x: x["timestamp"])
 
 def get_monthly_top_articles(client):
@@ -197,97 +199,366 @@ def get_monthly_top_articles(client):
     Aggregates monthly top 5 articles based on access count.
     Returns sorted list of results by timestamp.
     """
-    pipeline = [
-        {'$unwind': '$timestamp'},
-        {
-            '$addFields': {
-                'timestampDate': {
-                    '$dateFromString': {'dateString': '$timestamp'}
-                }
-            }
-        },
-        {
-            '$project': {
-                'year': {'$year': '$timestampDate'},
-                'month': {'$month': '$timestampDate'},
-                'aid': '$aid'
-            }
-        },
-        {
-            '$group': {
-                '_id': {
-                    'year': '$year',
-                    'month': '$month',
-                    'aid': '$aid'
-                },
-                'accessCount': {'$sum': 1}
-            }
-        },
-        {'$sort': {'_id.year': 1, '_id.month': 1, 'accessCount': -1}},
-        {
-            '$group': {
-                '_id': {'year': '$_id.year', 'month': '$_id.month'},
-                'articles': {
-                    '$push': {
-                        'aid': '$_id.aid',
-                        'accessCount': '$accessCount'
-                    }
-                }
-            }
-        },
-        {
-            '$project': {
-                'articles': {'$slice': ['$articles', 5]},
-                'year': '$_id.year',
-                'month': '$_id.month'
-            }
-        },
-        {
-            '$addFields': {
-                'date': {
-                    '$dateFromParts': {
-                        'year': '$year',
-                        'month': '$month'
-                    }
-                }
-            }
-        },
-        {
-            '$project': {
-                'timestamp': {'$toLong': '$date'},
-                'temporalGranularity': 'monthly',
-                'articleAidList': '$articles.aid'
-            }
-        }
-    ]
-    results = client.aggregate(pipeline)
+    results = client.aggregate(monthly_pipeline(), allowDiskUse=True)
     return sorted(list(results), key=lambda x: x["timestamp"])
 
+def get_all_top_articles(client):
+    """
+    Aggregates daily, weekly and monthly top 5 articles in one scan.
+    Returns daily, then weekly, then monthly results, each sorted by timestamp.
+    """
+    facets = next(client.aggregate(all_granularities_pipeline(), allowDiskUse=True))
+    top_articles = []
+    for granularity in GRANULARITIES:
+        top_articles.extend(sorted(facets[granularity], key=lambda x: x["timestamp"]))
+    return top_articles
+
+def rank_target(db1_client, db2_client, granularity):
+    """Daily rankings are stored in db1, weekly/monthly in db2."""
+    return db1_client if granularity == "daily" else db2_client
+
+def bump_rank_version(client):
+    client.history.popular_rank_version.update_one(
+        {"_id": RANK_VERSION_ID},
+        {"$inc": {"version": 1}, "$set": {"updatedAt": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+def write_rank_documents(db1_client, db2_client, operations):
+    """Send rank upserts with one bulk_write per target database."""
+    for target_db, target_operations in ((db1_client, operations["daily"]),
+                                         (db2_client, operations["weekly"] + operations["monthly"])):
+        if target_operations:
+            target_db.history.popular_rank.bulk_write(target_operations, ordered=False)
+            bump_rank_version(target_db)
+
+def write_ranks(db1_client, db2_client, top_articles):
+    """Number rank documents in order and upsert them by bucket."""
+    operations = {granularity: [] for granularity in GRANULARITIES}
+    for _id, article in enumerate(top_articles):
+        article["id"] = _id
+        article.pop("_id", None)
+        operations[article["temporalGranularity"]].append(UpdateOne(
+            {"temporalGranularity": article["temporalGranularity"], "timestamp": article["timestamp"]},
+            {"$set": article},
+            upsert=True
+        ))
+    write_rank_documents(db1_client, db2_client, operations)
+
+def generate_full(db1_client, db2_client):
+    """Recompute every rank document from all beread buckets."""
+    # Aggregate articles for all temporal granularities in one scan
+    write_ranks(db1_client, db2_client, get_all_top_articles(db2_client.history.beread_bucket))
+
+def bucket_timestamps(read_time):
+    """
+    Map a read time to the start of its daily, weekly and monthly buckets
+    in epoch milliseconds, matching the aggregation pipelines above.
+    """
+    day = datetime(read_time.year, read_time.month, read_time.day, tzinfo=timezone.utc)
+    # Weeks start on Sunday, as with $dayOfWeek in the weekly pipeline
+    week = day - timedelta(days=(day.weekday() + 1) % 7)
+    month = day.replace(day=1)
+    return {
+        "daily": int(day.timestamp() * 1000),
+        "weekly": int(week.timestamp() * 1000),
+        "monthly": int(month.timestamp() * 1000),
+    }
+
+def read_record_time(read_record):
+    """Convert a history.read timestamp the same way generate_beread does."""
+    return datetime.fromtimestamp(int(read_record["timestamp"]) / 1000)
+
+def create_counter_indexes(client):
+    """Indexes backing counter upserts and per-bucket top-k lookups."""
+    apply_indexes(client, [("history", "rank_counter")])
+
+def increment_counters(client, counts, chunk=None, replay=False):
+    """
+    Add per-bucket per-aid access counts with a single bulk_write. Counters
+    written for a `chunk` of reads record it in appliedChunks, and a
+    `replay` of the chunk skips the counters that already have it.
+    """
+    update = {}
+    if chunk is not None:
+        update["$push"] = {"appliedChunks": {"$each": [chunk], "$slice": -APPLIED_CHUNKS_KEPT}}
+    applied = set()
+    if replay:
+        for granularity in GRANULARITIES:
+            timestamps = list({timestamp for g, timestamp, _ in counts if g == granularity})
+            applied.update(
+                (granularity, counter["timestamp"], counter["aid"])
+                for counter in client.history.rank_counter.find(
+                    {"temporalGranularity": granularity, "timestamp": {"$in": timestamps}, "appliedChunks": chunk},
+                    {"_id": 0, "timestamp": 1, "aid": 1}
+                )
+            )
+    operations = [
+        UpdateOne(
+            {"temporalGranularity": granularity, "timestamp": timestamp, "aid": aid},
+            dict(update, **{"$inc": {"accessCount": count}}),
+            upsert=True
+        )
+        for (granularity, timestamp, aid), count in counts.items()
+        if (granularity, timestamp, aid) not in applied
+    ]
+    if operations:
+        client.history.rank_counter.bulk_write(operations, ordered=False)
+
+def count_reads(read_times_by_aid):
+    """Count accesses per (granularity, bucket timestamp, aid)."""
+    counts = Counter()
+    for aid, read_time in read_times_by_aid:
+        for granularity, timestamp in bucket_timestamps(read_time).items():
+            counts[(granularity, timestamp, aid)] += 1
+    return counts
+
+def load_dirty_buckets(client):
+    """(granularity, bucket timestamp) pairs whose counters changed since their rank documents were written."""
+    state = client.history.rank_state.find_one({"_id": "dirty"})
+    return {(granularity, timestamp) for granularity, timestamp in state["buckets"]} if state else set()
+
+def add_dirty_buckets(client, buckets):
+    """Record buckets whose rank documents must be rewritten, before their counters change."""
+    if buckets:
+        client.history.rank_state.update_one(
+            {"_id": "dirty"},
+            {"$addToSet": {"buckets": {"$each": [[granularity, timestamp] for granularity, timestamp in buckets]}}},
+            upsert=True
+        )
+
+def clear_dirty_buckets(client, buckets):
+    """Forget buckets once their rank documents are written."""
+    if buckets:
+        client.history.rank_state.update_one(
+            {"_id": "dirty"},
+            {"$pullAll": {"buckets": [[granularity, timestamp] for granularity, timestamp in buckets]}}
+        )
+
+def seed_counters(db1_client, db2_client):
+    """
+    Rebuild the counters from db2's beread buckets, which hold every article.
+    Rank high-water marks start at the beread ones, since that is exactly
+    the set of reads beread reflects. Without beread marks that set is
+    unknown, so the counters are left empty and the rank marks cleared:
+    count_new_reads then counts every read of history.read.
+    """
+    db2_client.history.rank_counter.drop()
+    create_counter_indexes(db2_client)
+
+    last_read_ids = {source: load_high_water_mark(db2_client, source) for source in ("db1", "db2")}
+    if any(last_read_id is None for last_read_id in last_read_ids.values()):
+        print("beread has no high-water marks; counting ranks from history.read")
+        db2_client.history.rank_state.delete_many({})
+        return set()
+
+    counts = Counter()
+    for bucket in db2_client.history.beread_bucket.find({}, {"_id": 0, "aid": 1, "day": 1, "count": 1}):
+        for granularity, timestamp in bucket_timestamps(bucket["day"]).items():
+            counts[(granularity, timestamp, bucket["aid"])] += bucket["count"]
+    add_dirty_buckets(db2_client, {(granularity, timestamp) for granularity, timestamp, _ in counts})
+    increment_counters(db2_client, counts)
+
+    for source, last_read_id in last_read_ids.items():
+        save_high_water_mark(db2_client, source, last_read_id, "rank_state")
+    return {(granularity, timestamp) for granularity, timestamp, _ in counts}
+
+def count_new_reads(db1_client, db2_client, chunk_size=INCREMENTAL_CHUNK_SIZE):
+    """
+    Add reads inserted since the last run to the counters, leaving reads
+    that have not settled yet to the next run. Like the incremental beread,
+    each chunk is recorded as pending first, so an interrupted run replays
+    it without counting a read twice; the buckets it changes are recorded
+    as dirty before the counters move.
+    Returns the (granularity, bucket timestamp) pairs that changed.
+    """
+    dirty = set()
+    cutoff = read_cutoff()
+    for name, client in (("db1", db1_client), ("db2", db2_client)):
+        last_read_id = load_high_water_mark(db2_client, name, "rank_state")
+        pending = load_pending_chunk(db2_client, name, "rank_state")
+        while True:
+            query = {"_id": {"$lt": cutoff}}
+            if pending is not None:
+                query = {"_id": {"$lte": pending["lastReadId"]}}
+            if last_read_id is not None:
+                query["_id"]["$gt"] = last_read_id
+            read_records = list(
+                client.history.read.find(query, {"_id": 1, "aid": 1, "timestamp": 1})
+                .sort("_id", ASCENDING)
+                .limit(0 if pending is not None else chunk_size)
+            )
+            if not read_records and pending is not None:
+                # The reads of the pending chunk are gone; nothing is left to replay
+                last_read_id = pending["lastReadId"]
+                save_high_water_mark(db2_client, name, last_read_id, "rank_state")
+                pending = None
+                continue
+            if not read_records:
+                break
+
+            last_read_id = read_records[-1]["_id"]
+            if pending is None:
+                save_pending_chunk(db2_client, name, {"lastReadId": last_read_id}, "rank_state")
+            counts = count_reads((r["aid"], read_record_time(r)) for r in read_records)
+            chunk_dirty = {(granularity, timestamp) for granularity, timestamp, _ in counts}
+            add_dirty_buckets(db2_client, chunk_dirty)
+            increment_counters(db2_client, counts, f"{name}:{last_read_id}", replay=pending is not None)
+            dirty.update(chunk_dirty)
+
+            save_high_water_mark(db2_client, name, last_read_id, "rank_state")
+            pending = None
+    return dirty
+
+def top_articles_for_bucket(db2_client, granularity, timestamp):
+    """Read the top-k counters (aid, accessCount) of one bucket."""
+    return list(db2_client.history.rank_counter.find(
+        {"temporalGranularity": granularity, "timestamp": timestamp},
+        {"_id": 0, "aid": 1, "accessCount": 1}
+    ).sort("accessCount", DESCENDING).limit(TOP_K))
+
+def next_rank_id(db1_client, db2_client):
+    """Rank ids are unique across both databases, as in the full rebuild."""
+    ids = [
+        rank["id"]
+        for client in (db1_client, db2_client)
+        for rank in client.history.popular_rank.find({}, {"_id": 0, "id": 1}).sort("id", DESCENDING).limit(1)
+    ]
+    return max(ids) + 1 if ids else 0
+
+def generate_incremental(db1_client, db2_client, rebuild_counters=False, chunk_size=INCREMENTAL_CHUNK_SIZE):
+    """
+    Recompute only the rank documents whose buckets received new reads,
+    including those left dirty by an interrupted run.
+    """
+    if rebuild_counters or db2_client.history.rank_counter.estimated_document_count() == 0:
+        dirty = seed_counters(db1_client, db2_client)
+    else:
+        dirty = set()
+    dirty.update(count_new_reads(db1_client, db2_client, chunk_size))
+    dirty.update(load_dirty_buckets(db2_client))
+
+    # Buckets that already have a rank document keep their id
+    existing_ids = {}
+    for granularity in GRANULARITIES:
+        timestamps = [timestamp for g, timestamp in dirty if g == granularity]
+        target_db = rank_target(db1_client, db2_client, granularity)
+        for rank in target_db.history.popular_rank.find(
+            {"temporalGranularity": granularity, "timestamp": {"$in": timestamps}},
+            {"_id": 0, "id": 1, "timestamp": 1}
+        ):
+            existing_ids[(granularity, rank["timestamp"])] = rank["id"]
+
+    next_id = next_rank_id(db1_client, db2_client)
+    operations = {granularity: [] for granularity in GRANULARITIES}
+    rank_ids = []
+    for granularity, timestamp in sorted(dirty, key=lambda bucket: (bucket[1], bucket[0])):
+        rank_id = existing_ids.get((granularity, timestamp))
+        if rank_id is None:
+            rank_id, next_id = next_id, next_id + 1
+        rank_ids.append(rank_id)
+
+        counters = top_articles_for_bucket(db2_client, granularity, timestamp)
+        operations[granularity].append(UpdateOne(
+            {"temporalGranularity": granularity, "timestamp": timestamp},
+            {"$set": {
+                "id": rank_id,
+                "timestamp": timestamp,
+                "temporalGranularity": granularity,
+                "articleAidList": [counter["aid"] for counter in counters],
+                "accessCountList": [counter["accessCount"] for counter in counters],
+            }},
+            upsert=True
+        ))
+    write_rank_documents(db1_client, db2_client, operations)
+    clear_dirty_buckets(db2_client, dirty)
+    return rank_ids
+
+def rank_article_lists(db2_client, aid_lists, fetch_host=DEFAULT_FETCH_HOST, preview_bytes=PREVIEW_BYTES):
+    """
+    The article_list the rank endpoint builds for each list of aids:
+    one {text, aid} entry per aid, with the same text previews.
+    """
+    texts = article_previews(db2_client, [aid for aids in aid_lists for aid in aids], fetch_host, preview_bytes)
+    # Same entries as rank_response in app/api.py, missing texts included
+    return [[dict(text=texts.get(aid) or "", aid=aid) for aid in aids] for aids in aid_lists]
+
+def materialize_ranks(db1_client, db2_client, rank_ids=None, fetch_host=DEFAULT_FETCH_HOST,
+                      preview_bytes=PREVIEW_BYTES):
+    """
+    Store the API response of each rank inside its document: articleList
+    (exactly the entries the rank endpoint builds), beginDate and the
+    previewBytes the texts were cut to. `rank_ids` limits the refresh to
+    some ranks.
+    """
+    query = {} if rank_ids is None else {"id": {"$in": list(rank_ids)}}
+    # A list, not a dict: clients of the same address compare equal
+    ranks = [
+        (target_db, list(target_db.history.popular_rank.find(
+            dict(query, temporalGranularity={"$in": granularities}),
+            {"_id": 1, "timestamp": 1, "articleAidList": 1}
+        )))
+        for target_db, granularities in ((db1_client, ["daily"]), (db2_client, ["weekly", "monthly"]))
+    ]
+    article_lists = iter(rank_article_lists(
+        db2_client, [rank["articleAidList"] for _, target_ranks in ranks for rank in target_ranks],
+        fetch_host, preview_bytes))
+
+    materialized = 0
+    for target_db, target_ranks in ranks:
+        operations = []
+        for rank in target_ranks:
+            operations.append(UpdateOne({"_id": rank["_id"]}, {"$set": {
+                "articleList": next(article_lists),
+                "beginDate": datetime.fromtimestamp(int(rank["timestamp"]) / 1000).strftime('%Y-%m-%d'),
+                "previewBytes": preview_bytes,
+            }}))
+        if operations:
+            target_db.history.popular_rank.bulk_write(operations, ordered=False)
+            bump_rank_version(target_db)
+            materialized += len(operations)
+    return materialized
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate history.popular_rank from the beread buckets")
+    parser.add_argument("--mode", choices=["full", "incremental", "materialize"], default="full",
+                        help="full recomputes every bucket; incremental only buckets touched by new reads; "
+                             "materialize only refreshes the article summaries of existing ranks")
+    parser.add_argument("--rebuild-counters", action="store_true",
+                        help="in incremental mode, rebuild the per-bucket counters from the beread buckets first")
+    parser.add_argument("--chunk-size", type=int, default=INCREMENTAL_CHUNK_SIZE,
+                        help="number of new reads counted per step in incremental mode")
+    parser.add_argument("--materialize", action="store_true",
+                        help="also store hydrated article summaries in the written rank documents")
+    parser.add_argument("--fetch-host", default=DEFAULT_FETCH_HOST,
+                        help="host serving FastDFS files to this script, for text previews")
+    return parser.parse_args()
+
+def generate_pair(db1_client, db2_client, args):
+    """Write the ranks of one pair as selected by the command line; both pairs run at once."""
+    for client in (db1_client, db2_client):
+        apply_indexes(client, [("history", "popular_rank")])
+    if args.mode == "materialize":
+        rank_ids = None
+    elif args.mode == "incremental":
+        rank_ids = generate_incremental(db1_client, db2_client, args.rebuild_counters, args.chunk_size)
+        print(f"Refreshed {len(rank_ids)} rank buckets")
+    else:
+        generate_full(db1_client, db2_client)
+        rank_ids = None
+
+    if args.materialize or args.mode == "materialize":
+        materialized = materialize_ranks(db1_client, db2_client, rank_ids, args.fetch_host)
+        print(f"Materialized {materialized} rank documents")
+
 def main():
     """
     Main execution function that processes and stores top articles
     for daily, weekly, and monthly granularities.
     """
-    for db1_client, db2_client in clients:
-        top_articles = []
-        
-        # Aggregate articles for all temporal granularities
-        top_articles.extend(get_daily_top_articles(db2_client.history.beread))
-        top_articles.extend(get_weekly_top_articles(db2_client.history.beread))
-        top_articles.extend(get_monthly_top_articles(db2_client.history.beread))
-
-        # Process and store results
-        for _id, article in enumerate(top_articles):
-            article["id"] = _id
-            del article["_id"]
-            
-            # Store daily rankings in db1, weekly/monthly in db2
-            target_db = db1_client if article["temporalGranularity"] == "daily" else db2_client
-            target_db.history.popular_rank.update_one(
-                {"timestamp": article["timestamp"]},
-                {"$set": article},
-                upsert=True
-            )
+    args = parse_args()
+    run_pairs(generate_pair, clients, args)
 
 if __name__ == "__main__":
     main()
+
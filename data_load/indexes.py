@@ -0,0 +1,189 @@
+"""
+Index specification of every collection, and the tools to apply and check it.
+
+    python3 indexes.py apply --targets localhost:27001,localhost:27002,localhost:27003,localhost:27004
+    python3 indexes.py check --targets ...
+
+`apply` is idempotent: indexes already in place are left alone, and an index
+whose keys or options differ from the spec is rebuilt. `check` explains
+every hot query of the API and the generators and exits non-zero when one
+of them would scan a whole collection. Queries on empty collections only
+explain to an EOF plan and are reported as unverified.
+"""
+
+import argparse
+import json
+import sys
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel, MongoClient
+
+# Every node receives every index; collections a node does not hold stay empty
+INDEXES = {
+    ('info', 'user'): [
+        IndexModel([('uid', ASCENDING)], name='uid_1', unique=True),
+    ],
+    ('info', 'article'): [
+        IndexModel([('aid', ASCENDING)], name='aid_1', unique=True),
+    ],
+    ('history', 'read'): [
+        # Upsert key of resumed imports
+        IndexModel([('id', ASCENDING)], name='id_1', unique=True),
+        # beread generation per article
+        IndexModel([('aid', ASCENDING)], name='aid_1'),
+        # Reading history, paged by _id
+        IndexModel([('uid', ASCENDING), ('_id', ASCENDING)], name='uid_1__id_1'),
+    ],
+    ('history', 'beread'): [
+        IndexModel([('aid', ASCENDING)], name='aid_1', unique=True),
+    ],
+    ('history', 'beread_bucket'): [
+        # Per-article rewrites, and incremental pushes into a day's bucket with room left
+        IndexModel([('aid', ASCENDING), ('day', ASCENDING), ('count', ASCENDING)], name='aid_1_day_1_count_1'),
+    ],
+    ('history', 'popular_rank'): [
+        # Rank lookups and listings by id; not unique, a full rebuild renumbers ranks in place
+        IndexModel([('temporalGranularity', ASCENDING), ('id', ASCENDING)], name='temporalGranularity_1_id_1'),
+        # Upserts by bucket and the newest rank of a granularity
+        IndexModel([('temporalGranularity', ASCENDING), ('timestamp', ASCENDING)],
+                   name='temporalGranularity_1_timestamp_1', unique=True),
+        # Next free rank id
+        IndexModel([('id', ASCENDING)], name='id_1'),
+    ],
+    ('history', 'rank_counter'): [
+        # Counter upserts
+        IndexModel([('temporalGranularity', ASCENDING), ('timestamp', ASCENDING), ('aid', ASCENDING)],
+                   name='temporalGranularity_1_timestamp_1_aid_1', unique=True),
+        # Top-k of a bucket
+        IndexModel([('temporalGranularity', ASCENDING), ('timestamp', ASCENDING), ('accessCount', DESCENDING)],
+                   name='temporalGranularity_1_timestamp_1_accessCount_-1'),
+    ],
+    ('file', 'mapping'): [
+        IndexModel([('name', ASCENDING)], name='name_1', unique=True),
+    ],
+}
+
+# Queries of app/ and the generators that must use an index:
+# (namespace, filter, sort); values only need the right types
+HOT_QUERIES = [
+    (('info', 'user'), {'uid': '0'}, None),
+    (('info', 'article'), {'aid': {'$in': ['0', '1']}}, None),
+    (('history', 'read'), {'id': '0'}, None),
+    (('history', 'read'), {'aid': '0'}, None),
+    (('history', 'read'), {'uid': '0'}, [('_id', ASCENDING)]),
+    (('history', 'read'), {'uid': '0', '_id': {'$gt': ObjectId('0' * 24)}}, [('_id', ASCENDING)]),
+    (('history', 'read'), {'_id': {'$gt': ObjectId('0' * 24)}}, [('_id', ASCENDING)]),
+    (('history', 'beread'), {'aid': {'$in': ['0', '1']}}, None),
+    (('history', 'beread_bucket'), {'aid': '0', 'day': datetime(2017, 9, 25), 'count': {'$lte': 0}}, None),
+    (('history', 'beread_bucket'), {'aid': '0'}, None),
+    (('history', 'popular_rank'), {'temporalGranularity': 'daily', 'id': 0}, None),
+    (('history', 'popular_rank'), {'temporalGranularity': 'daily', 'id': {'$gt': 0}}, [('id', ASCENDING)]),
+    (('history', 'popular_rank'), {'temporalGranularity': 'daily'}, [('timestamp', DESCENDING)]),
+    (('history', 'popular_rank'), {'temporalGranularity': 'daily', 'timestamp': {'$in': [0]}}, None),
+    (('history', 'popular_rank'), {}, [('id', DESCENDING)]),
+    (('history', 'popular_rank'), {'id': {'$in': [0]}, 'temporalGranularity': {'$in': ['daily']}}, None),
+    (('history', 'rank_counter'), {'temporalGranularity': 'daily', 'timestamp': 0}, [('accessCount', DESCENDING)]),
+    (('file', 'mapping'), {'name': {'$in': ['0', '1']}}, None),
+]
+
+def _index_options(document):
+    """Comparable (keys, unique) of an index_information() entry or an IndexModel document."""
+    keys = document['key'].items() if isinstance(document['key'], dict) else document['key']
+    return [(field, int(direction)) for field, direction in keys], bool(document.get('unique', False))
+
+def upsert_index(namespace, field):
+    """The unique single-field index of `namespace` that upserts on `field` rely on."""
+    for model in INDEXES[namespace]:
+        spec = model.document
+        if spec.get('unique') and list(spec['key'].items()) == [(field, ASCENDING)]:
+            return model
+    raise KeyError(f"no unique index on {field} for {'.'.join(namespace)}")
+
+def apply_indexes(client, namespaces=None):
+    """
+    Create the specified indexes on one node, rebuilding those whose keys or
+    options changed. Returns the names of the indexes created.
+    """
+    created = []
+    for namespace, models in INDEXES.items():
+        if namespaces is not None and namespace not in namespaces:
+            continue
+        database, collection = namespace
+        coll = client[database][collection]
+        existing = coll.index_information()
+        missing = []
+        for model in models:
+            spec = model.document
+            current = existing.get(spec['name'])
+            if current is not None and _index_options(current) == _index_options(spec):
+                continue
+            if current is not None:
+                coll.drop_index(spec['name'])
+            missing.append(model)
+        if missing:
+            created.extend(f"{database}.{collection}.{name}" for name in coll.create_indexes(missing))
+    return created
+
+def _stages(plan):
+    if plan.get('stage'):
+        yield plan['stage']
+    for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+        if child:
+            yield from _stages(child)
+
+def winning_plan(explain):
+    """The winning plan tree of an explain; the slot-based engine nests it under queryPlan."""
+    winning = explain.get('queryPlanner', {}).get('winningPlan', {})
+    return winning.get('queryPlan', winning)
+
+def check_queries(client):
+    """
+    Explain every hot query on one node. Return the queries whose plan
+    scans a collection, and those left unverified because their plan is
+    EOF (an empty or missing collection) or has no stages.
+    """
+    failures = []
+    unverified = []
+    for (database, collection), query, sort in HOT_QUERIES:
+        cursor = client[database][collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        stages = list(_stages(winning_plan(cursor.explain())))
+        entry = dict(namespace=f"{database}.{collection}", filter=str(query), sort=str(sort), stages=stages)
+        if 'COLLSCAN' in stages:
+            failures.append(entry)
+        elif not stages or 'EOF' in stages:
+            unverified.append(entry)
+    return failures, unverified
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Apply and check the MongoDB index specification")
+    parser.add_argument("command", choices=["apply", "check", "all"],
+                        help="apply the spec, check the hot queries, or both")
+    parser.add_argument("--targets", default="localhost:27001,localhost:27002,localhost:27003,localhost:27004",
+                        help="comma separated host:port of every node")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    report = {}
+    failed = False
+    for target in args.targets.split(","):
+        host, port = target.rsplit(":", 1)
+        client = MongoClient(host=host, port=int(port))
+        try:
+            report[target] = {}
+            if args.command in ("apply", "all"):
+                report[target]["created"] = apply_indexes(client)
+            if args.command in ("check", "all"):
+                report[target]["collscans"], report[target]["unverified"] = check_queries(client)
+                failed = failed or bool(report[target]["collscans"])
+        finally:
+            client.close()
+    print(json.dumps(report, indent=2))
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
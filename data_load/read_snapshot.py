@@ -0,0 +1,291 @@
+"""
+Columnar snapshot of history.read for offline ranking and beread analytics.
+
+Reads are exported once into day partitions of four NumPy columns:
+aid (uint32 index into aids.npy), uid (uint32 index into uids.npy),
+ts (int64 epoch milliseconds) and flags (uint8 comment/agree/share bits).
+Rankings and beread counters are then recomputed with vectorized
+bincounts over memory-mapped partitions instead of aggregations on the
+serving MongoDB nodes.
+
+    python3 read_snapshot.py export --snapshot read_snapshot
+    python3 read_snapshot.py rank --snapshot read_snapshot
+    python3 read_snapshot.py beread --snapshot read_snapshot --output beread_counters.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+from array import array
+from datetime import date, datetime, timezone
+from pathlib import Path
+
+from bson import json_util
+from tqdm import tqdm
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from generate_beread import READ_PROJECTION, get_mongo_clients, read_cutoff
+from generate_popular_rank import (DEFAULT_FETCH_HOST, GRANULARITIES, TOP_K, apply_indexes, bucket_timestamps,
+                                   materialize_ranks, read_record_time, write_ranks)
+
+DEFAULT_SNAPSHOT = "read_snapshot"
+
+MANIFEST_FILE = "manifest.json"
+PARTITION_DIR = "reads"
+
+# Column name -> array typecode (array module) and NumPy dtype
+COLUMNS = {"aid": ("I", "uint32"), "uid": ("I", "uint32"), "ts": ("q", "int64"), "flags": ("B", "uint8")}
+
+# Beread counter -> (read record field, bit in the flags column)
+FLAG_FIELDS = {"commentNum": ("commentOrNot", 1), "agreeNum": ("agreeOrNot", 2), "shareNum": ("shareOrNot", 4)}
+
+EXPORT_BATCH_SIZE = 10000
+
+def _require_numpy():
+    if np is None:
+        raise ValueError("read snapshots require the numpy package")
+
+def load_manifest(snapshot):
+    """The snapshot manifest, or None if nothing was exported to `snapshot` yet."""
+    manifest_file = Path(snapshot) / MANIFEST_FILE
+    if not manifest_file.exists():
+        return None
+    with open(manifest_file) as manifest:
+        return json_util.loads(manifest.read())
+
+def save_manifest(snapshot, manifest):
+    """Replace the manifest atomically; it is written after the partitions it lists."""
+    manifest_file = Path(snapshot) / MANIFEST_FILE
+    temporary = manifest_file.with_suffix(".tmp")
+    with open(temporary, "w") as out_file:
+        out_file.write(json_util.dumps(manifest, indent=2))
+    os.replace(temporary, manifest_file)
+
+def load_dictionary(snapshot, name):
+    """aids or uids, in column index order."""
+    dictionary_file = Path(snapshot) / f"{name}.npy"
+    return np.load(dictionary_file).tolist() if dictionary_file.exists() else []
+
+def save_dictionary(snapshot, name, values):
+    dictionary_file = Path(snapshot) / f"{name}.npy"
+    temporary = Path(snapshot) / f"{name}.tmp.npy"
+    np.save(temporary, np.array(values, dtype=str))
+    os.replace(temporary, dictionary_file)
+
+def load_partition(snapshot, day, rows):
+    """
+    The columns of one day. Plain partitions are memory-mapped; compressed
+    ones are decompressed column by column. Only the first `rows` rows,
+    the ones the manifest covers, are returned.
+    """
+    directory = Path(snapshot) / PARTITION_DIR
+    if (directory / f"{day}.npz").exists():
+        with np.load(directory / f"{day}.npz") as data:
+            return {name: data[name][:rows] for name in COLUMNS}
+    return {name: np.load(directory / day / f"{name}.npy", mmap_mode="r")[:rows] for name in COLUMNS}
+
+def write_partition(snapshot, day, columns, compress):
+    directory = Path(snapshot) / PARTITION_DIR
+    if compress:
+        temporary = directory / f"{day}.tmp.npz"
+        np.savez_compressed(temporary, **columns)
+        os.replace(temporary, directory / f"{day}.npz")
+        return
+    (directory / day).mkdir(parents=True, exist_ok=True)
+    for name, values in columns.items():
+        temporary = directory / day / f"{name}.tmp.npy"
+        np.save(temporary, values)
+        os.replace(temporary, directory / day / f"{name}.npy")
+
+def read_flags(read_record):
+    return sum(bit for field, bit in FLAG_FIELDS.values() if int(read_record[field]))
+
+def export_snapshot(snapshot, db1_client, db2_client, full=False, compress=False):
+    """
+    Append reads inserted since the last export to the snapshot, or rebuild
+    it from scratch with `full`. Partitions are rewritten before the
+    manifest, so an interrupted export is redone by the next run.
+    Returns the number of reads exported.
+    """
+    _require_numpy()
+    snapshot = Path(snapshot)
+    manifest = None if full else load_manifest(snapshot)
+    if manifest is None:
+        # The old manifest goes first, so a half-done rebuild is never read
+        if (snapshot / MANIFEST_FILE).exists():
+            (snapshot / MANIFEST_FILE).unlink()
+        shutil.rmtree(snapshot / PARTITION_DIR, ignore_errors=True)
+        manifest = {"compressed": compress, "days": {}, "lastReadIds": {}}
+        aids, uids = [], []
+    else:
+        aids, uids = load_dictionary(snapshot, "aids"), load_dictionary(snapshot, "uids")
+    (snapshot / PARTITION_DIR).mkdir(parents=True, exist_ok=True)
+    aid_ids = {aid: i for i, aid in enumerate(aids)}
+    uid_ids = {uid: i for i, uid in enumerate(uids)}
+
+    def index(ids, values, value):
+        if value not in ids:
+            ids[value] = len(values)
+            values.append(value)
+        return ids[value]
+
+    new_reads = {}
+    exported = 0
+    # Reads that have not settled are left to the next export
+    cutoff = read_cutoff()
+    for name, client in (("db1", db1_client), ("db2", db2_client)):
+        last_read_id = manifest["lastReadIds"].get(name)
+        query = {"_id": {"$lt": cutoff}}
+        if last_read_id is not None:
+            query["_id"]["$gt"] = last_read_id
+        cursor = client.history.read.find(query, READ_PROJECTION, batch_size=EXPORT_BATCH_SIZE)
+        for read_record in tqdm(cursor, desc=f"Exporting {name} reads"):
+            if last_read_id is None or read_record["_id"] > last_read_id:
+                last_read_id = read_record["_id"]
+            day = read_record_time(read_record).date().isoformat()
+            if day not in new_reads:
+                new_reads[day] = {column: array(typecode) for column, (typecode, _) in COLUMNS.items()}
+            columns = new_reads[day]
+            columns["aid"].append(index(aid_ids, aids, read_record["aid"]))
+            columns["uid"].append(index(uid_ids, uids, read_record["uid"]))
+            columns["ts"].append(int(read_record["timestamp"]))
+            columns["flags"].append(read_flags(read_record))
+            exported += 1
+        if last_read_id is not None:
+            manifest["lastReadIds"][name] = last_read_id
+
+    for day, columns in tqdm(sorted(new_reads.items()), desc="Writing partitions"):
+        columns = {name: np.frombuffer(values, dtype=COLUMNS[name][1]) for name, values in columns.items()}
+        rows = manifest["days"].get(day, 0)
+        if rows:
+            existing = load_partition(snapshot, day, rows)
+            columns = {name: np.concatenate([existing[name], columns[name]]) for name in COLUMNS}
+        write_partition(snapshot, day, columns, manifest["compressed"])
+        manifest["days"][day] = len(columns["aid"])
+
+    save_dictionary(snapshot, "aids", aids)
+    save_dictionary(snapshot, "uids", uids)
+    manifest["exportedAt"] = datetime.now(timezone.utc)
+    save_manifest(snapshot, manifest)
+    return exported
+
+def iter_partitions(snapshot):
+    """(day, columns) of every partition, oldest first."""
+    manifest = load_manifest(snapshot)
+    if manifest is None:
+        raise ValueError(f"no read snapshot in {snapshot}")
+    for day, rows in sorted(manifest["days"].items()):
+        yield date.fromisoformat(day), load_partition(snapshot, day, rows)
+
+def top_articles(counts, aids, k=TOP_K):
+    """The k most read aids and their counts, ties broken by first appearance in the snapshot."""
+    candidates = np.flatnonzero(counts)
+    if len(candidates) > k:
+        threshold = np.partition(counts[candidates], len(candidates) - k)[len(candidates) - k]
+        candidates = candidates[counts[candidates] >= threshold]
+    top = candidates[np.lexsort((candidates, -counts[candidates]))[:k]]
+    return [aids[i] for i in top], [int(count) for count in counts[top]]
+
+def rank_documents(snapshot, k=TOP_K):
+    """
+    Rank documents of every daily, weekly and monthly bucket, in the order
+    of get_all_top_articles. Days are scanned in order and weeks and months
+    are contiguous runs of days, so only the open bucket of each
+    granularity is kept in memory.
+    """
+    _require_numpy()
+    aids = load_dictionary(snapshot, "aids")
+    ranks = {granularity: [] for granularity in GRANULARITIES}
+    open_buckets = {}
+
+    def close(granularity):
+        timestamp, counts = open_buckets.pop(granularity)
+        aid_list, count_list = top_articles(counts, aids, k)
+        ranks[granularity].append({
+            "timestamp": timestamp,
+            "temporalGranularity": granularity,
+            "articleAidList": aid_list,
+            "accessCountList": count_list,
+        })
+
+    for day, columns in iter_partitions(snapshot):
+        day_counts = np.bincount(columns["aid"], minlength=len(aids))
+        read_time = datetime(day.year, day.month, day.day)
+        for granularity, timestamp in bucket_timestamps(read_time).items():
+            if granularity in open_buckets and open_buckets[granularity][0] != timestamp:
+                close(granularity)
+            if granularity in open_buckets:
+                open_buckets[granularity][1] += day_counts
+            else:
+                open_buckets[granularity] = [timestamp, day_counts.copy()]
+    for granularity in list(open_buckets):
+        close(granularity)
+    return [rank for granularity in GRANULARITIES for rank in ranks[granularity]]
+
+def beread_counters(snapshot):
+    """{aid: readNum/commentNum/agreeNum/shareNum} of every article read in the snapshot."""
+    _require_numpy()
+    aids = load_dictionary(snapshot, "aids")
+    fields = ["readNum"] + list(FLAG_FIELDS)
+    totals = np.zeros((len(fields), len(aids)), dtype=np.int64)
+    for _, columns in iter_partitions(snapshot):
+        aid, flags = columns["aid"], columns["flags"]
+        totals[0] += np.bincount(aid, minlength=len(aids))
+        for row, (_, bit) in enumerate(FLAG_FIELDS.values(), 1):
+            totals[row] += np.bincount(aid[(flags & bit) != 0], minlength=len(aids))
+    return {
+        aids[i]: {field: int(totals[row, i]) for row, field in enumerate(fields)}
+        for i in np.flatnonzero(totals[0])
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export history.read to a columnar snapshot and rank from it")
+    parser.add_argument("command", choices=["export", "rank", "beread"],
+                        help="export new reads; rank writes popular_rank from the snapshot; "
+                             "beread prints per-article counters")
+    parser.add_argument("--snapshot", default=DEFAULT_SNAPSHOT, help="snapshot directory")
+    parser.add_argument("--full", action="store_true", help="re-export every read instead of appending new ones")
+    parser.add_argument("--compress", action="store_true",
+                        help="with a new or --full export, store partitions as compressed .npz "
+                             "(smaller, but not memory-mapped)")
+    parser.add_argument("--source", choices=["backup", "primary"], default="backup",
+                        help="nodes to export reads from")
+    parser.add_argument("--materialize", action="store_true",
+                        help="after rank, also store hydrated article summaries in the rank documents")
+    parser.add_argument("--fetch-host", default=DEFAULT_FETCH_HOST,
+                        help="host serving FastDFS files to this script, for text previews")
+    parser.add_argument("--output", help="file for the beread counters (default: stdout)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    clients = get_mongo_clients()
+    if args.command == "export":
+        db1_client, db2_client = clients[1] if args.source == "backup" else clients[0]
+        exported = export_snapshot(args.snapshot, db1_client, db2_client, args.full, args.compress)
+        print(f"Exported {exported} reads to {args.snapshot}")
+    elif args.command == "rank":
+        ranks = rank_documents(args.snapshot)
+        for db1_client, db2_client in clients:
+            for client in (db1_client, db2_client):
+                apply_indexes(client, [("history", "popular_rank")])
+            write_ranks(db1_client, db2_client, [dict(rank) for rank in ranks])
+            if args.materialize:
+                materialized = materialize_ranks(db1_client, db2_client, fetch_host=args.fetch_host)
+                print(f"Materialized {materialized} rank documents")
+        print(f"Wrote {len(ranks)} rank documents")
+    else:
+        counters = json.dumps(beread_counters(args.snapshot), indent=2)
+        if args.output:
+            with open(args.output, "w") as out_file:
+                out_file.write(counters)
+        else:
+            print(counters)
+
+if __name__ == "__main__":
+    main()